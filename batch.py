@@ -0,0 +1,327 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import openai
+from langchain_core.prompts import ChatPromptTemplate
+
+from history_store import MESSAGE_TOKEN_OVERHEAD, count_tokens
+
+
+# 这些 HTTP 状态码通常是暂时性的（限流、超时、服务端错误），值得重试；其余错误（例如 401、400）直接记为失败
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+# 还没有任何完成的请求时，按这个数估算每个回答的 token 数
+DEFAULT_OUTPUT_TOKENS = 256
+# 每完成这么多条打印一次进度
+PROGRESS_EVERY = 50
+
+
+class RateLimiter:
+    """
+    滑动窗口限流：任意 window 秒内发出的请求数不超过 rpm，消耗的 token 数不超过 tpm，0 表示不限。
+    发请求前按估算的 token 数占用额度，请求结束后用 settle() 更正为实际用量。
+    """
+    def __init__(self, rpm=0, tpm=0, window=60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        # 每个请求一条 [发出时间, token 数]，按时间顺序排列
+        self._events = deque()
+        self._tokens = 0
+        self._cond = threading.Condition()
+
+    def _expire(self, now):
+        while self._events and now - self._events[0][0] >= self.window:
+            self._tokens -= self._events.popleft()[1]
+
+    def acquire(self, tokens):
+        """阻塞直到可以发出一个预计消耗 tokens 的请求，返回它的记录，之后传给 settle()。"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._expire(now)
+                # 单个请求的估算就超过 tpm 时，等窗口清空后放行，否则会永远等下去
+                over_rpm = self.rpm and len(self._events) >= self.rpm
+                over_tpm = self.tpm and self._events and self._tokens + tokens > self.tpm
+                if not over_rpm and not over_tpm:
+                    event = [now, tokens]
+                    self._events.append(event)
+                    self._tokens += tokens
+                    return event
+                # 等到最早的一条记录滑出窗口；settle() 减少用量时也会提前唤醒
+                self._cond.wait(self._events[0][0] + self.window - now)
+
+    def settle(self, event, tokens):
+        with self._cond:
+            now = time.monotonic()
+            self._expire(now)
+            # 已经滑出窗口的记录不再计入用量
+            if now - event[0] < self.window:
+                self._tokens += tokens - event[1]
+            event[1] = tokens
+            self._cond.notify_all()
+
+
+def _retry_after(error):
+    """服务端在 Retry-After 响应头里给出的等待秒数，没有时返回 None。"""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    if isinstance(error, openai.APIConnectionError):
+        # 包括超时（APITimeoutError 是它的子类）
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    return False
+
+
+def read_items(input_path):
+    """
+    逐行读取输入的 JSONL，产出 (index, item_id, text, error)。
+    每行可以是一个 JSON 字符串，或者带 "input" 字段（以及可选的 "id" 字段）的对象；空行会被跳过。
+    index 是非空行的序号，无法解析的行也占一个序号，以 error 的形式写进结果，保证输出与输入一一对应。
+    """
+    with open(input_path, "r", encoding="utf-8") as f:
+        index = 0
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                if isinstance(item, str):
+                    yield index, index, item, None
+                else:
+                    yield index, item.get("id", index), str(item["input"]), None
+            except (ValueError, KeyError, AttributeError) as e:
+                yield index, index, None, f"Invalid input on line {line_number}: {e!r}"
+            index += 1
+
+
+def load_finished(output_path):
+    """
+    读取已有的输出文件，返回 (成功的输入序号, 失败的输入序号) 两个集合。
+    进程被强行结束时最后一行可能只写了一半，这里把它截掉，续跑时从这一条重新开始。
+    """
+    succeeded, failed = set(), set()
+    if not os.path.exists(output_path):
+        return succeeded, failed
+    valid_bytes = 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+                (failed if "error" in record else succeeded).add(record["index"])
+            except (ValueError, KeyError, TypeError):
+                break
+            valid_bytes += len(line)
+    if valid_bytes < os.path.getsize(output_path):
+        logging.warning(f"Discarding an incomplete record at the end of {output_path}.")
+        with open(output_path, "r+b") as f:
+            f.truncate(valid_bytes)
+    # 同一条先失败、后来重试成功时以成功为准
+    return succeeded, failed - succeeded
+
+
+def _read_records(path):
+    """逐行产出输出文件中的 (index, 是否成功, 原始行)。"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            yield record["index"], "error" not in record, line
+
+
+def merge_outputs(newer_path, older_path):
+    """
+    把两个按输入顺序排列的输出文件按 index 合并成一个，写回 newer_path 并删掉 older_path。
+    同一条两边都有时优先取成功的记录，都失败时取较新的。用于恢复重试失败条目时被打断的续跑。
+    """
+    if not os.path.exists(newer_path):
+        # 原来的输出刚被移开、新文件还没创建就被打断了
+        os.replace(older_path, newer_path)
+        return
+    load_finished(newer_path)
+    merged_path = newer_path + ".merging"
+    with open(merged_path, "w", encoding="utf-8") as out:
+        newer, older = _read_records(newer_path), _read_records(older_path)
+        a, b = next(newer, None), next(older, None)
+        while a or b:
+            if b is None or (a and a[0] < b[0]):
+                out.write(a[2])
+                a = next(newer, None)
+            elif a is None or b[0] < a[0]:
+                out.write(b[2])
+                b = next(older, None)
+            else:
+                out.write(a[2] if a[1] or not b[1] else b[2])
+                a, b = next(newer, None), next(older, None)
+    os.replace(merged_path, newer_path)
+    os.remove(older_path)
+
+
+class BatchRunner:
+    """
+    无界面的批处理：对输入 JSONL 的每一条，用同一个提示词角色调用一次模型，结果写入输出 JSONL。
+    - 并发：最多 concurrency 个请求同时进行，发出前经过 RateLimiter 限流
+    - 重试：暂时性错误按指数退避（带随机抖动）重试，最多 max_retries 次，服务端给出 Retry-After 时以它为准
+    - 顺序：结果按输入顺序写出，每条写完立即 flush；等待写出的结果最多 concurrency * 4 条，内存占用不随输入增长
+    - 续跑：中断后用同样的参数重新运行即可接着处理，输出文件里已经成功的条目会被跳过；
+      失败的条目会重新处理，新的结果替换原来的错误记录，输出仍然按输入顺序排列
+    每条批处理都是独立的一问一答，不读写聊天记录。
+    """
+    def __init__(self, llm, system_prompt, concurrency=4, rpm=0, tpm=0, max_retries=5,
+                 backoff_seconds=1.0, max_backoff_seconds=60.0):
+        self.system_prompt = system_prompt
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.limiter = RateLimiter(rpm, tpm)
+        prompt = ChatPromptTemplate.from_messages([("system", system_prompt), ("human", "{question}")])
+        self.chain = prompt | llm
+        self._system_tokens = count_tokens(system_prompt) + MESSAGE_TOKEN_OVERHEAD
+        self._lock = threading.Lock()
+        self._output_tokens = None
+
+    def _expected_output_tokens(self):
+        """已完成请求的回答长度的滑动平均，用于估算下一个请求的 token 数。"""
+        with self._lock:
+            return int(self._output_tokens or DEFAULT_OUTPUT_TOKENS)
+
+    def _observe_output(self, tokens):
+        with self._lock:
+            self._output_tokens = tokens if self._output_tokens is None else 0.8 * self._output_tokens + 0.2 * tokens
+
+    def _backoff(self, attempt, error):
+        delay = min(self.backoff_seconds * 2 ** attempt, self.max_backoff_seconds)
+        # 随机抖动，避免一批同时被限流的请求又同时重试
+        delay *= random.uniform(0.5, 1.0)
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_backoff_seconds))
+        return delay
+
+    def _process(self, index, item_id, text):
+        """处理一条输入，返回要写进输出文件的记录。在线程池中执行。"""
+        started_at = time.perf_counter()
+        record = {"index": index, "id": item_id}
+        input_tokens = self._system_tokens + count_tokens(text) + MESSAGE_TOKEN_OVERHEAD
+        for attempt in range(self.max_retries + 1):
+            estimate = input_tokens + self._expected_output_tokens()
+            event = self.limiter.acquire(estimate)
+            try:
+                response = self.chain.invoke({"question": text})
+            except Exception as e:
+                # 失败的请求同样占用了请求数额度，但 token 按 0 计
+                self.limiter.settle(event, 0)
+                if attempt < self.max_retries and is_retryable(e):
+                    delay = self._backoff(attempt, e)
+                    logging.warning(
+                        f"Batch item {index} failed (attempt {attempt + 1}), retrying in {delay:.1f}s: {e}"
+                    )
+                    time.sleep(delay)
+                    continue
+                logging.error(f"Batch item {index} failed after {attempt + 1} attempt(s): {e}")
+                record.update(error=str(e), attempts=attempt + 1)
+                break
+
+            # 服务端没有返回用量时（部分兼容接口）按本地估算
+            usage = getattr(response, "usage_metadata", None) or {}
+            output_tokens = usage.get("output_tokens") or count_tokens(response.content)
+            self.limiter.settle(event, usage.get("total_tokens") or input_tokens + output_tokens)
+            self._observe_output(output_tokens)
+            record.update(output=response.content, attempts=attempt + 1)
+            if usage:
+                record["usage"] = {key: usage.get(key) for key in ("input_tokens", "output_tokens", "total_tokens")}
+            break
+        record["elapsed_ms"] = round((time.perf_counter() - started_at) * 1000, 1)
+        return record
+
+    def run(self, input_path, output_path):
+        """处理 input_path 中还没有在 output_path 里成功完成的所有条目，返回统计信息。"""
+        previous_path = output_path + ".resume"
+        if os.path.exists(previous_path):
+            # 上次重试失败条目时被打断：已经写出的新结果和原来的输出合并回一个文件
+            logging.warning(f"Recovering an interrupted resume of {output_path}.")
+            merge_outputs(output_path, previous_path)
+        succeeded, failed = load_finished(output_path)
+        if failed:
+            # 失败的条目要按输入顺序重新写回原来的位置：把原来的输出移开，
+            # 处理时把成功的记录原样抄回新文件，失败的和还没处理的条目重新请求
+            os.replace(output_path, previous_path)
+            logging.info(f"Resuming batch: retrying {len(failed)} failed items from {output_path}.")
+        if succeeded:
+            logging.info(f"Resuming batch: {len(succeeded)} items already in {output_path} will be skipped.")
+        stats = {"skipped": len(succeeded), "succeeded": 0, "failed": 0}
+        started_at = time.perf_counter()
+        window = self.concurrency * 4
+        pending = deque()
+
+        def write(future, out):
+            record = future.result()
+            if isinstance(record, str):
+                # 从原来的输出里抄回来的成功记录
+                out.write(record)
+                return
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            stats["failed" if "error" in record else "succeeded"] += 1
+            done = stats["succeeded"] + stats["failed"]
+            if done % PROGRESS_EVERY == 0:
+                elapsed = time.perf_counter() - started_at
+                logging.info(
+                    f"Batch progress: {done} done ({stats['failed']} failed), "
+                    f"{done / elapsed * 60:.0f} items/min"
+                )
+
+        def copied(line):
+            future = Future()
+            future.set_result(line)
+            return future
+
+        pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch")
+        # 重试失败条目时，原来输出里成功的记录按 index 顺序逐条取出
+        previous = ((index, line) for index, ok, line in _read_records(previous_path) if ok) if failed else None
+        try:
+            with open(output_path, "w" if failed else "a", encoding="utf-8") as out:
+                for index, item_id, text, error in read_items(input_path):
+                    if index in succeeded:
+                        if not failed:
+                            continue
+                        future = copied(next(line for previous_index, line in previous if previous_index == index))
+                    elif error is not None:
+                        future = pool.submit(dict, index=index, id=item_id, error=error, attempts=0)
+                    else:
+                        future = pool.submit(self._process, index, item_id, text)
+                    pending.append(future)
+                    # 按输入顺序写出已经完成的结果；排队的结果太多时等最早的那条完成
+                    while pending and (len(pending) >= window or pending[0].done()):
+                        write(pending.popleft(), out)
+                while pending:
+                    write(pending.popleft(), out)
+        finally:
+            # 被 Ctrl+C 打断时不再等待排队中的条目，已经写出的结果在续跑时会被跳过
+            pool.shutdown(wait=not pending, cancel_futures=True)
+            if previous:
+                previous.close()
+        if failed:
+            # 全部写完才删掉原来的输出；中途被打断时保留它，下次运行先合并
+            os.remove(previous_path)
+
+        stats["elapsed_seconds"] = round(time.perf_counter() - started_at, 2)
+        logging.info(
+            f"Batch finished: {stats['succeeded']} succeeded, {stats['failed']} failed, "
+            f"{stats['skipped']} skipped in {stats['elapsed_seconds']:.1f}s."
+        )
+        return stats
@@ -0,0 +1,220 @@
+"""
+端到端的离线基准测试：不需要真实的服务商，也不需要打开窗口。
+
+启动一个本地的假 OpenAI 兼容服务（见 fake_openai_server.py），在临时目录里生成指向它的
+secrets.json / prompts.json，然后导入 main.py，用一个只记录调用的假窗口代替 _window，
+直接驱动 Api.process_input / regenerate_response / set_prompt_profile。
+
+对每种会话长度（默认 10 / 100 / 1000 / 10000 轮历史）报告：
+- turn:   从调用 process_input 到前端收到 requestFinished 的总耗时
+- ttft:   从调用 process_input 到前端收到第一批文字的耗时
+- regen:  regenerate_response 的总耗时
+- load:   chain 每轮读取历史窗口的耗时
+- rss:    跑完该长度后进程的常驻内存
+以及 set_prompt_profile 第一次构建 chain 和之后复用 chain 的耗时。
+
+用法: python benchmarks/bench_api.py [--sizes 10,100,1000,10000] [--turns 30] [--latency 0.05]
+                                     [--tokens-per-second 500] [--response-tokens 50] [--no-stream]
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_openai_server import FakeOpenAIServer
+from history_store import MESSAGE_TOKEN_OVERHEAD, count_tokens
+from process_memory import current_rss_mb
+
+
+JS_CALL_PATTERN = re.compile(r'^(\w+)\(("(?:[^"\\]|\\.)*")')
+
+
+class RecordingWindow:
+    """代替 pywebview 窗口：记录每个请求第一次收到文字和结束的时间点。"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+        self.calls = 0
+
+    def _entry(self, request_id):
+        with self._lock:
+            return self._requests.setdefault(request_id, {"first_token_at": None, "done": threading.Event()})
+
+    def evaluate_js(self, script):
+        now = time.perf_counter()
+        self.calls += 1
+        match = JS_CALL_PATTERN.match(script)
+        if not match:
+            return
+        function, argument = match.group(1), json.loads(match.group(2))
+        if function == "appendToStreamingMessage":
+            entry = self._entry(argument)
+            if entry["first_token_at"] is None:
+                entry["first_token_at"] = now
+        elif function == "requestFinished":
+            entry = self._entry(argument)
+            entry["finished_at"] = now
+            entry["done"].set()
+
+    def wait(self, request_id, timeout=120):
+        entry = self._entry(request_id)
+        if not entry["done"].wait(timeout):
+            raise TimeoutError(f"Request {request_id} did not finish within {timeout}s")
+        return entry["first_token_at"], entry["finished_at"]
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def describe(values):
+    ms = [v * 1000 for v in values]
+    return f"{percentile(ms, 0.5):8.2f} {percentile(ms, 0.95):8.2f} {percentile(ms, 0.99):8.2f}"
+
+
+def write_config(directory, base_url, stream):
+    settings = {
+        "model_name": "bench-model",
+        "api_key": "sk-bench",
+        "base_url": base_url,
+        "hotkey": "ctrl+shift+a",
+        "stream": stream,
+        "prewarm_on_show": False,
+    }
+    prompts = {
+        "default": {"name": "默认助手", "prompt": "You are a helpful assistant."},
+        "bench": {"name": "基准测试", "prompt": "You are a terse assistant used for benchmarking. " * 10},
+    }
+    with open(os.path.join(directory, "secrets.json"), "w", encoding="utf-8") as f:
+        json.dump(settings, f, indent=4)
+    with open(os.path.join(directory, "prompts.json"), "w", encoding="utf-8") as f:
+        json.dump(prompts, f, indent=4, ensure_ascii=False)
+
+
+def seed_session(store, session_id, turns):
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    batch = []
+    for i in range(turns):
+        batch += [
+            HumanMessage(content=f"问题 {i}: " + "这是一个用来测试的问题。" * 5),
+            AIMessage(content=f"回答 {i}: " + "这是一段用来测试的回答内容。" * 20),
+        ]
+        if len(batch) >= 2000:
+            store.add_messages(session_id, batch)
+            batch = []
+    if batch:
+        store.add_messages(session_id, batch)
+
+
+def run_requests(window, submit, count):
+    latencies, ttfts = [], []
+    for _ in range(count):
+        started_at = time.perf_counter()
+        request_id = submit()
+        first_token_at, finished_at = window.wait(request_id)
+        latencies.append(finished_at - started_at)
+        if first_token_at is not None:
+            ttfts.append(first_token_at - started_at)
+    return latencies, ttfts
+
+
+def bench_size(api, window, turns, args):
+    session_id = f"bench-{turns}"
+    seed_session(api._history_store, session_id, turns)
+    with api._state_lock:
+        api.session_id = session_id
+        chain = api.chain_with_history
+
+    # 预热一轮，建立连接
+    window.wait(api.process_input("warm-up"))
+    latencies, ttfts = run_requests(window, lambda: api.process_input("新的问题"), args.turns)
+    regen, _ = run_requests(window, api.regenerate_response, max(args.turns // 3, 1))
+
+    # 和 _run_turn 一样，历史预算要扣掉问题本身的 token 数
+    question_tokens = count_tokens("新的问题") + MESSAGE_TOKEN_OVERHEAD
+    loads = []
+    for _ in range(args.turns):
+        started_at = time.perf_counter()
+        chain.get_session_history(session_id, question_tokens).messages
+        loads.append(time.perf_counter() - started_at)
+    return latencies, ttfts, regen, loads, current_rss_mb()
+
+
+def bench_prompt_switch(api, rounds=20):
+    cold, warm = [], []
+    for i in range(rounds):
+        profile = "bench" if i % 2 == 0 else "default"
+        started_at = time.perf_counter()
+        api.set_prompt_profile(profile)
+        (cold if i < 2 else warm).append(time.perf_counter() - started_at)
+    return cold, warm
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000,10000", help="会话中已有的历史轮数，逗号分隔")
+    parser.add_argument("--turns", type=int, default=30, help="每种长度下发送的消息数")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--tokens-per-second", type=float, default=500)
+    parser.add_argument("--response-tokens", type=int, default=50)
+    parser.add_argument("--no-stream", action="store_true")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    server = FakeOpenAIServer(
+        latency=args.latency, tokens_per_second=args.tokens_per_second, response_tokens=args.response_tokens
+    ).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        write_config(tmp, server.base_url, not args.no_stream)
+        # main.py 按当前目录定位 secrets.json 和数据库，必须先切换目录再导入；
+        # pywebview 导入时会检查脚本所在目录，所以先把脚本路径转成绝对路径
+        sys.argv[0] = os.path.abspath(sys.argv[0])
+        os.chdir(tmp)
+        rss_before_import = current_rss_mb()
+        import main as app
+        logging.getLogger().setLevel(logging.WARNING)
+
+        api = app.api
+        window = RecordingWindow()
+        api._window = window
+        api.start_background_init()
+        api._ready.wait()
+        if not api.chain_with_history:
+            raise SystemExit("LLM failed to initialize against the fake server.")
+
+        print(f"fake server: latency {args.latency * 1000:.0f} ms, {args.tokens_per_second:.0f} tok/s, "
+              f"{args.response_tokens} tokens/answer, stream={not args.no_stream}")
+        print(f"rss before import {rss_before_import:.1f} MB, after init {current_rss_mb():.1f} MB")
+        print(f"{'history':>8} | {'turn p50/p95/p99 ms':^26} | {'ttft p50/p95/p99 ms':^26} | "
+              f"{'regen p50/p95/p99 ms':^26} | {'load p50/p95/p99 ms':^26} | rss MB")
+        for turns in sizes:
+            latencies, ttfts, regen, loads, rss = bench_size(api, window, turns, args)
+            ttft_column = describe(ttfts) if ttfts else f"{'n/a':^26}"
+            print(f"{turns:>8} | {describe(latencies)} | {ttft_column} | {describe(regen)} | "
+                  f"{describe(loads)} | {rss:6.1f}")
+
+        cold, warm = bench_prompt_switch(api)
+        print(f"set_prompt_profile: first build p50 {percentile(cold, 0.5) * 1000:.2f} ms, "
+              f"memoized p50 {percentile(warm, 0.5) * 1000:.2f} ms")
+        print(f"{server.request_count} requests served, {window.calls} evaluate_js calls recorded")
+
+        api._executor.shutdown()
+        api._history_store.close()
+        api._clients.close()
+        os.chdir(ROOT)
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
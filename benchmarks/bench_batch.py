@@ -0,0 +1,117 @@
+"""
+批处理模式（batch.BatchRunner）的离线基准测试，用本地的假 OpenAI 服务代替真实的服务商。
+
+- concurrency: 不同并发数下处理 --items 条输入的吞吐量
+- rate-limit:  开启 RPM 限流时实际的请求速率（为了缩短运行时间，限流窗口缩短为 5 秒）
+- errors:      服务端以 --error-rate 的概率返回 429 时，重试后的成功率和服务端实际收到的请求数
+- resume:      先处理一半的输入并在输出末尾留下半行（模拟进程被强行结束），再用完整的输入续跑，
+               检查跳过的条数以及最终输出是否完整、有序
+- retry:       不重试时按 --error-rate 留下一批失败的条目，再在服务恢复正常后续跑，
+               检查失败的条目是否被重新处理并替换掉原来的错误记录，输出仍按输入顺序排列
+
+用法: python benchmarks/bench_batch.py [--items 200] [--latency 0.2] [--error-rate 0.3]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_openai_server import FakeOpenAIServer
+from llm_clients import ClientRegistry
+from batch import BatchRunner, RateLimiter
+
+
+SYSTEM_PROMPT = "You are a translator. Translate the user's text into English."
+
+
+def write_input(path, count):
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(count):
+            f.write(json.dumps({"id": f"item-{i}", "input": f"第 {i} 段需要翻译的文字。"}, ensure_ascii=False) + "\n")
+
+
+def read_output(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def run(llm, input_path, output_path, limiter=None, **kwargs):
+    runner = BatchRunner(llm, SYSTEM_PROMPT, backoff_seconds=0.1, **kwargs)
+    if limiter:
+        runner.limiter = limiter
+    started_at = time.perf_counter()
+    stats = runner.run(input_path, output_path)
+    return stats, time.perf_counter() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.2, help="每个请求的服务端延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.3)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as tmp, FakeOpenAIServer(latency=args.latency, tokens_per_second=0) as server:
+        registry = ClientRegistry(max_retries=0)
+        llm = registry.get("bench-model", "sk-bench", server.base_url)
+        input_path = os.path.join(tmp, "input.jsonl")
+        write_input(input_path, args.items)
+
+        for concurrency in (1, 4, 16):
+            output_path = os.path.join(tmp, f"concurrency-{concurrency}.jsonl")
+            stats, elapsed = run(llm, input_path, output_path, concurrency=concurrency)
+            print(f"concurrency {concurrency:>2}: {stats['succeeded']} items in {elapsed:6.2f} s, "
+                  f"{stats['succeeded'] / elapsed * 60:7.0f} items/min")
+
+        rate_input = os.path.join(tmp, "rate-input.jsonl")
+        write_input(rate_input, 60)
+        limiter = RateLimiter(rpm=20, window=5.0)
+        stats, elapsed = run(llm, rate_input, os.path.join(tmp, "rate.jsonl"), limiter, concurrency=16)
+        print(f"rate-limit  : 60 items at 20 requests / 5 s window took {elapsed:.2f} s "
+              f"(expected >= 10 s, {60 / elapsed * 5:.1f} requests per window)")
+
+        server.error_rate = args.error_rate
+        before = server.request_count
+        stats, elapsed = run(llm, input_path, os.path.join(tmp, "errors.jsonl"), concurrency=8)
+        print(f"errors      : {stats['succeeded']}/{args.items} succeeded, {stats['failed']} failed with "
+              f"{args.error_rate:.0%} simulated 429s, {server.request_count - before} requests sent, {elapsed:.2f} s")
+        server.error_rate = 0.0
+
+        half_input = os.path.join(tmp, "half-input.jsonl")
+        write_input(half_input, args.items // 2)
+        resume_output = os.path.join(tmp, "resume.jsonl")
+        run(llm, half_input, resume_output, concurrency=8)
+        with open(resume_output, "a", encoding="utf-8") as f:
+            f.write('{"index": 999, "id": "trunc')
+        stats, elapsed = run(llm, input_path, resume_output, concurrency=8)
+        records = read_output(resume_output)
+        in_order = [r["index"] for r in records] == list(range(args.items))
+        print(f"resume      : skipped {stats['skipped']}, processed {stats['succeeded']}, "
+              f"{len(records)} records in output, complete and in input order: {in_order}")
+
+        retry_output = os.path.join(tmp, "retry.jsonl")
+        server.error_rate = args.error_rate
+        # 这一轮的失败是有意制造的，不打印每一条的错误日志
+        logging.disable(logging.ERROR)
+        run(llm, input_path, retry_output, concurrency=8, max_retries=0)
+        logging.disable(logging.NOTSET)
+        failed_before = sum("error" in r for r in read_output(retry_output))
+        server.error_rate = 0.0
+        stats, elapsed = run(llm, input_path, retry_output, concurrency=8)
+        records = read_output(retry_output)
+        in_order = [r["index"] for r in records] == list(range(args.items))
+        print(f"retry       : {failed_before} failed on the first run, skipped {stats['skipped']}, "
+              f"retried {stats['succeeded'] + stats['failed']}, {sum('error' in r for r in records)} errors left, "
+              f"complete and in input order: {in_order}")
+        registry.close()
+
+
+if __name__ == "__main__":
+    main()
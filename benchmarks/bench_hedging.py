@@ -0,0 +1,101 @@
+"""
+多接口对冲 / 故障转移基准测试，用两个本地的假 OpenAI 服务代替真实的服务商。
+
+三个场景，各自对比只用首选接口和使用 HedgedChatModel 时的首字延迟（TTFT）：
+- slow-spells: 首选接口有 --slow-rate 的概率首 token 延迟 --slow-latency 秒，备用接口始终正常
+- outage:      首选接口的端口上没有服务（连接被拒绝），备用接口正常
+- degraded:    首选接口持续比对冲延迟还慢，几轮之后应被降级，备用接口直接成为首选
+
+用法: python benchmarks/bench_hedging.py [--turns 40] [--hedge-delay 0.3] [--slow-rate 0.2] [--slow-latency 2]
+"""
+import argparse
+import logging
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_openai_server import FakeOpenAIServer
+from llm_clients import ClientRegistry
+from endpoint_router import HedgedChatModel
+
+
+def unused_base_url():
+    """找一个当前没有进程监听的本地端口，用来模拟宕机的接口。"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/v1"
+
+
+def first_token_latency(llm):
+    started_at = time.perf_counter()
+    stream = llm.stream("Reply with a short sentence.")
+    try:
+        for chunk in stream:
+            if chunk.content:
+                return time.perf_counter() - started_at
+    finally:
+        stream.close()
+    return time.perf_counter() - started_at
+
+
+def measure(llm, turns):
+    samples = []
+    for _ in range(turns):
+        try:
+            samples.append(first_token_latency(llm))
+        except Exception:
+            samples.append(float("inf"))
+    return samples
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def report(scenario, label, samples):
+    ms = [v * 1000 for v in samples]
+    failures = sum(1 for v in samples if v == float("inf"))
+    print(f"{scenario:<12} {label:<10} ttft p50 {percentile(ms, 0.5):8.1f} ms   p95 {percentile(ms, 0.95):8.1f} ms   "
+          f"p99 {percentile(ms, 0.99):8.1f} ms   failed {failures}/{len(samples)}")
+
+
+def run_scenario(name, primary_url, backup_url, args):
+    registry = ClientRegistry()
+    try:
+        primary = registry.get("bench-model", "sk-bench", primary_url)
+        backup = registry.get("bench-model", "sk-bench", backup_url)
+        hedged = HedgedChatModel([("primary", primary), ("backup", backup)], args.hedge_delay)
+        report(name, "single", measure(primary, args.turns))
+        report(name, "hedged", measure(hedged, args.turns))
+        order = " > ".join(hedged.endpoints[i][0] for i in hedged.ordered_endpoints())
+        print(f"{'':<12} endpoint order after run: {order}")
+    finally:
+        registry.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=40)
+    parser.add_argument("--hedge-delay", type=float, default=0.3, help="对冲延迟（秒）")
+    parser.add_argument("--latency", type=float, default=0.05, help="正常情况下的首 token 延迟（秒）")
+    parser.add_argument("--slow-rate", type=float, default=0.2)
+    parser.add_argument("--slow-latency", type=float, default=2.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with FakeOpenAIServer(latency=args.latency) as backup:
+        with FakeOpenAIServer(latency=args.latency, slow_rate=args.slow_rate, slow_latency=args.slow_latency) as primary:
+            run_scenario("slow-spells", primary.base_url, backup.base_url, args)
+        run_scenario("outage", unused_base_url(), backup.base_url, args)
+        with FakeOpenAIServer(latency=args.hedge_delay * 3) as primary:
+            run_scenario("degraded", primary.base_url, backup.base_url, args)
+
+
+if __name__ == "__main__":
+    main()
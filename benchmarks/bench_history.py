@@ -0,0 +1,202 @@
+"""
+聊天记录读写基准测试。
+
+在一个包含 10 万+ 条消息、数千个会话的数据库上，对比两种方式每轮对话的历史读取和追加耗时：
+- legacy: 旧实现的做法，每轮对话新建一个 engine，默认回滚日志，session_id 上没有索引
+- store:  ChatHistoryStore，进程内共享一个带连接池的 engine，WAL + 索引
+
+另外单独测量“重新生成”时修剪最后一轮问答的耗时，对比 2 轮和 2000 轮的会话，
+以及旧数据库第一次打开时建立全文索引的耗时、几类搜索的耗时，
+和恢复 50 / 500 / 5000 条消息的会话时分页读取第一页与一次读取整段会话的耗时和内存峰值。
+
+用法: python benchmarks/bench_history.py [--sessions 2500] [--messages-per-session 40] [--turns 300]
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, text
+from langchain_core.messages import AIMessage, HumanMessage, message_to_dict, messages_from_dict
+
+from history_store import ChatHistoryStore, SQLiteChatMessageHistory
+
+
+def make_rows(sessions, messages_per_session):
+    for s in range(sessions):
+        session_id = f"2024{s:010d}"
+        for i in range(messages_per_session):
+            if i % 2 == 0:
+                message = HumanMessage(content=f"问题 {i}: " + "这是一个用来测试的问题。" * 5)
+            else:
+                message = AIMessage(content=f"回答 {i}: " + "这是一段用来测试的回答内容。" * 20)
+            yield {"session_id": session_id, "message": json.dumps(message_to_dict(message), ensure_ascii=False)}
+
+
+def seed(path, sessions, messages_per_session, with_index):
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE message_store (id INTEGER PRIMARY KEY, session_id TEXT, message TEXT)"))
+        if with_index:
+            conn.execute(text("CREATE INDEX ix_message_store_session_id_id ON message_store (session_id, id)"))
+        conn.execute(
+            text("INSERT INTO message_store (session_id, message) VALUES (:session_id, :message)"),
+            list(make_rows(sessions, messages_per_session)),
+        )
+    engine.dispose()
+
+
+def legacy_turn(path, session_id, new_messages):
+    """模拟旧实现：每轮对话都创建新的 engine 和连接。"""
+    engine = create_engine(f"sqlite:///{path}")
+    t0 = time.perf_counter()
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text("SELECT message FROM message_store WHERE session_id = :session_id ORDER BY id"),
+            {"session_id": session_id},
+        ).fetchall()
+    messages_from_dict([json.loads(row[0]) for row in rows])
+    t1 = time.perf_counter()
+    with engine.begin() as conn:
+        conn.execute(
+            text("INSERT INTO message_store (session_id, message) VALUES (:session_id, :message)"),
+            [{"session_id": session_id, "message": json.dumps(message_to_dict(m))} for m in new_messages],
+        )
+    t2 = time.perf_counter()
+    engine.dispose()
+    return t1 - t0, t2 - t1
+
+
+def store_turn(store, session_id, new_messages):
+    history = SQLiteChatMessageHistory(store, session_id)
+    t0 = time.perf_counter()
+    history.messages
+    t1 = time.perf_counter()
+    history.add_messages(new_messages)
+    t2 = time.perf_counter()
+    return t1 - t0, t2 - t1
+
+
+def regenerate_cost(store, turns, repeat=50):
+    """模拟 regenerate_response 的历史修剪：找到最后一条人类消息并删除它及之后的消息，再写回新的一轮。"""
+    session_id = f"regenerate-{turns}"
+    messages = []
+    for i in range(turns):
+        messages += [HumanMessage(content=f"问题 {i}"), AIMessage(content="回答" * 100)]
+    store.add_messages(session_id, messages)
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        message_id, message = store.get_last_human_message(session_id)
+        store.truncate(session_id, message_id)
+        samples.append(time.perf_counter() - t0)
+        store.add_messages(session_id, [message, AIMessage(content="新的回答")])
+    return statistics.median(samples) * 1000
+
+
+def search_cost(store, query, repeat=20):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        results, _ = store.search(query)
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples) * 1000, len(results)
+
+
+def measure_peak(fn, repeat=10):
+    """返回 fn 的耗时中位数（毫秒）和一次调用期间 Python 分配的内存峰值（KB）。"""
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(samples) * 1000, peak / 1024
+
+
+def resume_cost(store, count):
+    """恢复一个有 count 条消息的会话：分页读取最近一页 + 向前翻一页，对比一次读取全部消息。"""
+    session_id = f"resume-{count}"
+    messages = []
+    for i in range(count // 2):
+        messages += [HumanMessage(content=f"问题 {i}"), AIMessage(content="回答" * 100)]
+    store.add_messages(session_id, messages)
+
+    def paged():
+        page, _ = store.get_page(session_id)
+        store.get_page(session_id, page[0][0])
+
+    return measure_peak(paged), measure_peak(lambda: store.get_messages(session_id))
+
+
+def summarize(name, samples):
+    load = sorted(s[0] * 1000 for s in samples)
+    append = sorted(s[1] * 1000 for s in samples)
+    p95 = lambda values: values[int(len(values) * 0.95) - 1]
+    print(f"{name:<8} load  p50 {statistics.median(load):8.2f} ms   p95 {p95(load):8.2f} ms")
+    print(f"{name:<8} append p50 {statistics.median(append):8.2f} ms   p95 {p95(append):8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=2500)
+    parser.add_argument("--messages-per-session", type=int, default=40)
+    parser.add_argument("--turns", type=int, default=300)
+    args = parser.parse_args()
+
+    total = args.sessions * args.messages_per_session
+    new_messages = [HumanMessage(content="新的问题"), AIMessage(content="新的回答" * 50)]
+    random.seed(0)
+    session_ids = [f"2024{random.randrange(args.sessions):010d}" for _ in range(args.turns)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        store_path = os.path.join(tmp, "store.db")
+        print(f"Seeding {total} messages across {args.sessions} sessions...")
+        seed(legacy_path, args.sessions, args.messages_per_session, with_index=False)
+        seed(store_path, args.sessions, args.messages_per_session, with_index=True)
+
+        legacy_samples = [legacy_turn(legacy_path, sid, new_messages) for sid in session_ids]
+
+        t0 = time.perf_counter()
+        store = ChatHistoryStore(store_path)
+        migrate_cost = time.perf_counter() - t0
+        store_samples = [store_turn(store, sid, new_messages) for sid in session_ids]
+        regenerate = {turns: regenerate_cost(store, turns) for turns in (2, 2000)}
+        # 埋几条只出现一次的消息，对比命中很少和命中很多的查询
+        store.add_messages("needle", [HumanMessage(content="关于 zebrafish 胚胎发育的问题"), AIMessage(content="斑马鱼的回答")])
+        searches = {
+            "rare word": search_cost(store, "zebrafish"),
+            "rare prefix": search_cost(store, "zebra"),
+            "rare 2-char cjk": search_cost(store, "斑马"),
+            "broad cjk phrase": search_cost(store, "回答内容"),
+            "broad 2-char cjk": search_cost(store, "测试"),
+        }
+        resume = {count: resume_cost(store, count) for count in (50, 500, 5000)}
+        store.close()
+
+    print(f"{args.turns} turns, {args.messages_per_session} messages per session")
+    summarize("legacy", legacy_samples)
+    summarize("store", store_samples)
+    for turns, cost in regenerate.items():
+        print(f"regenerate trim on {turns:>4}-turn session: p50 {cost:.2f} ms")
+    print(f"first open of legacy db (migration + search index build): {migrate_cost:.2f} s")
+    for name, (cost, hits) in searches.items():
+        print(f"search {name:<20} p50 {cost:8.2f} ms ({hits} hits on first page)")
+    for count, ((paged_ms, paged_kb), (full_ms, full_kb)) in resume.items():
+        print(f"resume {count:>5}-message session: two pages {paged_ms:7.2f} ms / {paged_kb:8.0f} KB peak, "
+              f"all messages {full_ms:7.2f} ms / {full_kb:8.0f} KB peak")
+
+
+if __name__ == "__main__":
+    main()
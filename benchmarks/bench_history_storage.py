@@ -0,0 +1,138 @@
+"""
+聊天记录存储维护（压缩、保留策略、增量 VACUUM）的基准测试。
+
+1. 用旧格式（message 列全是未压缩的 JSON 文本、没有增量 auto_vacuum）写入 --sessions 个会话，
+   回答长短混合，其中一部分是几 KB 的长回答（代码、长文）
+2. 测量数据库大小，以及读取历史窗口（get_window）和第一页（get_page）的耗时
+3. 执行一次 maintain()：补压缩大消息，并转换为增量 auto_vacuum，再测一遍大小和读取耗时
+4. 模拟“重新生成”反复删改最后一轮造成的碎片，以及按 --max-sessions 执行保留策略，
+   对比增量 VACUUM 前后的文件大小
+
+用法: python benchmarks/bench_history_storage.py [--sessions 1000] [--messages-per-session 40] [--max-sessions 200]
+"""
+import argparse
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from history_store import ChatHistoryStore
+
+
+WORDS = (
+    "模型 回答 代码 函数 数据 参数 请求 返回 问题 解释 因为 所以 然后 如果 需要 可以 使用 通过 实现 处理 "
+    "the a of to and in for with request response model value list result error config cache token stream"
+).split()
+CODE_LINES = [
+    "def handler(request):", "    result = process(request.payload)", "    return {'status': 'ok', 'data': result}",
+    "for item in items:", "    total += item.price * item.count", "if not user.is_active:", "    raise PermissionError()",
+    "logging.info(f'processed {len(rows)} rows')", "with open(path, encoding='utf-8') as f:", "    lines = f.readlines()",
+]
+
+
+def make_text(rng, words):
+    """随机拼出来的文字，压缩率接近真实的聊天内容，而不是重复同一句话。"""
+    return " ".join(rng.choice(WORDS) + (str(rng.randint(0, 999)) if rng.random() < 0.1 else "") for _ in range(words))
+
+
+def make_answer(rng):
+    """大多数回答在 1 KB 以下，约三分之一是 2~12 KB 的长回答（长文加代码）。"""
+    if rng.random() < 0.35:
+        code = "\n".join(rng.choice(CODE_LINES) for _ in range(rng.randint(10, 80)))
+        return make_text(rng, rng.randint(200, 1000)) + "\n```python\n" + code + "\n```"
+    return make_text(rng, rng.randint(20, 150))
+
+
+def seed(store, sessions, messages_per_session):
+    rng = random.Random(42)
+    for s in range(sessions):
+        messages = []
+        for i in range(messages_per_session // 2):
+            messages.append(HumanMessage(content=f"问题 {i}: " + make_text(rng, rng.randint(5, 40))))
+            messages.append(AIMessage(content=make_answer(rng)))
+        store.add_messages(f"2024{s:010d}", messages, "default")
+
+
+def read_latency(store, session_ids, repeat=200):
+    window, page = [], []
+    for i in range(repeat):
+        session_id = session_ids[i % len(session_ids)]
+        started_at = time.perf_counter()
+        store.get_window(session_id, max_tokens=4000, max_turns=20)
+        window.append((time.perf_counter() - started_at) * 1000)
+        started_at = time.perf_counter()
+        store.get_page(session_id, limit=50)
+        page.append((time.perf_counter() - started_at) * 1000)
+    return statistics.median(window), statistics.median(page)
+
+
+def report(name, store, session_ids):
+    """先把 WAL 合并回数据库文件，文件大小才有可比性；message 列的总字节数单独列出。"""
+    with store.engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        payload = conn.exec_driver_sql("SELECT SUM(LENGTH(CAST(message AS BLOB))) FROM message_store").scalar()
+        free = conn.exec_driver_sql("PRAGMA freelist_count").scalar() * conn.exec_driver_sql("PRAGMA page_size").scalar()
+    window_ms, page_ms = read_latency(store, session_ids)
+    mb = lambda size: size / 1024 / 1024
+    print(f"{name:<24} file {mb(store.file_size()):6.1f} MB (free {mb(free):5.1f} MB, messages {mb(payload):5.1f} MB)   "
+          f"get_window p50 {window_ms:5.2f} ms   get_page p50 {page_ms:5.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--messages-per-session", type=int, default=40)
+    parser.add_argument("--max-sessions", type=int, default=200)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "chat_history.db")
+        # 先用 compress_min_bytes=0 按旧格式写入，再把数据库伪装成旧版本（没有增量 auto_vacuum）
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA auto_vacuum = NONE")
+        conn.execute("CREATE TABLE placeholder (id INTEGER)")
+        conn.commit()
+        conn.close()
+        store = ChatHistoryStore(path, compress_min_bytes=0)
+        started_at = time.perf_counter()
+        seed(store, args.sessions, args.messages_per_session)
+        store.close()
+        print(f"seeded {args.sessions * args.messages_per_session} messages in {args.sessions} sessions "
+              f"({time.perf_counter() - started_at:.1f} s)")
+
+        store = ChatHistoryStore(path)
+        session_ids = [f"2024{s:010d}" for s in range(0, args.sessions, max(args.sessions // 50, 1))]
+        with store.engine.begin() as c:
+            c.exec_driver_sql("PRAGMA user_version = 0")
+        report("uncompressed", store, session_ids)
+
+        stats = store.maintain()
+        print(f"maintain: compressed {stats['compressed_messages']} messages in place")
+        report("compressed", store, session_ids)
+
+        # 重新生成：反复删掉最后一轮再写入新的回答
+        rng = random.Random(7)
+        for session_id in session_ids * 10:
+            last = store.get_last_human_message(session_id)
+            store.truncate(session_id, last[0])
+            store.add_messages(session_id, [last[1], AIMessage(content=make_answer(rng))])
+        store.apply_retention(max_sessions=args.max_sessions, keep=session_ids)
+        report(f"retention {args.max_sessions} sessions", store, session_ids)
+        started_at = time.perf_counter()
+        reclaimed = store.reclaim_space()
+        print(f"incremental vacuum: reclaimed {reclaimed} pages in {time.perf_counter() - started_at:.2f} s")
+        report("after vacuum", store, session_ids)
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
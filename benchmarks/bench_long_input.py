@@ -0,0 +1,92 @@
+"""
+长文本分段并行处理（long_input.LongInputProcessor）的离线基准测试，用本地的假 OpenAI 服务代替真实的服务商。
+
+假设处理一篇长文本（例如翻译一篇论文）时，输出长度和输入长度成正比：
+- single:   整篇文本作为一个请求发送，服务端一次输出 段数 * --tokens-per-chunk 个 token
+- parallel: 切成若干段后按不同的并发数处理，每段输出 --tokens-per-chunk 个 token
+分别统计首字延迟（第一个片段到达的时间）和总耗时。
+
+用法: python benchmarks/bench_long_input.py [--sections 12] [--tokens-per-chunk 100] [--tokens-per-second 50]
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from fake_openai_server import FakeOpenAIServer
+from llm_clients import ClientRegistry
+from long_input import LongInputProcessor, split_into_chunks
+
+
+SYSTEM_PROMPT = "You are a translator. Translate the user's text into English."
+CHUNK_TOKENS = 1500
+
+
+def make_document(sections):
+    """生成一篇带标题的长文本，每节约 1000 token。"""
+    parts = []
+    for i in range(sections):
+        parts.append(f"## 第 {i + 1} 节")
+        for _ in range(4):
+            parts.append("这是一段需要翻译的长文本，用于测试分段并行处理的效果。" * 8)
+    return "\n\n".join(parts)
+
+
+def timed(stream):
+    started_at = time.perf_counter()
+    first_at = None
+    chars = 0
+    for delta in stream:
+        if first_at is None:
+            first_at = time.perf_counter()
+        chars += len(delta)
+    return first_at - started_at, time.perf_counter() - started_at, chars
+
+
+def single_request(llm, text):
+    messages = [SystemMessage(content=SYSTEM_PROMPT), HumanMessage(content=text)]
+    for chunk in llm.stream(messages):
+        if chunk.content:
+            yield chunk.content
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sections", type=int, default=12)
+    parser.add_argument("--tokens-per-chunk", type=int, default=100, help="每段的回答包含多少个 token")
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--latency", type=float, default=0.5, help="每个请求的首 token 延迟（秒）")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    text = make_document(args.sections)
+    chunk_count = len(split_into_chunks(text, CHUNK_TOKENS))
+    print(f"document: {len(text)} characters, {chunk_count} chunks of <= {CHUNK_TOKENS} tokens")
+
+    with FakeOpenAIServer(latency=args.latency, tokens_per_second=args.tokens_per_second) as server:
+        registry = ClientRegistry()
+        llm = registry.get("bench-model", "sk-bench", server.base_url)
+
+        server.response_tokens = args.tokens_per_chunk * chunk_count
+        first, total, chars = timed(single_request(llm, text))
+        print(f"single       : first output {first * 1000:7.0f} ms, total {total:6.2f} s, {chars} characters")
+
+        server.response_tokens = args.tokens_per_chunk
+        for concurrency in (1, 4, 8):
+            processor = LongInputProcessor(llm, SYSTEM_PROMPT, chunk_tokens=CHUNK_TOKENS, concurrency=concurrency)
+            processor.split(text)
+            first, total, chars = timed(processor.stream(threading.Event()))
+            print(f"parallel x{concurrency:<2}  : first output {first * 1000:7.0f} ms, total {total:6.2f} s, "
+                  f"{chars} characters")
+        registry.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+连接预热基准测试。
+
+模拟“长时间空闲后用快捷键唤出窗口 -> 用户打字 -> 发送第一条消息”的场景，对比开启和关闭预热时：
+- hotkey-to-visible: 唤出窗口时预热给显示路径额外增加的同步耗时（预热本身在后台线程中进行）
+- idle-to-first-token: 空闲后第一条消息的首字延迟
+
+每一轮都新建 ClientRegistry，相当于空闲超过 keep-alive 时间后连接池已经空了。
+默认从 secrets.json 读取模型和接口地址，也可以用参数指定（例如指向本地的假服务）。
+
+用法: python benchmarks/bench_prewarm.py [--rounds 5] [--think-time 1.5] [--base-url URL --api-key KEY --model NAME]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_clients import ClientRegistry
+
+
+def first_token_latency(registry, model_name, api_key, base_url):
+    llm = registry.get(model_name, api_key, base_url)
+    started_at = time.perf_counter()
+    for chunk in llm.stream("Reply with the single word: ok"):
+        if chunk.content:
+            return time.perf_counter() - started_at
+    return time.perf_counter() - started_at
+
+
+def run_round(args, prewarm):
+    registry = ClientRegistry()
+    try:
+        show_started_at = time.perf_counter()
+        if prewarm:
+            # 与 Api.prewarm_connection 相同：只是启动一个后台线程
+            threading.Thread(
+                target=registry.warm_up, args=(args.model, args.api_key, args.base_url), daemon=True
+            ).start()
+        show_cost = time.perf_counter() - show_started_at
+        # 用户看到窗口后开始打字
+        time.sleep(args.think_time)
+        return show_cost, first_token_latency(registry, args.model, args.api_key, args.base_url)
+    finally:
+        registry.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--think-time", type=float, default=1.5, help="唤出窗口到发送消息之间的时间（秒）")
+    parser.add_argument("--base-url")
+    parser.add_argument("--api-key")
+    parser.add_argument("--model")
+    args = parser.parse_args()
+
+    if not (args.base_url and args.api_key and args.model):
+        with open("secrets.json", "r", encoding="utf-8") as f:
+            settings = json.load(f)
+        args.base_url = args.base_url or settings.get("base_url")
+        args.api_key = args.api_key or settings.get("api_key")
+        args.model = args.model or settings.get("model_name")
+
+    for prewarm in (False, True):
+        samples = [run_round(args, prewarm) for _ in range(args.rounds)]
+        show = statistics.median(s[0] for s in samples) * 1000
+        ttft = statistics.median(s[1] for s in samples) * 1000
+        label = "with pre-warm" if prewarm else "no pre-warm"
+        print(f"{label:<14} hotkey-to-visible overhead p50 {show:7.3f} ms   idle-to-first-token p50 {ttft:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+本地的假 OpenAI 兼容服务，只实现 /chat/completions（流式和非流式），用于离线基准测试。
+
+- latency:           收到请求到返回第一个 token 之间的延迟（秒）
+- tokens_per_second: 之后每秒输出多少个 token
+- response_tokens:   每个回答包含多少个 token
+- stream:            为 False 时忽略请求里的 stream 参数，总是一次性返回完整回答
+- slow_rate / slow_latency: 以 slow_rate 的概率把首 token 延迟换成 slow_latency，模拟服务商偶尔变慢
+- error_rate:        以这个概率直接返回 429（带 Retry-After），模拟限流
+
+这些参数都是 FakeOpenAIServer 实例上的普通属性，运行中修改会对之后的请求生效。
+也可以单独运行，把 secrets.json 的 base_url 指向它来手动测试应用：
+
+用法: python benchmarks/fake_openai_server.py [--port 8765] [--latency 0.3] [--tokens-per-second 50]
+然后把 base_url 设为 http://127.0.0.1:8765/v1，api_key 随便填一个非空值。
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+WORDS = ["这是", "一段", "用于", "基准", "测试", "的", "模拟", "回答", "，", "内容", "没有", "意义", "。"]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        # 连接预热发的是 HEAD 请求，状态码无关紧要
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        fake = self.server.fake
+        fake.request_count += 1
+        if random.random() < fake.error_rate:
+            fake.error_count += 1
+            self._send_json(429, {"error": {"message": "Rate limit reached (simulated)", "type": "rate_limit"}},
+                            {"Retry-After": str(fake.retry_after)})
+            return
+        model = body.get("model", "fake-model")
+        prompt_tokens = sum(len(str(m.get("content", ""))) // 4 + 4 for m in body.get("messages", []))
+        tokens = [WORDS[i % len(WORDS)] for i in range(fake.response_tokens)]
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+        }
+
+        time.sleep(fake.slow_latency if random.random() < fake.slow_rate else fake.latency)
+        if fake.stream and body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+            self._stream(model, tokens, usage if include_usage else None, fake.tokens_per_second)
+        else:
+            if fake.tokens_per_second:
+                time.sleep(len(tokens) / fake.tokens_per_second)
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, model, tokens, usage, tokens_per_second):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def send_event(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(delta, finish_reason=None, **extra):
+            return json.dumps({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                **extra,
+            }, ensure_ascii=False)
+
+        interval = 1 / tokens_per_second if tokens_per_second else 0
+        try:
+            send_event(chunk({"role": "assistant", "content": ""}))
+            for i, token in enumerate(tokens):
+                if interval and i:
+                    time.sleep(interval)
+                send_event(chunk({"content": token}))
+            send_event(chunk({}, "stop"))
+            if usage:
+                send_event(json.dumps({
+                    "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": model, "choices": [], "usage": usage,
+                }))
+            send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端取消了请求
+            self.close_connection = True
+
+
+class FakeOpenAIServer:
+    """在后台线程中运行的假服务。port=0 表示由系统分配一个空闲端口。"""
+    def __init__(self, host="127.0.0.1", port=0, latency=0.05, tokens_per_second=200, response_tokens=50, stream=True,
+                 slow_rate=0.0, slow_latency=2.0, error_rate=0.0, retry_after=0.1):
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.stream = stream
+        self.request_count = 0
+        self.error_count = 0
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--response-tokens", type=int, default=200)
+    parser.add_argument("--no-stream", action="store_true")
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        args.host, args.port, args.latency, args.tokens_per_second, args.response_tokens, not args.no_stream
+    )
+    print(f"Fake OpenAI-compatible server listening on {server.base_url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+
+
+if __name__ == "__main__":
+    main()
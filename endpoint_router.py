@@ -0,0 +1,206 @@
+import contextvars
+import logging
+import queue
+import threading
+import time
+
+from langchain_core.runnables import Runnable
+
+
+# 滑动平均（EWMA）的权重：新样本占 30%
+EWMA_ALPHA = 0.3
+# 错误率的滑动平均超过这个值就降级（连续失败两次即可触发）
+ERROR_DEMOTE_THRESHOLD = 0.5
+# 超过这么久没有新样本的接口，统计会被清空，重新按配置顺序参与排序
+RECOVERY_SECONDS = 300
+
+
+class EndpointStats:
+    """一个接口的首字节耗时和错误率的滑动平均。"""
+    def __init__(self):
+        self.ttfb = None
+        self.error_rate = 0.0
+        self.updated_at = None
+
+    def _expire(self, now):
+        if self.updated_at is not None and now - self.updated_at > RECOVERY_SECONDS:
+            self.ttfb = None
+            self.error_rate = 0.0
+            self.updated_at = None
+
+    def record(self, ttfb=None, error=False):
+        now = time.monotonic()
+        self._expire(now)
+        self.error_rate = EWMA_ALPHA * (1.0 if error else 0.0) + (1 - EWMA_ALPHA) * self.error_rate
+        if ttfb is not None:
+            self.ttfb = ttfb if self.ttfb is None else EWMA_ALPHA * ttfb + (1 - EWMA_ALPHA) * self.ttfb
+        self.updated_at = now
+
+    def is_demoted(self, hedge_delay):
+        """
+        错误率过高，或者平均首字节耗时超过了对冲延迟（也就是说几乎每次都要靠对冲请求兜底）时降级。
+        """
+        self._expire(time.monotonic())
+        if self.error_rate > ERROR_DEMOTE_THRESHOLD:
+            return True
+        return bool(hedge_delay) and self.ttfb is not None and self.ttfb > hedge_delay
+
+
+class _Attempt:
+    def __init__(self, index, label):
+        self.index = index
+        self.label = label
+        self.cancelled = threading.Event()
+        self.finished = False
+
+
+class HedgedChatModel(Runnable):
+    """
+    包在多个 ChatOpenAI 外面的路由层，用法与原来的 llm 相同：prompt | HedgedChatModel(...)。
+    endpoints 是按优先级排列的 [(label, llm), ...]。
+
+    - 对冲：首选接口在 hedge_delay 秒内没有返回任何数据时，向下一个接口发送一份相同的请求，
+      谁先返回第一个 chunk 就用谁的回答，另一个请求被取消（在它返回第一个 chunk 或读取超时时关闭 HTTP 流）
+    - 故障转移：请求在返回任何数据之前出错，立即改用下一个接口
+    - 降级：按 EndpointStats 的滑动平均，把错误率高或者明显偏慢的接口排到后面
+    回答开始输出之后出现的错误不会再切换接口，而是照常抛出。hedge_delay 为 0 时只做故障转移。
+    非流式调用（invoke）看不到首字节，只做故障转移，不发对冲请求，也不计入首字节耗时。
+
+    输掉的请求如果一直没有返回数据，它的线程会阻塞在读取上，没法从外面关掉，
+    所以流式调用的每个请求都带上 attempt_timeout 秒的读取超时（两次收到数据之间的最长间隔）：
+    失联的接口最多占用一个连接这么久，超时也会计入错误率并触发故障转移。为 0 时沿用客户端的默认超时。
+    """
+    def __init__(self, endpoints, hedge_delay=1.5, attempt_timeout=60):
+        self.endpoints = endpoints
+        self.hedge_delay = hedge_delay
+        self.attempt_timeout = attempt_timeout
+        self.stats = [EndpointStats() for _ in endpoints]
+        self._lock = threading.Lock()
+        self._last_order = list(range(len(endpoints)))
+
+    def ordered_endpoints(self):
+        """当前的尝试顺序：未降级的接口在前，同一组内保持配置顺序。"""
+        with self._lock:
+            order = sorted(range(len(self.endpoints)), key=lambda i: (self.stats[i].is_demoted(self.hedge_delay), i))
+            if order != self._last_order:
+                labels = " > ".join(self.endpoints[i][0] for i in order)
+                logging.info(f"Endpoint order changed: {labels}")
+                self._last_order = order
+        return order
+
+    def _record(self, index, ttfb=None, error=False):
+        with self._lock:
+            self.stats[index].record(ttfb, error)
+
+    def _run_attempt(self, attempt, make_stream, streaming, events):
+        """在后台线程中运行一次请求，把 chunk / 结束 / 错误事件放进 events 队列。"""
+        llm = self.endpoints[attempt.index][1]
+        started_at = time.perf_counter()
+        first_chunk = True
+        stream = make_stream(llm)
+        try:
+            for chunk in stream:
+                if first_chunk:
+                    first_chunk = False
+                    self._record(attempt.index, ttfb=time.perf_counter() - started_at if streaming else None)
+                if attempt.cancelled.is_set():
+                    return
+                events.put((attempt, "chunk", chunk))
+            events.put((attempt, "done", None))
+        except Exception as e:
+            # 被取消的请求只会在两个 chunk 之间停下，这里捕获到的都是真正的错误（例如连接失败），
+            # 即使它已经输给了别的接口也要计入错误率，否则宕机的接口永远不会被降级
+            self._record(attempt.index, error=True)
+            if not attempt.cancelled.is_set():
+                events.put((attempt, "error", e))
+        finally:
+            stream.close()
+
+    def _race(self, make_stream, streaming=True):
+        """
+        按顺序尝试各个接口，产出胜出者的所有 chunk。
+        make_stream(llm) 返回一个生成器，第一次迭代时才真正发出请求。
+        """
+        hedge_delay = self.hedge_delay if streaming else 0
+        order = self.ordered_endpoints()
+        events = queue.Queue()
+        attempts = []
+        launched_at = 0.0
+
+        def launch():
+            nonlocal launched_at
+            index = order[len(attempts)]
+            attempt = _Attempt(index, self.endpoints[index][0])
+            attempts.append(attempt)
+            launched_at = time.monotonic()
+            # 复制当前的 contextvars，LangChain 的回调和追踪上下文在后台线程中同样有效
+            context = contextvars.copy_context()
+            threading.Thread(
+                target=context.run, args=(self._run_attempt, attempt, make_stream, streaming, events),
+                name=f"llm-{attempt.label}", daemon=True,
+            ).start()
+
+        launch()
+        winner = None
+        try:
+            while True:
+                live = [a for a in attempts if not a.finished]
+                # 只对冲一份：同时最多两个请求在路上；出错后的故障转移不受这个限制
+                can_hedge = winner is None and hedge_delay and len(live) < 2 and len(attempts) < len(order)
+                timeout = max(launched_at + hedge_delay - time.monotonic(), 0) if can_hedge else None
+                try:
+                    attempt, kind, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    logging.info(
+                        f"No response from '{attempts[-1].label}' after {hedge_delay * 1000:.0f} ms, "
+                        f"sending hedged request to '{self.endpoints[order[len(attempts)]][0]}'."
+                    )
+                    launch()
+                    continue
+
+                if winner is not None and attempt is not winner:
+                    continue
+                if kind == "chunk":
+                    if winner is None:
+                        winner = attempt
+                        for other in attempts:
+                            if other is not attempt:
+                                other.cancelled.set()
+                        if attempt is not attempts[0]:
+                            logging.info(f"Answer taken from '{attempt.label}' instead of '{attempts[0].label}'.")
+                    yield payload
+                elif kind == "done":
+                    attempt.finished = True
+                    if winner is None:
+                        # 没有任何 chunk 的空回答，也算这个接口胜出
+                        winner = attempt
+                    return
+                else:
+                    attempt.finished = True
+                    if winner is not None:
+                        raise payload
+                    logging.warning(f"Request to '{attempt.label}' failed: {payload}")
+                    if len(attempts) < len(order):
+                        logging.info(f"Failing over to '{self.endpoints[order[len(attempts)]][0]}'.")
+                        launch()
+                    elif all(a.finished for a in attempts):
+                        raise payload
+        finally:
+            # 调用方提前关闭生成器（例如用户点击了停止生成）时，也要取消所有进行中的请求
+            for attempt in attempts:
+                attempt.cancelled.set()
+
+    def invoke(self, input, config=None, **kwargs):
+        def make_stream(llm):
+            yield llm.invoke(input, config, **kwargs)
+
+        results = self._race(make_stream, streaming=False)
+        try:
+            return next(results)
+        finally:
+            results.close()
+
+    def stream(self, input, config=None, **kwargs):
+        if self.attempt_timeout:
+            kwargs.setdefault("timeout", self.attempt_timeout)
+        yield from self._race(lambda llm: llm.stream(input, config, **kwargs))
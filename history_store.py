@@ -0,0 +1,839 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import QueuePool
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import message_chunk_to_message, message_to_dict, messages_from_dict
+
+
+# 每个新建的连接都会执行这些 PRAGMA
+# - WAL: 读写互不阻塞，追加消息时只写 WAL 文件，不用每次都重写回滚日志
+# - synchronous=NORMAL: WAL 模式下足够安全，断电最多丢失最后一次提交
+# - cache_size 为负数时单位是 KiB，这里给每个连接 8 MB 页缓存
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-8192",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+# message 列序列化后超过这么多字节时用 zlib 压缩，以 BLOB 存储；读取时按值的类型自动解压。
+# 短消息压缩收益很小，仍以 JSON 文本存储
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 6
+# PRAGMA user_version 记录存储格式：1 表示所有大消息都已压缩，旧数据库在后台维护时补压缩后升级
+STORAGE_FORMAT_VERSION = 1
+# 后台维护时每批处理的消息数，以及增量 VACUUM 每一步归还的页数；每一步之间检查是否需要停下
+MAINTENANCE_BATCH_SIZE = 500
+VACUUM_PAGES_PER_STEP = 256
+# 旧数据库转换为增量 auto_vacuum 需要一次完整的 VACUUM，期间一直持有写锁（前台写入最多只等 busy_timeout）；
+# 只有空闲页至少占这个比例、且不少于这么多页时才值得做
+VACUUM_CONVERT_MIN_FREE_RATIO = 0.2
+VACUUM_CONVERT_MIN_FREE_PAGES = 1024
+
+
+# OpenAI 聊天格式里每条消息除了内容之外还有几个固定开销的 token（角色、分隔符）
+MESSAGE_TOKEN_OVERHEAD = 4
+# 最近一轮本身就超出历史预算时，截断后保留，并在被截断的消息末尾加上这个标记
+TRUNCATED_MARKER = "\n\n[内容过长，已截断]"
+
+_encoding = None
+_encoding_lock = threading.Lock()
+_encoding_loaded = False
+
+
+def _get_encoding():
+    """
+    懒加载 tiktoken 编码器，只尝试一次。
+    tiktoken 首次使用时需要联网下载词表，离线或加载失败时退回到估算。
+    """
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        if not _encoding_loaded:
+            _encoding_loaded = True
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                logging.warning(f"tiktoken unavailable, falling back to estimated token counts: {e}")
+        return _encoding
+
+
+def count_tokens(content):
+    """计算一段文本的 token 数。非字符串内容（例如多模态消息）按其 JSON 形式计算。"""
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False)
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(content, disallowed_special=()))
+    # 估算：中日韩等宽字符大约每个字 1 个 token，其余字符大约每 4 个字符 1 个 token
+    wide = sum(1 for ch in content if ord(ch) >= 0x2E80)
+    return wide + (len(content) - wide + 3) // 4
+
+
+def count_message_tokens(message):
+    return count_tokens(message.content) + MESSAGE_TOKEN_OVERHEAD
+
+
+def truncate_to_tokens(content, max_tokens):
+    """截取文本开头不超过 max_tokens 个 token 的部分。没有 tiktoken 时按估算值二分查找截断位置。"""
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(content, disallowed_special=())
+        return content if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    low, high = 0, len(content)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(content[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return content[:low]
+
+
+def _fit_messages(messages, max_tokens):
+    """
+    把最近的一轮对话截断到 max_tokens 以内：预算平均分给各条消息，短的消息完整保留，
+    省下的额度留给更长的消息；被截断的文本消息末尾加上 TRUNCATED_MARKER。返回新的消息列表。
+    预算连每条消息的固定开销、截断标记和一点正文都放不下时（例如问题本身就占满了预算），返回空列表。
+    """
+    sizes = [count_message_tokens(message) for message in messages]
+    budgets = [0] * len(messages)
+    remaining = max_tokens
+    order = sorted(range(len(messages)), key=lambda i: sizes[i])
+    for n, i in enumerate(order):
+        budgets[i] = min(sizes[i], remaining // (len(order) - n))
+        remaining -= budgets[i]
+
+    marker_tokens = count_tokens(TRUNCATED_MARKER)
+    fitted = []
+    for message, size, budget in zip(messages, sizes, budgets):
+        if size <= budget:
+            fitted.append(message)
+            continue
+        content = None
+        if isinstance(message.content, str):
+            content = truncate_to_tokens(message.content, budget - MESSAGE_TOKEN_OVERHEAD - marker_tokens)
+        if not content:
+            # 多模态消息没法截断，或者截断后只剩下标记
+            return []
+        fitted.append(message.model_copy(update={"content": content + TRUNCATED_MARKER}))
+    if sum(count_message_tokens(message) for message in fitted) > max_tokens:
+        return []
+    return fitted
+
+
+# 搜索结果摘要中命中部分的标记，前端先转义 HTML 再把它们替换成 <mark>，避免消息内容被当作 HTML 执行
+HIGHLIGHT_START = "\u0002"
+HIGHLIGHT_END = "\u0003"
+# 会话标题取第一条人类消息的前若干个字符
+SESSION_TITLE_CHARS = 60
+
+
+def message_text(content):
+    """消息内容的纯文本，用于全文索引和会话标题。多模态消息只取其中的文本部分。"""
+    if isinstance(content, str):
+        return content
+    return "\n".join(
+        part.get("text", "") if isinstance(part, dict) else str(part)
+        for part in content
+    )
+
+
+def _dump_payload(message, compress_min_bytes=COMPRESS_MIN_BYTES):
+    """序列化一条消息，写入 message 列：超过 compress_min_bytes（0 表示不压缩）时返回压缩后的 bytes。"""
+    payload = json.dumps(message_to_dict(message), ensure_ascii=False)
+    if compress_min_bytes:
+        encoded = payload.encode("utf-8")
+        if len(encoded) >= compress_min_bytes:
+            return zlib.compress(encoded, COMPRESS_LEVEL)
+    return payload
+
+
+def _load_payload(payload):
+    """message 列的值还原成消息字典：BLOB 是压缩过的 JSON，TEXT 是原始 JSON。"""
+    if isinstance(payload, bytes):
+        # 先解码成 str 再交给 json.loads，比直接传 bytes（需要先探测编码）快
+        payload = zlib.decompress(payload).decode("utf-8")
+    return json.loads(payload)
+
+
+def _load_messages(payloads):
+    return messages_from_dict([_load_payload(payload) for payload in payloads])
+
+
+def _payload_text(payload):
+    """直接从 message 列的 JSON 中取出纯文本，迁移和重建索引时不用构造消息对象。"""
+    return message_text(_load_payload(payload).get("data", {}).get("content", ""))
+
+
+def _session_created_at(session_id):
+    """会话 ID 是 %Y%m%d%H%M%S 格式的时间字符串，旧数据迁移时用它推算会话的创建时间。"""
+    try:
+        return time.mktime(time.strptime(session_id, "%Y%m%d%H%M%S"))
+    except (TypeError, ValueError):
+        return time.time()
+
+
+# 中日韩文字之间没有空格，unicode61 分词器会把一整段连续的汉字当成一个词。
+# 写入全文索引前在每个这类字符两边插入零宽空格（unicode61 把它当作分隔符），让每个字成为一个词；
+# 查询时同样处理，再按短语匹配（要求各个字相邻），任意长度的中文词都能走索引。
+# 用零宽空格而不是普通空格，生成摘要时去掉它就能还原原文。
+CJK_RUN_PATTERN = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff]+")
+FTS_SEPARATOR = "\u200b"
+# 命中的消息不超过这么多条时按相关度（bm25）排序，否则按时间倒序。
+# bm25 需要统计每个短语在全部消息中的命中数，常见词（几万条命中）每次查询要多花几十毫秒。
+SEARCH_RANK_LIMIT = 1000
+
+
+def _fts_text(text):
+    # 按连续的一段处理而不是逐字替换，长消息上快得多
+    return CJK_RUN_PATTERN.sub(lambda m: FTS_SEPARATOR + FTS_SEPARATOR.join(m.group()) + FTS_SEPARATOR, text)
+
+
+def _fts_query(query):
+    """
+    把用户输入转成 FTS5 查询：按空白拆成多个词，全部命中才算匹配。
+    每个词作为一个带引号的短语（用户输入里的 FTS5 语法字符不会被解释），
+    以字母或数字结尾的词按前缀匹配，输入到一半的英文单词也能搜到（中文每个字都是一个词，不需要）。
+    没有可搜索的文字时返回 None。
+    """
+    phrases = []
+    for term in query.split():
+        if not any(ch.isalnum() for ch in term):
+            continue
+        phrase = '"' + _fts_text(term).replace('"', '""') + '"'
+        if not CJK_RUN_PATTERN.fullmatch(term[-1]):
+            phrase += "*"
+        phrases.append(phrase)
+    return " ".join(phrases) or None
+
+
+def _clean_snippet(snippet):
+    """去掉建索引时插入的零宽空格，并把相邻的两段高亮合并成一段。"""
+    return snippet.replace(FTS_SEPARATOR, "").replace(HIGHLIGHT_END + HIGHLIGHT_START, "")
+
+
+def _apply_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # 新建的数据库使用增量 auto_vacuum，删除消息后由后台维护逐步归还空间（旧数据库在第一次维护时转换）。
+    # 必须在切换到 WAL 之前设置，之后数据库文件已经初始化，只能靠完整的 VACUUM 转换
+    if cursor.execute("PRAGMA page_count").fetchone()[0] == 0:
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+class ChatHistoryStore:
+    """
+    进程内共享的聊天记录存储。
+    整个进程只创建一个 SQLAlchemy engine（带连接池），所有会话的读写都复用它，
+    而不是像 SQLChatMessageHistory 那样每轮对话都新建一个 engine。
+    表结构沿用 langchain 的 SQLChatMessageHistory（message_store 表），旧的 chat_history.db 可以直接使用；
+    不过超过 compress_min_bytes 的消息以压缩后的 BLOB 存储（见 _dump_payload），SQLChatMessageHistory 读不了这些行。
+    另外维护两张辅助表，都在追加/删除消息的同一个事务里更新：
+    - message_fts:   FTS5 全文索引（unicode61 分词，中日韩文字逐字成词，见 _fts_text），rowid 与 message_store.id 对应
+    - chat_sessions: 每个会话一行，记录角色、标题、时间和消息数，用于浏览历史会话
+    """
+    def __init__(self, db_path, pool_size=4, compress_min_bytes=COMPRESS_MIN_BYTES):
+        self.db_path = db_path
+        self.compress_min_bytes = compress_min_bytes
+        self.engine = create_engine(
+            f"sqlite:///{db_path}",
+            poolclass=QueuePool,
+            pool_size=pool_size,
+            max_overflow=pool_size,
+            connect_args={"check_same_thread": False},
+        )
+        event.listen(self.engine, "connect", _apply_pragmas)
+        self._create_schema()
+
+    def _create_schema(self):
+        with self.engine.begin() as conn:
+            # 新建的数据库从一开始就压缩写入，不需要再补压缩
+            if conn.execute(text("SELECT COUNT(*) FROM sqlite_master")).scalar() == 0:
+                conn.execute(text(f"PRAGMA user_version = {STORAGE_FORMAT_VERSION}"))
+            conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS message_store ("
+                "id INTEGER PRIMARY KEY, session_id TEXT, message TEXT, type TEXT, token_count INTEGER)"
+            ))
+            # 按会话读取历史时只需要走这个索引，不用扫描整张表
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_message_store_session_id_id "
+                "ON message_store (session_id, id)"
+            ))
+            # 单独记录消息类型，查找“最后一条人类消息”时不用反序列化整段会话
+            columns = {row[1] for row in conn.execute(text("PRAGMA table_info(message_store)"))}
+            if "type" not in columns:
+                logging.info("Migrating message_store: adding 'type' column.")
+                conn.execute(text("ALTER TABLE message_store ADD COLUMN type TEXT"))
+                conn.execute(text("UPDATE message_store SET type = json_extract(message, '$.type')"))
+            # 每条消息的 token 数在写入时计算一次并保存，挑选历史窗口时直接累加即可。
+            # 旧数据这一列为空，会在第一次被窗口扫描到时补算。
+            if "token_count" not in columns:
+                logging.info("Migrating message_store: adding 'token_count' column.")
+                conn.execute(text("ALTER TABLE message_store ADD COLUMN token_count INTEGER"))
+
+            tables = {row[0] for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))}
+            # 只索引消息的纯文本，不依赖 message 列的存储格式
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(content, tokenize = 'unicode61')"
+            ))
+            conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS chat_sessions ("
+                "session_id TEXT PRIMARY KEY, profile TEXT, title TEXT, "
+                "created_at REAL, updated_at REAL, message_count INTEGER NOT NULL DEFAULT 0)"
+            ))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_chat_sessions_updated_at ON chat_sessions (updated_at)"
+            ))
+            has_messages = conn.execute(text("SELECT 1 FROM message_store LIMIT 1")).fetchone() is not None
+        logging.info(f"Chat history store ready at {self.db_path}")
+        # 旧的数据库第一次打开时，从已有的消息建立全文索引和会话列表
+        if has_messages and not {"message_fts", "chat_sessions"} <= tables:
+            logging.info("Migrating chat history: building search index and session list.")
+            self.rebuild_search_index()
+
+    def get_messages(self, session_id):
+        """按写入顺序返回某个会话的全部消息。"""
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                text("SELECT message FROM message_store WHERE session_id = :session_id ORDER BY id"),
+                {"session_id": session_id},
+            ).fetchall()
+        return _load_messages(row[0] for row in rows)
+
+    def add_messages(self, session_id, messages, profile=None):
+        """在一个事务里追加多条消息，同时更新全文索引和会话列表。"""
+        if not messages:
+            return
+        title = next((message_text(m.content).strip() for m in messages if m.type == "human"), None)
+        now = time.time()
+        with self.engine.begin() as conn:
+            for message in messages:
+                message_id = conn.execute(
+                    text(
+                        "INSERT INTO message_store (session_id, type, message, token_count) "
+                        "VALUES (:session_id, :type, :message, :token_count)"
+                    ),
+                    {
+                        "session_id": session_id,
+                        "type": message.type,
+                        "message": _dump_payload(message, self.compress_min_bytes),
+                        "token_count": count_message_tokens(message),
+                    },
+                ).lastrowid
+                conn.execute(
+                    text("INSERT INTO message_fts (rowid, content) VALUES (:id, :content)"),
+                    {"id": message_id, "content": _fts_text(message_text(message.content))},
+                )
+            conn.execute(
+                text(
+                    "INSERT INTO chat_sessions (session_id, profile, title, created_at, updated_at, message_count) "
+                    "VALUES (:session_id, :profile, :title, :now, :now, :count) "
+                    "ON CONFLICT (session_id) DO UPDATE SET "
+                    "updated_at = excluded.updated_at, "
+                    "message_count = chat_sessions.message_count + excluded.message_count, "
+                    "profile = COALESCE(chat_sessions.profile, excluded.profile), "
+                    "title = COALESCE(chat_sessions.title, excluded.title)"
+                ),
+                {
+                    "session_id": session_id,
+                    "profile": profile,
+                    "title": title[:SESSION_TITLE_CHARS] if title else None,
+                    "now": now,
+                    "count": len(messages),
+                },
+            )
+
+    def get_window(self, session_id, max_tokens=None, max_turns=None):
+        """
+        从最新的消息开始倒序挑选历史窗口，返回 (messages, total_tokens)。
+        - max_tokens: 窗口内所有消息的 token 总数上限，None 或 0 表示不限
+        - max_turns: 最多保留最近多少轮（一轮 = 一问一答），None 或 0 表示不限
+        倒序扫描时只读取 id、type 和缓存的 token_count，确定起点后才反序列化窗口内的消息。
+        窗口总是从一条人类消息开始，避免把半轮对话发给模型。
+        最近的一轮本身就超出 max_tokens 时，截断到预算以内后保留；预算小到连截断后的一轮都放不下时窗口为空（见 _fit_messages）。
+        """
+        query = (
+            "SELECT id, type, token_count, CASE WHEN token_count IS NULL THEN message END "
+            "FROM message_store WHERE session_id = :session_id ORDER BY id DESC"
+        )
+        params = {"session_id": session_id}
+        if max_turns:
+            query += " LIMIT :limit"
+            params["limit"] = max_turns * 2
+
+        start_id = None
+        total_tokens = 0
+        window_tokens = 0
+        truncate = False
+        backfill = []
+        with self.engine.connect() as conn:
+            for message_id, message_type, token_count, payload in conn.execute(text(query), params):
+                if token_count is None:
+                    token_count = count_message_tokens(_load_messages([payload])[0])
+                    backfill.append({"id": message_id, "token_count": token_count})
+                over_budget = max_tokens and total_tokens + token_count > max_tokens
+                if over_budget and start_id is not None:
+                    break
+                # 最近的一轮还没找到开头就超出了预算：继续找到这一轮的人类消息，只保留这一轮并截断
+                truncate = truncate or over_budget
+                total_tokens += token_count
+                # 只有遇到人类消息时才移动窗口起点，保证窗口以完整的一轮开始
+                if message_type == "human":
+                    start_id = message_id
+                    window_tokens = total_tokens
+                    if truncate:
+                        break
+
+            messages = []
+            if start_id is not None:
+                rows = conn.execute(
+                    text(
+                        "SELECT message FROM message_store "
+                        "WHERE session_id = :session_id AND id >= :start_id ORDER BY id"
+                    ),
+                    {"session_id": session_id, "start_id": start_id},
+                ).fetchall()
+                messages = _load_messages(row[0] for row in rows)
+                if truncate:
+                    messages = _fit_messages(messages, max_tokens)
+                    window_tokens = sum(count_message_tokens(message) for message in messages)
+
+        if backfill:
+            with self.engine.begin() as conn:
+                conn.execute(text("UPDATE message_store SET token_count = :token_count WHERE id = :id"), backfill)
+        return messages, window_tokens
+
+    def get_page(self, session_id, before_id=None, limit=50):
+        """
+        按 id 做键集分页，返回 id < before_id（为 None 时从最新开始）的最近 limit 条消息，
+        结果为按写入顺序排列的 [(message_id, message), ...] 以及更早的消息是否还有剩余。
+        每一页都沿 (session_id, id) 索引直接定位，翻到多早的位置耗时和内存都一样。
+        """
+        query = "SELECT id, message FROM message_store WHERE session_id = :session_id"
+        params = {"session_id": session_id, "limit": limit + 1}
+        if before_id is not None:
+            query += " AND id < :before_id"
+            params["before_id"] = before_id
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(query + " ORDER BY id DESC LIMIT :limit"), params).fetchall()
+        page = rows[:limit][::-1]
+        messages = _load_messages(row[1] for row in page)
+        return [(row[0], message) for row, message in zip(page, messages)], len(rows) > limit
+
+    def get_session(self, session_id):
+        """返回会话列表中的一行（字段同 list_sessions），会话不存在时返回 None。"""
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                text(
+                    "SELECT session_id, profile, title, created_at, updated_at, message_count FROM chat_sessions "
+                    "WHERE session_id = :session_id"
+                ),
+                {"session_id": session_id},
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("session_id", "profile", "title", "created_at", "updated_at", "message_count"), row))
+
+    def get_last_human_message(self, session_id):
+        """
+        沿 (session_id, id) 索引倒序查找最后一条人类消息，返回 (message_id, message)，找不到时返回 None。
+        只反序列化命中的这一条，耗时与会话长度无关。
+        """
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                text(
+                    "SELECT id, message FROM message_store "
+                    "WHERE session_id = :session_id AND type = 'human' "
+                    "ORDER BY id DESC LIMIT 1"
+                ),
+                {"session_id": session_id},
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], _load_messages([row[1]])[0]
+
+    def truncate(self, session_id, from_id):
+        """在一个事务里删除该会话中 id >= from_id 的所有消息（连同索引），返回删除的条数。"""
+        params = {"session_id": session_id, "from_id": from_id}
+        with self.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "DELETE FROM message_fts WHERE rowid IN ("
+                    "SELECT id FROM message_store WHERE session_id = :session_id AND id >= :from_id)"
+                ),
+                params,
+            )
+            result = conn.execute(
+                text("DELETE FROM message_store WHERE session_id = :session_id AND id >= :from_id"),
+                params,
+            )
+            conn.execute(
+                text(
+                    "UPDATE chat_sessions SET "
+                    "title = CASE WHEN message_count <= :deleted THEN NULL ELSE title END, "
+                    "message_count = MAX(message_count - :deleted, 0) "
+                    "WHERE session_id = :session_id"
+                ),
+                {"session_id": session_id, "deleted": result.rowcount},
+            )
+        return result.rowcount
+
+    def clear(self, session_id):
+        self.delete_sessions([session_id])
+
+    def delete_sessions(self, session_ids):
+        """在一个事务里删除多个会话的全部消息，连同全文索引和会话列表中的行。"""
+        params = [{"session_id": session_id} for session_id in session_ids]
+        if not params:
+            return
+        with self.engine.begin() as conn:
+            conn.execute(
+                text("DELETE FROM message_fts WHERE rowid IN (SELECT id FROM message_store WHERE session_id = :session_id)"),
+                params,
+            )
+            conn.execute(text("DELETE FROM message_store WHERE session_id = :session_id"), params)
+            conn.execute(text("DELETE FROM chat_sessions WHERE session_id = :session_id"), params)
+
+    def rebuild_search_index(self, batch_size=5000):
+        """
+        从 message_store 重新建立全文索引，并重新统计会话列表（保留已记录的角色），返回索引的消息数。
+        在一个事务里完成，重建过程中的查询看到的仍是旧索引。
+        """
+        started_at = time.perf_counter()
+        indexed = 0
+        with self.engine.begin() as conn:
+            conn.execute(text("DELETE FROM message_fts"))
+            last_id = 0
+            while True:
+                rows = conn.execute(
+                    text("SELECT id, message FROM message_store WHERE id > :last_id ORDER BY id LIMIT :limit"),
+                    {"last_id": last_id, "limit": batch_size},
+                ).fetchall()
+                if not rows:
+                    break
+                conn.execute(
+                    text("INSERT INTO message_fts (rowid, content) VALUES (:id, :content)"),
+                    [{"id": row[0], "content": _fts_text(_payload_text(row[1]))} for row in rows],
+                )
+                indexed += len(rows)
+                last_id = rows[-1][0]
+            conn.execute(text("INSERT INTO message_fts (message_fts) VALUES ('optimize')"))
+
+            counts = conn.execute(
+                text("SELECT session_id, COUNT(*) FROM message_store GROUP BY session_id")
+            ).fetchall()
+            conn.execute(text("DELETE FROM chat_sessions WHERE session_id NOT IN (SELECT session_id FROM message_store)"))
+            sessions = []
+            for session_id, count in counts:
+                first_human = conn.execute(
+                    text(
+                        "SELECT message FROM message_store WHERE session_id = :session_id AND type = 'human' "
+                        "ORDER BY id LIMIT 1"
+                    ),
+                    {"session_id": session_id},
+                ).fetchone()
+                title = _payload_text(first_human[0]).strip() if first_human else None
+                created_at = _session_created_at(session_id)
+                sessions.append({
+                    "session_id": session_id,
+                    "title": title[:SESSION_TITLE_CHARS] if title else None,
+                    "created_at": created_at,
+                    "count": count,
+                })
+            if sessions:
+                conn.execute(
+                    text(
+                        "INSERT INTO chat_sessions (session_id, title, created_at, updated_at, message_count) "
+                        "VALUES (:session_id, :title, :created_at, :created_at, :count) "
+                        "ON CONFLICT (session_id) DO UPDATE SET "
+                        "title = excluded.title, message_count = excluded.message_count"
+                    ),
+                    sessions,
+                )
+        logging.info(
+            f"Search index rebuilt: {indexed} messages in {len(sessions)} sessions, "
+            f"{time.perf_counter() - started_at:.2f}s."
+        )
+        return indexed
+
+    def search(self, query, limit=20, offset=0):
+        """
+        全文搜索所有会话，返回 (results, has_more)。查询的写法见 _fts_query。
+        命中不超过 SEARCH_RANK_LIMIT 条时按相关度排序，否则按时间倒序。
+        """
+        match = _fts_query(query)
+        if match is None:
+            return [], False
+        with self.engine.connect() as conn:
+            # 只数到 SEARCH_RANK_LIMIT + 1 条为止，沿 rowid 倒序读取，不会遍历常见词的全部命中
+            broad = conn.execute(
+                text(
+                    "SELECT COUNT(*) FROM (SELECT rowid FROM message_fts WHERE message_fts MATCH :match "
+                    "ORDER BY rowid DESC LIMIT :limit)"
+                ),
+                {"match": match, "limit": SEARCH_RANK_LIMIT + 1},
+            ).scalar() > SEARCH_RANK_LIMIT
+            rows = conn.execute(
+                text(
+                    "SELECT m.id, m.session_id, m.type, snippet(message_fts, 0, :start, :end, '…', 32), "
+                    "s.profile, s.title, s.updated_at "
+                    "FROM message_fts f JOIN message_store m ON m.id = f.rowid "
+                    "LEFT JOIN chat_sessions s ON s.session_id = m.session_id "
+                    "WHERE message_fts MATCH :match "
+                    f"ORDER BY {'f.rowid DESC' if broad else 'rank'} LIMIT :limit OFFSET :offset"
+                ),
+                {
+                    "match": match,
+                    "start": HIGHLIGHT_START,
+                    "end": HIGHLIGHT_END,
+                    "limit": limit + 1,
+                    "offset": offset,
+                },
+            ).fetchall()
+        results = [
+            {
+                "message_id": row[0],
+                "session_id": row[1],
+                "type": row[2],
+                "snippet": _clean_snippet(row[3]),
+                "profile": row[4],
+                "title": row[5],
+                "updated_at": row[6],
+            }
+            for row in rows[:limit]
+        ]
+        return results, len(rows) > limit
+
+    def list_sessions(self, limit=20, offset=0):
+        """按最近更新时间倒序列出有消息的会话，返回 (sessions, has_more)。"""
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                text(
+                    "SELECT session_id, profile, title, created_at, updated_at, message_count FROM chat_sessions "
+                    "WHERE message_count > 0 ORDER BY updated_at DESC, session_id DESC LIMIT :limit OFFSET :offset"
+                ),
+                {"limit": limit + 1, "offset": offset},
+            ).fetchall()
+        sessions = [
+            {
+                "session_id": row[0],
+                "profile": row[1],
+                "title": row[2],
+                "created_at": row[3],
+                "updated_at": row[4],
+                "message_count": row[5],
+            }
+            for row in rows[:limit]
+        ]
+        return sessions, len(rows) > limit
+
+    # --- 后台维护：保留策略、补压缩、归还空间 ---
+    def file_size(self):
+        """数据库文件加上 WAL 文件的大小（字节）。"""
+        return sum(
+            os.path.getsize(path) for path in (self.db_path, self.db_path + "-wal") if os.path.exists(path)
+        )
+
+    def _expired_sessions(self, max_age_days=0, max_sessions=0, max_bytes=0, keep=()):
+        """
+        按保留策略挑出要删除的会话，从最久没有更新的开始，各项为 0 表示不限：
+        - max_age_days: 超过这么多天没有更新的会话
+        - max_sessions: 只保留最近更新的这么多个会话
+        - max_bytes:    数据库实际占用（不含空闲页）超过这个大小时，继续删除最旧的会话，
+                        按消息内容在总占用中的比例估算每个会话的占用（索引和全文索引也随之释放）
+        keep 中的会话（例如当前正在使用的会话）永远不会被删除。
+        """
+        cutoff = time.time() - max_age_days * 86400
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(
+                "SELECT session_id, updated_at FROM chat_sessions ORDER BY updated_at DESC, session_id DESC"
+            )).fetchall()
+            expired = []
+            remaining = []
+            for rank, (session_id, updated_at) in enumerate(rows):
+                if session_id in keep:
+                    continue
+                if (max_sessions and rank >= max_sessions) or (max_age_days and (updated_at or 0) < cutoff):
+                    expired.append(session_id)
+                else:
+                    remaining.append(session_id)
+            if not max_bytes:
+                return expired
+
+            page_size = conn.execute(text("PRAGMA page_size")).scalar()
+            used = (conn.execute(text("PRAGMA page_count")).scalar()
+                    - conn.execute(text("PRAGMA freelist_count")).scalar()) * page_size
+            if used <= max_bytes:
+                return expired
+            sizes = dict(conn.execute(text(
+                "SELECT session_id, SUM(LENGTH(CAST(message AS BLOB))) FROM message_store GROUP BY session_id"
+            )).fetchall())
+        # 每字节消息内容对应的实际占用（包括索引和全文索引）
+        ratio = used / (sum(size or 0 for size in sizes.values()) or 1)
+        used -= sum(sizes.get(session_id) or 0 for session_id in expired) * ratio
+        # remaining 按更新时间倒序排列，从末尾（最旧的）开始删
+        while remaining and used > max_bytes:
+            session_id = remaining.pop()
+            expired.append(session_id)
+            used -= (sizes.get(session_id) or 0) * ratio
+        return expired
+
+    def apply_retention(self, max_age_days=0, max_sessions=0, max_bytes=0, keep=()):
+        """删除保留策略之外的会话（规则见 _expired_sessions），返回删除的会话数。"""
+        expired = self._expired_sessions(max_age_days, max_sessions, max_bytes, keep)
+        for start in range(0, len(expired), MAINTENANCE_BATCH_SIZE):
+            self.delete_sessions(expired[start:start + MAINTENANCE_BATCH_SIZE])
+        if expired:
+            logging.info(f"Retention removed {len(expired)} sessions.")
+        return len(expired)
+
+    def compress_payloads(self, stop_event=None):
+        """
+        把旧版本写入的、未压缩的大消息改为压缩存储，返回改写的条数。
+        分批进行，每批一个短事务；全部完成后升级 user_version，之后不再扫描。被 stop_event 打断时下次从头继续。
+        """
+        if not self.compress_min_bytes:
+            return 0
+        with self.engine.connect() as conn:
+            if conn.execute(text("PRAGMA user_version")).scalar() >= STORAGE_FORMAT_VERSION:
+                return 0
+        compressed = 0
+        last_id = 0
+        while True:
+            if stop_event and stop_event.is_set():
+                return compressed
+            with self.engine.begin() as conn:
+                # 先按字符数粗筛（UTF-8 每个字符最多 4 字节，字符数不到四分之一的一定不够大），再按实际字节数判断
+                rows = conn.execute(
+                    text(
+                        "SELECT id, message FROM message_store "
+                        "WHERE id > :last_id AND typeof(message) = 'text' AND LENGTH(message) >= :min_chars "
+                        "ORDER BY id LIMIT :limit"
+                    ),
+                    {"last_id": last_id, "min_chars": self.compress_min_bytes // 4, "limit": MAINTENANCE_BATCH_SIZE},
+                ).fetchall()
+                if not rows:
+                    conn.execute(text(f"PRAGMA user_version = {STORAGE_FORMAT_VERSION}"))
+                    break
+                updates = []
+                for message_id, payload in rows:
+                    encoded = payload.encode("utf-8")
+                    if len(encoded) >= self.compress_min_bytes:
+                        updates.append({"id": message_id, "message": zlib.compress(encoded, COMPRESS_LEVEL)})
+                if updates:
+                    conn.execute(text("UPDATE message_store SET message = :message WHERE id = :id"), updates)
+                compressed += len(updates)
+                last_id = rows[-1][0]
+        if compressed:
+            logging.info(f"Compressed {compressed} stored messages.")
+        return compressed
+
+    def reclaim_space(self, stop_event=None):
+        """
+        把空闲页归还给文件系统，返回归还的页数。
+        增量 auto_vacuum 模式下分步执行 incremental_vacuum，每步之间检查 stop_event；
+        旧数据库还不是这个模式时先做一次完整的 VACUUM 完成转换（只有第一次，耗时与数据库大小成正比，不能中途打断），
+        所以只在还没收到 stop_event、空闲页足够多（见 VACUUM_CONVERT_MIN_FREE_*）时才转换，否则留到下次维护。
+        最后把 WAL 文件截断。
+        """
+        reclaimed = 0
+        with self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            freelist = conn.execute(text("PRAGMA freelist_count")).scalar()
+            if conn.execute(text("PRAGMA auto_vacuum")).scalar() != 2:
+                page_count = conn.execute(text("PRAGMA page_count")).scalar()
+                if stop_event and stop_event.is_set():
+                    return 0
+                if freelist < VACUUM_CONVERT_MIN_FREE_PAGES or freelist < page_count * VACUUM_CONVERT_MIN_FREE_RATIO:
+                    logging.info(
+                        f"Skipping the one-time VACUUM: only {freelist} of {page_count} pages are free."
+                    )
+                    return 0
+                logging.info("Converting chat history database to incremental auto_vacuum (one-time full VACUUM).")
+                conn.execute(text("PRAGMA auto_vacuum = INCREMENTAL"))
+                conn.execute(text("VACUUM"))
+                reclaimed = freelist
+            else:
+                # sqlite3 模块的 execute 对不返回行的语句只执行一步（只归还一页），executescript 才会执行到底
+                dbapi_connection = conn.connection.dbapi_connection
+                while freelist and not (stop_event and stop_event.is_set()):
+                    dbapi_connection.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP})")
+                    remaining = conn.execute(text("PRAGMA freelist_count")).scalar()
+                    reclaimed += freelist - remaining
+                    freelist = remaining
+            conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)")).fetchall()
+        return reclaimed
+
+    def maintain(self, max_age_days=0, max_sessions=0, max_bytes=0, keep=(), stop_event=None):
+        """依次执行保留策略、补压缩和归还空间，返回统计信息。窗口隐藏时在后台调用，stop_event 置位后尽快停下。"""
+        started_at = time.perf_counter()
+        size_before = self.file_size()
+        stats = {
+            "deleted_sessions": self.apply_retention(max_age_days, max_sessions, max_bytes, keep),
+            "compressed_messages": self.compress_payloads(stop_event),
+        }
+        stats["reclaimed_pages"] = self.reclaim_space(stop_event)
+        stats.update(size_before=size_before, size_after=self.file_size())
+        logging.info(
+            f"Chat history maintenance: {stats['deleted_sessions']} sessions removed, "
+            f"{stats['compressed_messages']} messages compressed, {stats['reclaimed_pages']} pages reclaimed, "
+            f"{size_before / 1024 / 1024:.1f} MB -> {stats['size_after'] / 1024 / 1024:.1f} MB "
+            f"in {time.perf_counter() - started_at:.2f}s."
+        )
+        return stats
+
+    def close(self):
+        """关闭连接池中的所有连接。"""
+        self.engine.dispose()
+
+
+class SQLiteChatMessageHistory(BaseChatMessageHistory):
+    """
+    基于 ChatHistoryStore 的 BaseChatMessageHistory 实现，对象本身很轻，
+    chain 每次取历史时新建一个也没有开销，真正的连接由 store 复用。
+    传入 max_tokens / max_turns 时，messages 只返回按预算挑选出的最近一段历史。
+    """
+    def __init__(self, store, session_id, max_tokens=None, max_turns=None, profile=None):
+        self.store = store
+        self.session_id = session_id
+        self.max_tokens = max_tokens
+        self.max_turns = max_turns
+        # 会话第一次写入时记录到 chat_sessions 的角色名，之后不会被覆盖
+        self.profile = profile
+
+    @property
+    def messages(self):
+        if not self.max_tokens and not self.max_turns:
+            return self.store.get_messages(self.session_id)
+        messages, tokens = self.store.get_window(self.session_id, self.max_tokens, self.max_turns)
+        logging.info(
+            f"History window for session {self.session_id}: {len(messages)} messages, {tokens} tokens "
+            f"(budget {self.max_tokens or 'unlimited'}, max turns {self.max_turns or 'unlimited'})"
+        )
+        return messages
+
+    def add_messages(self, messages):
+        # 流式调用时 chain 的输出是拼接后的 AIMessageChunk，
+        # 入库前统一转换成完整的 AIMessage，保证历史记录里只有一条完整的 AI 消息。
+        self.store.add_messages(self.session_id, [message_chunk_to_message(m) for m in messages], self.profile)
+
+    def clear(self):
+        self.store.clear(self.session_id)
+
+    def get_last_human_message(self):
+        return self.store.get_last_human_message(self.session_id)
+
+    def truncate(self, from_id):
+        return self.store.truncate(self.session_id, from_id)
@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+
+import httpx
+from langchain_openai import ChatOpenAI
+
+
+# 长连接池参数：空闲连接保留 5 分钟，这段时间内的请求都不需要重新做 TCP/TLS 握手
+POOL_LIMITS = httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=300)
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+
+
+class ClientRegistry:
+    """
+    ChatOpenAI 客户端注册表，按 (model_name, api_key, base_url) 复用。
+    每个客户端持有一个长期存在、带连接池的 httpx.Client，
+    切换角色或修改快捷键等无关设置时都会拿到同一个实例，已建立的 keep-alive 连接不会被丢弃。
+    max_retries 传给 ChatOpenAI（None 表示沿用 SDK 默认的重试次数）；自己负责重试的调用方（批处理）传 0。
+    """
+    def __init__(self, max_retries=None):
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        # (model_name, api_key, base_url) -> httpx.Client
+        self._http_clients = {}
+        # (model_name, api_key, base_url, max_retries) -> ChatOpenAI
+        self._clients = {}
+
+    def get(self, model_name, api_key, base_url, max_retries=None):
+        """
+        返回对应的 ChatOpenAI 客户端。max_retries 不为 None 时覆盖注册表的设置，
+        重试次数不同的客户端共用同一个连接池（例如对冲路由自己负责故障转移，不需要 SDK 再重试）。
+        """
+        key = (model_name, api_key, base_url)
+        if max_retries is None:
+            max_retries = self.max_retries
+        with self._lock:
+            llm = self._clients.get(key + (max_retries,))
+            if llm is None:
+                http_client = self._http_clients.get(key)
+                if http_client is None:
+                    http_client = httpx.Client(limits=POOL_LIMITS)
+                    self._http_clients[key] = http_client
+                llm = ChatOpenAI(
+                    model=model_name, api_key=api_key, base_url=base_url, http_client=http_client,
+                    max_retries=max_retries,
+                )
+                self._clients[key + (max_retries,)] = llm
+                logging.info(f"Created ChatOpenAI client for model '{model_name}' at {base_url or 'default endpoint'}.")
+            return llm
+
+    def get_http_client(self, model_name, api_key, base_url):
+        """返回某个客户端底层的 httpx.Client，没有时返回 None。"""
+        with self._lock:
+            return self._http_clients.get((model_name, api_key, base_url))
+
+    def warm_up(self, model_name, api_key, base_url, timeout=5):
+        """
+        用客户端自己的连接池向 base_url 发一个 HEAD 请求，提前完成 DNS、TCP 和 TLS 握手，
+        并把池子里已经失效的旧连接换掉。不带 API Key，也不会消耗额度；返回状态码无关紧要。
+        返回耗时（秒），失败时返回 None。
+        """
+        self.get(model_name, api_key, base_url)
+        http_client = self.get_http_client(model_name, api_key, base_url)
+        started_at = time.perf_counter()
+        try:
+            http_client.head(base_url or DEFAULT_BASE_URL, timeout=timeout)
+        except httpx.HTTPError as e:
+            logging.warning(f"Connection warm-up to {base_url or DEFAULT_BASE_URL} failed: {e}")
+            return None
+        return time.perf_counter() - started_at
+
+    def close(self):
+        """关闭所有客户端的连接池。"""
+        with self._lock:
+            http_clients = list(self._http_clients.values())
+            self._http_clients.clear()
+            self._clients.clear()
+        for http_client in http_clients:
+            http_client.close()
@@ -0,0 +1,261 @@
+import logging
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from history_store import count_tokens
+
+
+# 存入历史的输入预览长度（字符）。长文本本身不写入历史，只记录它的开头和分段信息
+HISTORY_PREVIEW_CHARS = 500
+# 精简记录在 additional_kwargs 中的标记，重新生成时据此识别出历史里只有预览、没有完整输入
+HISTORY_MARKER = "long_input"
+# 不开启合并时，存入历史的回答最多保留这么多字符，避免下一轮的历史窗口被一整篇译文占满
+HISTORY_ANSWER_CHARS = 4000
+# 等待下一段输出时检查取消的间隔（秒）
+CANCEL_POLL_SECONDS = 0.1
+
+MAP_INSTRUCTION = "以下是一段长文本的第 {index}/{total} 部分，请按照你的设定处理这一部分，只输出这一部分的结果：\n\n{chunk}"
+REDUCE_INSTRUCTION = (
+    "下面是把一段长文本分成 {total} 部分后分别处理得到的结果，"
+    "请把它们合并成一个完整、连贯的回答，去掉重复的内容：\n\n{results}"
+)
+
+# Markdown 标题（# 标题）、编号标题（1. / 1.2 / 第一章 / 一、）都视为新小节的开始
+HEADING_PATTERN = re.compile(r"^(#{1,6}\s|\d+(\.\d+)*\.?\s+\S|第[一二三四五六七八九十百\d]+[章节部分]|[一二三四五六七八九十]+、)")
+# 一个句子：到句末标点（连同后面的空白）为止，用于切分超长的段落
+SENTENCE_PATTERN = re.compile(r".*?(?:[。！？；.!?;]+\s*|$)", re.S)
+
+
+def _split_blocks(text):
+    """
+    按结构把文本切成块：空行分隔的段落、标题各自成块，代码块（``` 围起来的部分）整体作为一块不拆开。
+    返回 [(block_text, is_heading), ...]。
+    """
+    blocks = []
+    current = []
+    in_code = False
+
+    def flush():
+        if current:
+            blocks.append(("\n".join(current), False))
+            current.clear()
+
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            if not in_code:
+                flush()
+            current.append(line)
+            in_code = not in_code
+            if not in_code:
+                flush()
+        elif in_code:
+            current.append(line)
+        elif not stripped:
+            flush()
+        elif HEADING_PATTERN.match(stripped) and len(stripped) <= 80:
+            flush()
+            blocks.append((line, True))
+        else:
+            current.append(line)
+    flush()
+    return blocks
+
+
+def _split_oversized(block, max_tokens):
+    """把超过 max_tokens 的单个段落按句子切开；单个句子仍然超长时按字符硬切。"""
+    pieces = []
+    current = ""
+    for sentence in SENTENCE_PATTERN.findall(block):
+        if not sentence:
+            continue
+        if current and count_tokens(current + sentence) > max_tokens:
+            pieces.append(current)
+            current = ""
+        while count_tokens(sentence) > max_tokens:
+            # 按 token 与字符的比例估算切点
+            cut = max(int(len(sentence) * max_tokens / count_tokens(sentence)), 1)
+            pieces.append(sentence[:cut])
+            sentence = sentence[cut:]
+        current += sentence
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_into_chunks(text, max_tokens):
+    """
+    把长文本切成不超过 max_tokens 的若干段，尽量在结构边界上断开：
+    - 按段落、标题、代码块累积，放不下下一块时才断开；单个段落超长时先按句子切开再累积
+    - 当前段已经用了一半以上的额度、又遇到新标题时提前断开，让每个小节尽量完整地落在同一段里
+    - 标题不会单独留在上一段的末尾
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+    current_is_heading = False
+
+    def flush():
+        nonlocal current_tokens
+        if current:
+            chunks.append("\n\n".join(current))
+            current.clear()
+            current_tokens = 0
+
+    blocks = []
+    for block, is_heading in _split_blocks(text):
+        tokens = count_tokens(block)
+        if tokens > max_tokens:
+            blocks.extend((piece, False, count_tokens(piece)) for piece in _split_oversized(block, max_tokens))
+        else:
+            blocks.append((block, is_heading, tokens))
+
+    for block, is_heading, tokens in blocks:
+        if is_heading and current_tokens >= max_tokens / 2:
+            flush()
+        if current_tokens + tokens > max_tokens:
+            # 不把刚开始的小节标题留在上一段末尾
+            heading = current.pop() if current and current_is_heading else None
+            flush()
+            if heading:
+                current.append(heading)
+                current_tokens = count_tokens(heading)
+        current.append(block)
+        current_tokens += tokens
+        current_is_heading = is_heading
+    flush()
+    return chunks
+
+
+class LongInputProcessor:
+    """
+    长文本的分段并行处理（map-reduce）。
+    - map：每一段都和当前角色的 system prompt 一起单独发给模型，最多 concurrency 段同时进行
+    - 输出按段落顺序产出：排在最前面、还没完成的那一段实时流式输出，后面先完成的段落先缓存起来，轮到时一次性输出
+    - reduce（可选）：所有段落处理完后，把各段结果交给模型合并成一个回答，流式输出合并结果
+    先 split() 再 stream()，stream() 产出文本片段；cancel_event 置位后停止产出，并让进行中的请求在下一个 chunk 处停下。
+    """
+    def __init__(self, llm, system_prompt, chunk_tokens=1500, concurrency=4, reduce=False):
+        self.llm = llm
+        self.system_prompt = system_prompt
+        self.chunk_tokens = chunk_tokens
+        self.concurrency = concurrency
+        self.reduce = reduce
+        self.chunks = []
+        self.results = []
+
+    def _map_messages(self, index, chunk):
+        return [
+            SystemMessage(content=self.system_prompt),
+            HumanMessage(content=MAP_INSTRUCTION.format(index=index + 1, total=len(self.chunks), chunk=chunk)),
+        ]
+
+    def _run_chunk(self, index, output, stop_event, config):
+        """在线程池中处理一段，把增量文本放进这一段自己的队列，结束时放入 None（出错时放入异常）。"""
+        parts = []
+        stream = self.llm.stream(self._map_messages(index, self.chunks[index]), config=config)
+        try:
+            for chunk in stream:
+                if stop_event.is_set():
+                    break
+                if chunk.content:
+                    parts.append(chunk.content)
+                    output.put(chunk.content)
+            self.results[index] = "".join(parts)
+            output.put(None)
+        except Exception as e:
+            output.put(e)
+        finally:
+            stream.close()
+
+    def _map(self, stop_event, cancel_event, config):
+        """
+        并行处理所有段落，按顺序产出 (index, delta)；每一段结束时产出 (index, None)。
+        等待时也会定期检查 cancel_event，首字节迟迟不来时取消同样能立即生效。
+        """
+        outputs = [queue.Queue() for _ in self.chunks]
+        pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="long-input")
+        try:
+            for index, output in enumerate(outputs):
+                pool.submit(self._run_chunk, index, output, stop_event, config)
+            for index, output in enumerate(outputs):
+                while True:
+                    try:
+                        item = output.get(timeout=CANCEL_POLL_SECONDS)
+                    except queue.Empty:
+                        if cancel_event.is_set():
+                            return
+                        continue
+                    if isinstance(item, Exception):
+                        raise item
+                    yield index, item
+                    if item is None:
+                        logging.info(f"Long input chunk {index + 1}/{len(self.chunks)} finished.")
+                        break
+        finally:
+            # 提前结束（取消或出错）时，还没开始的段落不再发请求，进行中的段落在下一个 chunk 处停下
+            stop_event.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def split(self, text):
+        """切分输入，返回段数。"""
+        self.chunks = split_into_chunks(text, self.chunk_tokens)
+        self.results = [None] * len(self.chunks)
+        logging.info(
+            f"Long input split into {len(self.chunks)} chunks "
+            f"(max {self.chunk_tokens} tokens each, concurrency {self.concurrency}, reduce {self.reduce})."
+        )
+        return len(self.chunks)
+
+    def stream(self, cancel_event, config=None):
+        """依次产出 split() 切好的各段的处理结果（开启 reduce 时只产出合并后的结果）。"""
+        stop_event = threading.Event()
+        for index, delta in self._map(stop_event, cancel_event, config):
+            if cancel_event.is_set():
+                return
+            if self.reduce:
+                continue
+            if delta is None:
+                if index < len(self.chunks) - 1:
+                    yield "\n\n"
+            else:
+                yield delta
+
+        # _map 在等待时发现取消会直接返回，这里不能再去发合并请求
+        if cancel_event.is_set():
+            return
+        if self.reduce:
+            results = "\n\n".join(f"【第 {i + 1} 部分】\n{result}" for i, result in enumerate(self.results))
+            messages = [
+                SystemMessage(content=self.system_prompt),
+                HumanMessage(content=REDUCE_INSTRUCTION.format(total=len(self.chunks), results=results)),
+            ]
+            stream = self.llm.stream(messages, config=config)
+            try:
+                for chunk in stream:
+                    if cancel_event.is_set():
+                        return
+                    if chunk.content:
+                        yield chunk.content
+            finally:
+                stream.close()
+
+    def history_messages(self, text, answer):
+        """
+        存入聊天记录的精简版本：输入只保留开头的预览和分段信息，
+        回答在没有合并步骤时截断到 HISTORY_ANSWER_CHARS，分段的中间结果都不写入。
+        两条消息都带有 HISTORY_MARKER 标记。
+        """
+        preview = text[:HISTORY_PREVIEW_CHARS] + ("…" if len(text) > HISTORY_PREVIEW_CHARS else "")
+        note = f"[长文本输入：{len(text)} 个字符，分为 {len(self.chunks)} 段处理，以下是开头部分]\n\n"
+        if not self.reduce and len(answer) > HISTORY_ANSWER_CHARS:
+            answer = answer[:HISTORY_ANSWER_CHARS] + f"\n\n[回答共 {len(answer)} 个字符，此处只保留开头部分]"
+        marker = {HISTORY_MARKER: True}
+        return [
+            HumanMessage(content=note + preview, additional_kwargs=marker),
+            AIMessage(content=answer, additional_kwargs=marker),
+        ]
@@ -1,20 +1,51 @@
-import webview
+import time
+# 尽早记录进程启动的时间点，用于统计启动各阶段的耗时
+_process_started_at = time.perf_counter()
 import logging
 import os
 import sys
 import json
-import time
-import keyboard
+import queue
 import threading
-from PIL import Image
-import pystray
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_community.chat_message_histories import SQLChatMessageHistory
-from langchain_core.runnables.history import RunnableWithMessageHistory
+from request_executor import RequestExecutor
+# 注意：LangChain、SQLAlchemy、PIL/pystray 这些重量级依赖都改为在用到的地方局部导入，
+# LangChain 相关的导入和初始化在后台线程中完成，窗口和托盘不需要等它们。
+# pywebview 和 keyboard 也在用到时才导入，无界面的批处理模式（main_batch）完全不会加载它们
 
 logging.basicConfig(level=logging.INFO,format='%(asctime)s - %(levelname)s - %(message)s')
 
+
+# 这些设置变化时才需要重新初始化 LLM 和 chain，其余设置（例如快捷键）保存后不影响进行中的会话
+LLM_SETTING_KEYS = (
+    "model_name", "api_key", "base_url", "endpoints", "hedge_delay_ms", "endpoint_timeout_seconds",
+    "history_max_tokens", "history_keep_last_turns",
+    "response_cache_enabled", "response_cache_max_entries", "response_cache_ttl_seconds",
+)
+# 后台初始化完成前（以及从空闲模式恢复期间）收到的操作排在执行器的这个队列里，
+# 由工作线程按到达顺序等待初始化完成后执行，JS 的调用立即返回
+STARTUP_QUEUE = "startup"
+
+
+class StartupTimer:
+    """
+    启动阶段计时，设置环境变量 SIMPLEAI_STARTUP_TIMING=1 后开启。
+    每个阶段只记录第一次到达的时间（相对进程启动），用于追踪冷启动耗时的回归。
+    """
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.phases = {}
+
+    def mark(self, phase):
+        if not self.enabled or phase in self.phases:
+            return
+        elapsed_ms = (time.perf_counter() - _process_started_at) * 1000
+        self.phases[phase] = elapsed_ms
+        logging.info(f"[startup] {phase}: {elapsed_ms:.0f} ms")
+
+
+startup_timer = StartupTimer(os.environ.get("SIMPLEAI_STARTUP_TIMING") == "1")
+startup_timer.mark("imports")
+
 # --- 关键改动：判断运行环境，并设置正确的路径 ---
 if getattr(sys, 'frozen', False):
     # 如果是打包后的 .exe 文件
@@ -28,6 +59,9 @@ else:
 
 secret_path = os.path.join(app_path, "secrets.json")
 prompt_path = os.path.join(app_path, "prompts.json")
+history_db_path = os.path.join(app_path, "chat_history.db")
+cache_db_path = os.path.join(app_path, "llm_cache.db")
+metrics_log_path = os.path.join(app_path, "metrics.jsonl")
 # 注意：图片资源路径依然使用 base_path，因为它被打包进了_MEIPASS
 icon_path = os.path.join(base_path, "static", "img", "icon.png")
 
@@ -39,54 +73,461 @@ if not os.path.exists(secret_path):
         "model_name": "",
         "api_key": "",
         "base_url": "",
-        "hotkey": "ctrl+shift+a"
+        "endpoints": [],
+        "hedge_delay_ms": 1500,
+        "endpoint_timeout_seconds": 60,
+        "hotkey": "ctrl+shift+a",
+        "stream": True,
+        "stream_flush_ms": 50,
+        "stream_flush_chars": 200,
+        "max_concurrent_requests": 4,
+        "history_max_tokens": 4000,
+        "history_keep_last_turns": 20,
+        "response_cache_enabled": False,
+        "response_cache_max_entries": 1000,
+        "response_cache_ttl_seconds": 604800,
+        "prewarm_on_show": True,
+        "prewarm_min_interval_seconds": 60,
+        "metrics_enabled": True,
+        "long_input_threshold_tokens": 6000,
+        "long_input_chunk_tokens": 2000,
+        "long_input_concurrency": 4,
+        "long_input_reduce": False,
+        "idle_release_after_seconds": 600,
+        "history_retention_days": 0,
+        "history_max_sessions": 0,
+        "history_max_size_mb": 0,
+        "history_maintenance_delay_seconds": 120,
+        "history_maintenance_interval_hours": 24
     }
     with open(secret_path, 'w', encoding='utf-8') as f:
         json.dump(default_secrets, f, indent=4)
 
 
+class StreamBatcher:
+    """
+    将流式返回的零碎 token 合并成批次再推送到前端，避免频繁调用 evaluate_js。
+    满足以下任一条件即推送一次：距上次推送超过 flush_ms 毫秒，或者累积字符数达到 flush_chars。
+    第一批会立即推送，以尽可能缩短首字延迟。
+    """
+    def __init__(self, flush, flush_ms=50, flush_chars=200):
+        self._flush = flush
+        self._flush_interval = flush_ms / 1000
+        self._flush_chars = flush_chars
+        self._pending = []
+        self._pending_chars = 0
+        self._last_flush = 0.0
+
+    def push(self, delta):
+        if not delta:
+            return
+        self._pending.append(delta)
+        self._pending_chars += len(delta)
+        now = time.monotonic()
+        if self._pending_chars >= self._flush_chars or now - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        text = "".join(self._pending)
+        self._pending = []
+        self._pending_chars = 0
+        self._last_flush = time.monotonic()
+        self._flush(text)
+
+
 class Api:
     def __init__(self):
         self._window = None
         self.llm = None
         self.chain_with_history = None
         self.session_id = None
+        # 当前使用的提示词角色，长文本分段处理时需要取它的 system prompt
+        self.profile_name = None
         self.settings = self.get_settings()
         self.prompts = self.get_prompts()
-        self._try_initialize_llm() # 启动时首次尝试初始化
+        startup_timer.mark("settings loaded")
+        # 保护 session_id / chain_with_history / profile_name 的切换，请求提交时会在锁内取一份快照
+        self._state_lock = threading.RLock()
+        # 整个进程共用一个聊天记录存储（一个带连接池的 engine），在后台初始化时创建
+        self._history_store = None
+        # 回答缓存默认关闭，在 secrets.json 中开启 response_cache_enabled 后才会创建
+        self._response_cache = None
+        # ChatOpenAI 客户端注册表（复用连接池），在后台初始化时创建
+        self._clients = None
+        # 每轮对话的分阶段计时记录，在后台初始化时创建；metrics_enabled 为 False 时保持 None
+        self._metrics = None
+        # 按提示词角色缓存已经构建好的 chain: profile_name -> (fingerprint, chain)
+        self._chains = {}
+        # 连接预热的限流，以及用于统计“空闲多久后的首字延迟”的时间点
+        self._last_prewarm_at = 0.0
+        self._last_prewarm_done_at = 0.0
+        self._last_activity_at = time.monotonic()
+        # 所有 LLM 调用都交给后台执行器，按会话排队，不阻塞 JS 桥接线程
+        # 排队中就被取消的请求不会执行，需要单独通知前端结束它，否则“停止生成”按钮会一直显示
+        self._executor = RequestExecutor(
+            max_workers=self.settings.get("max_concurrent_requests", 4),
+            on_dropped=lambda request_id: self._evaluate_js(f"requestFinished({json.dumps(request_id)})"),
+        )
+        # 后台初始化（导入 LangChain、打开数据库、创建 LLM 和 chain）完成后置位；从空闲模式恢复期间会暂时清除
+        self._ready = threading.Event()
+        # 聊天记录存储打开后置位，比 _ready 早得多，空闲模式也不会清除；只读聊天记录的调用只等它
+        self._store_ready = threading.Event()
+        # 窗口隐藏超过 idle_release_after_seconds 后进入空闲模式，释放客户端、chain 和缓存
+        self._idle = False
+        self._idle_timer = None
+        # 进入空闲模式的释放（关闭客户端、缓存、数据库，清空前端）在锁外进行，完成前保持清除；
+        # 恢复时先等它，避免和正在关闭的客户端交错，或者被晚到的 enterIdle() 清掉刚恢复的页面
+        self._idle_entered = threading.Event()
+        self._idle_entered.set()
+        # 窗口隐藏时的聊天记录维护（保留策略、补压缩、增量 VACUUM），窗口显示时通过 _maintenance_stop 让它停下
+        self._maintenance_timer = None
+        self._maintenance_stop = threading.Event()
+        self._last_maintenance_at = 0.0
+
+    def start_background_init(self):
+        """在后台线程中完成重量级的初始化，调用后立即返回。"""
+        threading.Thread(target=self._background_init, name="llm-init", daemon=True).start()
+
+    def _background_init(self):
+        try:
+            # 先打开聊天记录，历史弹窗不用等 LLM 初始化；之后各处的局部导入都只是查一下 sys.modules
+            import history_store
+            self._history_store = history_store.ChatHistoryStore(history_db_path)
+            self._store_ready.set()
+            startup_timer.mark("history store ready")
+            import llm_clients
+            import metrics
+            startup_timer.mark("langchain imported")
+            self._clients = llm_clients.ClientRegistry()
+            if self.settings.get("metrics_enabled", True):
+                self._metrics = metrics.MetricsRecorder(metrics_log_path)
+            self._try_initialize_llm() # 启动时首次尝试初始化
+            startup_timer.mark("llm ready")
+        except Exception as e:
+            logging.error(f"Background initialization failed: {e}")
+        finally:
+            self._store_ready.set()
+            self._ready.set()
+
+    def _wait_until_ready(self, timeout=60):
+        """启动后过早到来的请求在这里等待后台初始化完成，而不是直接报“未初始化”。"""
+        if not self._ready.is_set():
+            logging.info("Waiting for background initialization to finish...")
+        return self._ready.wait(timeout)
+
+    def _is_deferred(self):
+        """初始化还没完成，或者启动队列里还有没执行完的操作时，新的操作也要排进启动队列，保证先后顺序。"""
+        return not self._ready.is_set() or self._executor.is_busy(STARTUP_QUEUE)
+
+    def _submit_when_ready(self, fn, cancellable=True):
+        """把 fn(request_id, cancel_event) 排进启动队列，在工作线程里等待初始化完成后再执行，立即返回 request_id。"""
+        def run(request_id, cancel_event):
+            self._wait_until_ready()
+            fn(request_id, cancel_event)
+
+        return self._executor.submit(STARTUP_QUEUE, run, cancellable)
 
     def _try_initialize_llm(self):
         """
         尝试用当前的设置初始化LLM和Chain。
         如果失败（例如缺少API Key），则保持 self.llm 为 None，不崩溃。
         """
-        api_key = self.settings.get("api_key")
-        if not api_key:
+        endpoints = self._get_endpoints()
+        if not endpoints:
             logging.warning("API key not found. LLM not initialized.")
             return
 
         try:
-            self.llm = ChatOpenAI(
-                model=self.settings.get("model_name"), 
-                api_key=api_key, 
-                base_url=self.settings.get("base_url")
-            )
+            llm = self._build_llm(endpoints)
             # LLM成功初始化后，立即设置一个默认的chain
-            self.session_id = time.strftime("%Y%m%d%H%M%S", time.localtime())
             default_prompt = self.prompts.get("default", {}).get("prompt", "You are a helpful assistant.")
-            self.chain_with_history = self._create_chain(default_prompt, self.llm)
+            chain_with_history = self._get_chain("default", default_prompt, llm)
+            with self._state_lock:
+                self.llm = llm
+                self.chain_with_history = chain_with_history
+                self.profile_name = "default"
+                self.session_id = time.strftime("%Y%m%d%H%M%S", time.localtime())
             logging.info(f"LLM and chain initialized successfully. New session started: {self.session_id}")
         except Exception as e:
             logging.error(f"Failed to initialize LLM. Please check API settings. Error: {e}")
+            with self._state_lock:
+                self.llm = None
+                self.chain_with_history = None
+
+    def _build_llm(self, endpoints):
+        """按接口列表创建 llm：多个接口时包一层 HedgedChatModel，开启回答缓存时再包一层 CachedChatModel。"""
+        from response_cache import CachedChatModel
+        from endpoint_router import HedgedChatModel
+
+        # 相同的模型、密钥和地址会拿到同一个客户端，连接池得以保留。
+        # 多个接口时由路由层负责故障转移，SDK 自带的重试会让超时的请求一直占着连接，所以关掉
+        max_retries = 0 if len(endpoints) > 1 else None
+        llms = [self._clients.get(*endpoint, max_retries=max_retries) for endpoint in endpoints]
+        if len(llms) > 1:
+            # 配置了多个接口时，由 HedgedChatModel 负责对冲请求、故障转移和按延迟降级
+            labels = [f"{model_name}@{base_url or 'default'}" for model_name, _, base_url in endpoints]
+            llm = HedgedChatModel(
+                list(zip(labels, llms)),
+                self.settings.get("hedge_delay_ms", 1500) / 1000,
+                attempt_timeout=self.settings.get("endpoint_timeout_seconds", 60),
+            )
+            logging.info(f"Using {len(llms)} endpoints in order: {', '.join(labels)}")
+        else:
+            llm = llms[0]
+        if self.settings.get("response_cache_enabled", False):
+            llm = CachedChatModel(
+                llm,
+                self._get_response_cache(),
+                [(model_name, base_url) for model_name, _, base_url in endpoints],
+            )
+        return llm
+
+    def on_window_hidden(self):
+        """窗口隐藏时调用：安排空闲模式和聊天记录的后台维护。"""
+        self._schedule_idle()
+        self._schedule_maintenance()
+
+    def _schedule_idle(self):
+        """idle_release_after_seconds 秒（0 表示关闭）后窗口仍然隐藏，就进入空闲模式。"""
+        delay = self.settings.get("idle_release_after_seconds", 600)
+        if not delay:
+            return
+        with self._state_lock:
+            if self._idle_timer:
+                self._idle_timer.cancel()
+            self._idle_timer = threading.Timer(delay, self._enter_idle)
+            self._idle_timer.daemon = True
+            self._idle_timer.start()
+
+    def _schedule_maintenance(self):
+        """
+        距离上次维护超过 history_maintenance_interval_hours（0 表示关闭）时，
+        在窗口隐藏 history_maintenance_delay_seconds 秒后执行一次聊天记录维护。
+        """
+        interval = self.settings.get("history_maintenance_interval_hours", 24) * 3600
+        if not interval or time.time() - self._last_maintenance_at < interval:
+            return
+        with self._state_lock:
+            if self._maintenance_timer:
+                self._maintenance_timer.cancel()
+            self._maintenance_timer = threading.Timer(
+                self.settings.get("history_maintenance_delay_seconds", 120), self._run_maintenance
+            )
+            self._maintenance_timer.daemon = True
+            self._maintenance_timer.start()
+
+    def _run_maintenance(self):
+        """在计时器线程中执行保留策略、补压缩和增量 VACUUM；窗口被唤出时补压缩和 VACUUM 会尽快停下。"""
+        with self._state_lock:
+            # 计时器触发的同时窗口被显示了，放弃这次维护
+            if self._maintenance_timer is not threading.current_thread():
+                return
+            self._maintenance_timer = None
+            self._maintenance_stop.clear()
+            session_id = self.session_id
+        if not self._history_store:
+            return
+        try:
+            self._history_store.maintain(
+                max_age_days=self.settings.get("history_retention_days", 0),
+                max_sessions=self.settings.get("history_max_sessions", 0),
+                max_bytes=self.settings.get("history_max_size_mb", 0) * 1024 * 1024,
+                keep=(session_id,),
+                stop_event=self._maintenance_stop,
+            )
+        except Exception as e:
+            logging.error(f"Chat history maintenance failed: {e}")
+        if not self._maintenance_stop.is_set():
+            self._last_maintenance_at = time.time()
+
+    def on_window_shown(self):
+        """
+        窗口显示时调用：取消空闲计时和还没开始的维护，让进行中的维护尽快停下；
+        已经进入空闲模式时在后台重建，期间到来的请求会等待重建完成。
+        """
+        with self._state_lock:
+            self._maintenance_stop.set()
+            if self._idle_timer:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            if self._maintenance_timer:
+                self._maintenance_timer.cancel()
+                self._maintenance_timer = None
+            idle = self._idle
+            if idle:
+                self._idle = False
+                self._ready.clear()
+        if idle:
+            threading.Thread(target=self._leave_idle, name="idle-wake", daemon=True).start()
+
+    def _enter_idle(self):
+        """
+        空闲模式：释放 LLM 客户端（连接池）、所有 chain、回答缓存和数据库连接（连同 SQLite 的页缓存），
+        并清空前端的聊天 DOM。会话 ID 和角色保留下来，恢复时从数据库重新加载最近的消息。
+        """
+        from process_memory import current_rss_mb, release_free_memory
+
+        with self._state_lock:
+            # 计时器触发的同时窗口被显示了，放弃这次进入
+            if self._idle_timer is not threading.current_thread():
+                return
+            self._idle_timer = None
+            if not self._ready.is_set() or not self.llm:
+                return
+            if self._executor.is_busy():
+                # 还有请求在进行（例如隐藏窗口后仍在生成的回答），稍后再试
+                logging.info("Requests still running, postponing idle mode.")
+                self._schedule_idle()
+                return
+            self._idle = True
+            self._idle_entered.clear()
             self.llm = None
             self.chain_with_history = None
+            self._chains = {}
+
+        try:
+            rss_before = current_rss_mb()
+            self._clients.close()
+            if self._response_cache:
+                self._response_cache.close()
+                self._response_cache = None
+            self._history_store.close()
+            self._evaluate_js("enterIdle()")
+            release_free_memory()
+            logging.info(f"Entered idle mode: RSS {rss_before:.1f} MB -> {current_rss_mb():.1f} MB.")
+        finally:
+            self._idle_entered.set()
+
+    def _leave_idle(self):
+        """在后台线程中按空闲前的会话和角色重建 LLM 和 chain，并把最近一页消息重新渲染到前端。"""
+        from process_memory import current_rss_mb
+
+        # 窗口在进入空闲的释放过程中被显示时，等释放和前端清空完成后再重建
+        self._idle_entered.wait()
+        started_at = time.perf_counter()
+        rss_before = current_rss_mb()
+        with self._state_lock:
+            session_id = self.session_id
+            profile_name = self.profile_name if self.profile_name in self.prompts else "default"
+        try:
+            endpoints = self._get_endpoints()
+            if endpoints:
+                llm = self._build_llm(endpoints)
+                system_prompt = self.prompts.get(profile_name, {}).get("prompt", "You are a helpful assistant.")
+                chain_with_history = self._get_chain(profile_name, system_prompt, llm)
+                with self._state_lock:
+                    self.llm = llm
+                    self.chain_with_history = chain_with_history
+                    self.profile_name = profile_name
+            # 数据库连接按需重新打开；最近一页之前的消息由前端向上滚动时按页加载
+            page = self._history_page(session_id) if session_id else None
+            self._evaluate_js(f"leaveIdle({json.dumps(session_id)}, {json.dumps(page)})")
+        except Exception as e:
+            logging.error(f"Failed to rebuild after idle mode: {e}")
+        finally:
+            self._ready.set()
+        logging.info(
+            f"Left idle mode in {(time.perf_counter() - started_at) * 1000:.0f} ms: "
+            f"RSS {rss_before:.1f} MB -> {current_rss_mb():.1f} MB."
+        )
+        self.prewarm_connection()
+
+    def _get_endpoints(self):
+        """
+        返回按优先级排列的接口列表 [(model_name, api_key, base_url), ...]，没有 API Key 的条目会被忽略。
+        secrets.json 中的 endpoints 列表不为空时使用它（每一项可以省略 model_name，沿用顶层的设置），
+        否则只使用顶层的 model_name / api_key / base_url。
+        """
+        endpoints = [
+            (endpoint.get("model_name") or self.settings.get("model_name"), endpoint.get("api_key"), endpoint.get("base_url"))
+            for endpoint in self.settings.get("endpoints") or []
+        ]
+        if not endpoints:
+            endpoints = [(self.settings.get("model_name"), self.settings.get("api_key"), self.settings.get("base_url"))]
+        return [endpoint for endpoint in endpoints if endpoint[1]]
+
+    def _get_response_cache(self):
+        """懒创建回答缓存；修改缓存相关设置后会用新的参数重新打开。"""
+        from response_cache import ResponseCache
+
+        max_entries = self.settings.get("response_cache_max_entries", 1000)
+        ttl_seconds = self.settings.get("response_cache_ttl_seconds", 604800)
+        cache = self._response_cache
+        if cache and (cache.max_entries, cache.ttl_seconds) == (max_entries, ttl_seconds):
+            return cache
+        if cache:
+            cache.close()
+        self._response_cache = ResponseCache(cache_db_path, max_entries, ttl_seconds)
+        return self._response_cache
+
+    def get_cache_stats(self):
+        """返回回答缓存的命中/未命中计数，缓存未开启时返回 None。"""
+        if not self._response_cache:
+            return None
+        return self._response_cache.stats()
+
+    def get_metrics_summary(self):
+        """设置页面调用：返回最近若干轮对话各阶段耗时的 p50/p95/p99，未开启计时时返回 None。"""
+        if not self._metrics:
+            return None
+        return self._metrics.summary()
+
+    def prewarm_connection(self):
+        """
+        窗口被唤出时调用：在后台线程里预热到 base_url 的连接，用户打字的这段时间正好完成握手。
+        由 prewarm_min_interval_seconds 限流，且永远不会阻塞调用方。
+        """
+        if not self.settings.get("prewarm_on_show", True) or not self._ready.is_set() or not self.llm:
+            return
+        now = time.monotonic()
+        if now - self._last_prewarm_at < self.settings.get("prewarm_min_interval_seconds", 60):
+            return
+        self._last_prewarm_at = now
+
+        endpoints = self._get_endpoints()
+
+        def warm_up():
+            # 配置了多个接口时全部预热，对冲或故障转移时备用接口同样不需要重新握手
+            for model_name, api_key, base_url in endpoints:
+                elapsed = self._clients.warm_up(model_name, api_key, base_url)
+                if elapsed is not None:
+                    self._last_prewarm_done_at = time.monotonic()
+                    logging.info(f"Connection to {base_url or 'default endpoint'} pre-warmed in {elapsed * 1000:.0f} ms.")
+
+        threading.Thread(target=warm_up, name="prewarm", daemon=True).start()
+
+    def _get_chain(self, profile_name, system_prompt, llm):
+        """
+        返回某个角色的 chain，已经构建过且提示词、LLM 和历史窗口设置都没变时直接复用。
+        在设置里修改了该角色的提示词后，指纹不同，下次使用时会自动重建。
+        """
+        fingerprint = (
+            system_prompt,
+            id(llm),
+            self.settings.get("history_max_tokens", 4000),
+            self.settings.get("history_keep_last_turns", 20),
+        )
+        cached = self._chains.get(profile_name)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        chain_with_history = self._create_chain(system_prompt, llm, profile_name)
+        self._chains[profile_name] = (fingerprint, chain_with_history)
+        logging.info(f"Built chain for prompt profile '{profile_name}'.")
+        return chain_with_history
 
-    def _create_chain(self, system_prompt, llm):
+    def _create_chain(self, system_prompt, llm, profile_name="default"):
         """
         一个私有方法，用于根据提供的 system_prompt 创建一个完整的、带历史记录的 chain。
         将其独立出来，方便在切换 prompt 时重复调用。
         现在它接收 llm 作为参数并返回一个新的 chain 实例，而不是修改 self.chain_with_history。
         """
+        from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+        from langchain_core.runnables import ConfigurableFieldSpec
+        from langchain_core.runnables.history import RunnableWithMessageHistory
+        from history_store import count_tokens, MESSAGE_TOKEN_OVERHEAD
+
         # 1. 基于传入的 system_prompt 创建 Prompt Template
         prompt = ChatPromptTemplate.from_messages(
             [
@@ -98,16 +539,152 @@ class Api:
         
         # 2. 创建基础的 Chain
         chain = prompt | llm
-        
-        # 3. 创建并返回带历史记录的 Chain
+
+        # 3. 计算历史窗口的预算：history_max_tokens 包含 system prompt 和这次的问题，
+        #    它们总是完整发送，剩下的额度才分给历史消息；问题的 token 数由 _run_turn 通过 config 传入
+        max_tokens = self.settings.get("history_max_tokens", 4000)
+        max_turns = self.settings.get("history_keep_last_turns", 20)
+        history_budget = None
+        if max_tokens:
+            system_tokens = count_tokens(system_prompt) + MESSAGE_TOKEN_OVERHEAD
+            history_budget = max(max_tokens - system_tokens, 1)
+            logging.info(f"System prompt uses {system_tokens} tokens, history budget is {history_budget} tokens.")
+
+        def get_session_history(session_id, question_tokens):
+            # 问题本身就占满了预算时，预算为 1，get_window 放不下任何一轮，返回空的历史
+            budget = max(history_budget - question_tokens, 1) if history_budget else None
+            return self._get_session_history(session_id, budget, max_turns, profile_name)
+
+        # 4. 创建并返回带历史记录的 Chain
         return RunnableWithMessageHistory(
             chain,
-            lambda session_id: SQLChatMessageHistory(
-                session_id=session_id, connection_string="sqlite:///chat_history.db"
-            ),
+            get_session_history,
             input_messages_key="question",
             history_messages_key="history",
+            history_factory_config=[
+                ConfigurableFieldSpec(id="session_id", annotation=str, is_shared=True),
+                # 必填：RunnableWithMessageHistory 在 configurable 缺少任何一个键时都会报错，由 _run_turn 传入
+                ConfigurableFieldSpec(id="question_tokens", annotation=int, is_shared=True),
+            ],
+        )
+
+    def _get_session_history(self, session_id, max_tokens=None, max_turns=None, profile=None):
+        """
+        返回指定会话的历史记录对象，chain 和重新生成逻辑共用。
+        chain 会传入窗口参数，只读取预算内的最近历史；其他地方拿到的是完整历史。
+        """
+        from history_store import SQLiteChatMessageHistory
+
+        return SQLiteChatMessageHistory(self._history_store, session_id, max_tokens, max_turns, profile)
+
+    def search_history(self, query, limit=20, offset=0):
+        """
+        前端“历史”弹窗调用：在所有会话中全文搜索，返回一页结果（排序规则见 ChatHistoryStore.search）。
+        摘要中的命中部分用 \u0002 / \u0003 标记，由前端转义后再高亮。
+        """
+        self._store_ready.wait()
+        if not self._history_store:
+            return {"results": [], "has_more": False}
+        started_at = time.perf_counter()
+        results, has_more = self._history_store.search(query, limit, offset)
+        for result in results:
+            result["profile_name"] = self._profile_display_name(result["profile"])
+        logging.info(f"History search for {query!r}: {len(results)} hits in {(time.perf_counter() - started_at) * 1000:.1f} ms")
+        return {"results": results, "has_more": has_more}
+
+    def list_sessions(self, limit=20, offset=0):
+        """前端“历史”弹窗调用：按最近更新时间倒序返回一页会话。"""
+        self._store_ready.wait()
+        if not self._history_store:
+            return {"sessions": [], "has_more": False}
+        sessions, has_more = self._history_store.list_sessions(limit, offset)
+        for session in sessions:
+            session["profile_name"] = self._profile_display_name(session["profile"])
+        return {"sessions": sessions, "has_more": has_more}
+
+    def rebuild_search_index(self):
+        """从现有的聊天记录重新建立全文索引和会话列表，返回索引的消息数。"""
+        self._store_ready.wait()
+        if not self._history_store:
+            return 0
+        return self._history_store.rebuild_search_index()
+
+    def resume_session(self, session_id, limit=50):
+        """
+        前端“历史”弹窗调用：切换到一个以前的会话继续对话。
+        使用该会话记录的提示词角色（角色已被删除或没有记录时用默认角色），
+        返回最近的一页消息，更早的消息由前端向上滚动时通过 load_history_page 按需加载。
+        初始化还没完成时先返回消息，切换会话排进启动队列，等初始化完成后再执行。
+        """
+        self._store_ready.wait()
+        deferred = self._is_deferred()
+        if not self._history_store or (not deferred and not self.llm):
+            logging.warning("Cannot resume a session because LLM/chain is not initialized.")
+            return None
+        session = self._history_store.get_session(session_id)
+        if session is None:
+            logging.warning(f"Attempted to resume an unknown session: {session_id}")
+            return None
+
+        profile_name = session["profile"] if session["profile"] in self.prompts else "default"
+        if deferred:
+            self._submit_when_ready(
+                lambda request_id, cancel_event: self._switch_session(session_id, profile_name), cancellable=False,
+            )
+        else:
+            self._switch_session(session_id, profile_name)
+        logging.info(
+            f"Resumed session {session_id} ({session['message_count']} messages) with prompt profile '{profile_name}'."
+        )
+
+        page = self._history_page(session_id, None, limit)
+        page.update(session_id=session_id, title=session["title"], profile_name=self._profile_display_name(profile_name))
+        return page
+
+    def _switch_session(self, session_id, profile_name):
+        """把当前会话切换到 session_id，并使用 profile_name 角色的 chain。"""
+        if not self.llm:
+            logging.warning(f"Cannot switch to session {session_id} because LLM/chain is not initialized.")
+            return
+        system_prompt = self.prompts.get(profile_name, {}).get("prompt", "You are a helpful assistant.")
+        chain_with_history = self._get_chain(profile_name, system_prompt, self.llm)
+        with self._state_lock:
+            self.session_id = session_id
+            self.chain_with_history = chain_with_history
+            self.profile_name = profile_name
+
+    def load_history_page(self, session_id, before_id=None, limit=50):
+        """
+        返回会话中 id < before_id 的最近一页消息（before_id 为 None 时从最新开始），按时间顺序排列。
+        前端把返回的 before_id 传回来即可继续向前翻页，has_more 为 False 时说明已经到了会话开头。
+        """
+        self._store_ready.wait()
+        return self._history_page(session_id, before_id, limit)
+
+    def _history_page(self, session_id, before_id=None, limit=50):
+        from history_store import message_text
+
+        if not self._history_store:
+            return {"messages": [], "has_more": False, "before_id": None}
+        started_at = time.perf_counter()
+        page, has_more = self._history_store.get_page(session_id, before_id, limit)
+        logging.info(
+            f"Loaded {len(page)} messages of session {session_id} before id {before_id} "
+            f"in {(time.perf_counter() - started_at) * 1000:.1f} ms"
         )
+        return {
+            "messages": [
+                {"id": message_id, "type": message.type, "content": message_text(message.content)}
+                for message_id, message in page
+            ],
+            "has_more": has_more,
+            "before_id": page[0][0] if page else before_id,
+        }
+
+    def _profile_display_name(self, profile):
+        if not profile:
+            return ""
+        return self.prompts.get(profile, {}).get("name", profile)
 
     def get_settings(self):
         """从 secrets.json 加载设置并返回一个字典。"""
@@ -121,7 +698,10 @@ class Api:
             return {} # 返回空字典以避免崩溃
 
     def save_settings(self, settings_data):
-        """从前端接收一个字典并将其保存到 secrets.json。"""
+        """
+        从前端接收一个字典并将其保存到 secrets.json。
+        文件立即写入；需要重新初始化 LLM 时，如果后台初始化还没完成，就排进启动队列等它完成后再执行，避免两边同时初始化。
+        """
         try:
             # 在保存前，确保所有必要的键都存在
             current_settings = self.get_settings()
@@ -131,13 +711,22 @@ class Api:
                 json.dump(current_settings, f, indent=4)
             logging.info(f"Settings saved: {current_settings}")
             
-            # 保存后，重新加载 LLM 以应用新设置
+            # 保存后，只有和 LLM 相关的设置变化时才重新加载 LLM，
+            # 修改快捷键这类无关设置不会打断当前会话，也不会丢掉已建立的连接
+            previous_settings = self.settings
             self.settings = current_settings
-            self._try_initialize_llm() # 尝试用新设置重新初始化
-            logging.info("LLM re-initialized with new settings.")
+            if any(previous_settings.get(key) != current_settings.get(key) for key in LLM_SETTING_KEYS):
+                if self._is_deferred():
+                    self._submit_when_ready(lambda request_id, cancel_event: self._reinitialize_llm(), cancellable=False)
+                else:
+                    self._reinitialize_llm()
         except Exception as e:
             logging.error(f"Could not save settings to {secret_path}: {e}")
     
+    def _reinitialize_llm(self):
+        self._try_initialize_llm() # 尝试用新设置重新初始化
+        logging.info("LLM re-initialized with new settings.")
+
     def get_prompts(self):
         """从 prompts.json 加载所有提示词。"""
         try:
@@ -172,6 +761,7 @@ class Api:
         try:
             if prompt_id in self.prompts and prompt_id != "default":
                 del self.prompts[prompt_id]
+                self._chains.pop(prompt_id, None)
                 with open(prompt_path, 'w', encoding='utf-8') as f:
                     json.dump(self.prompts, f, indent=4, ensure_ascii=False)
                 logging.info(f"Prompt '{prompt_id}' deleted.")
@@ -185,6 +775,8 @@ class Api:
 
     def change_hotkey(self, new_hotkey):
         """动态更改并保存快捷键。"""
+        import keyboard
+
         global hotkey
         try:
             logging.info(f"Attempting to change hotkey from '{hotkey}' to '{new_hotkey}'")
@@ -208,7 +800,16 @@ class Api:
         """
         这是一个可以被JavaScript调用的公共方法。
         它会根据传入的 profile_name 从 PROMPT_TEMPLATES 字典中查找对应的 system_prompt，
+        后台初始化还没完成时排进启动队列，等初始化完成后再切换。
         """
+        if self._is_deferred():
+            self._submit_when_ready(
+                lambda request_id, cancel_event: self._set_prompt_profile(profile_name), cancellable=False,
+            )
+            return
+        self._set_prompt_profile(profile_name)
+
+    def _set_prompt_profile(self, profile_name):
         # 现在从加载的 prompts 字典中获取
         prompt_data = self.prompts.get(profile_name)
 
@@ -221,9 +822,13 @@ class Api:
 
         if prompt_data and 'prompt' in prompt_data:
             system_prompt = prompt_data['prompt']
+            chain_with_history = self._get_chain(profile_name, system_prompt, self.llm)
             # 当切换 prompt 时，我们创建一个新的会话ID，以开启一段全新的对话
-            self.session_id = time.strftime("%Y%m%d%H%M%S", time.localtime())
-            self.chain_with_history = self._create_chain(system_prompt, self.llm)
+            # 正在进行中的请求持有旧会话的快照，不受这里切换的影响
+            with self._state_lock:
+                self.session_id = time.strftime("%Y%m%d%H%M%S", time.localtime())
+                self.chain_with_history = chain_with_history
+                self.profile_name = profile_name
             logging.info(f"Prompt profile set to '{profile_name}'. New session started: {self.session_id}")
             
             # 通知前端AI角色已经成功切换
@@ -236,93 +841,394 @@ class Api:
 
 
     def regenerate_response(self):
-        """重新生成上一条AI回答"""
-        if not self.session_id:
+        """
+        重新生成上一条AI回答。
+        修剪历史和重新生成都放到该会话的请求队列里执行，保证不会和进行中的请求交错。
+        返回 request_id，前端可以用它来取消。
+        """
+        if self._is_deferred():
+            return self._submit_when_ready(
+                lambda request_id, cancel_event: self._run_prepared(self._prepare_regenerate(), request_id, cancel_event)
+            )
+        prepared = self._prepare_regenerate()
+        return self._executor.submit(*prepared) if prepared else None
+
+    def _prepare_regenerate(self):
+        """取会话和 chain 的快照，返回 (session_id, fn)；无法重新生成时返回 None。"""
+        with self._state_lock:
+            session_id = self.session_id
+            chain = self.chain_with_history
+
+        if not session_id:
             logging.warning("No active session to regenerate from.")
+            return None
+
+        # 和 process_input 一样先检查 chain，否则后台会先删掉最后一轮再因为 chain 为空而失败
+        if not chain:
+            error_message = "AI功能尚未初始化，请在“设置”中配置有效的API Key。"
+            if self._window:
+                self._window.evaluate_js(f"addMessageToChat({json.dumps(error_message)}, 'system')")
+            return None
+
+        return session_id, lambda request_id, cancel_event: self._regenerate(session_id, chain, request_id, cancel_event)
+
+    def _run_prepared(self, prepared, request_id, cancel_event):
+        """在启动队列里执行准备好的请求；准备失败（例如 chain 未初始化）时直接通知前端这个请求已结束。"""
+        if prepared is None:
+            self._evaluate_js(f"requestFinished({json.dumps(request_id)})")
             return
+        prepared[1](request_id, cancel_event)
 
-        history = SQLChatMessageHistory(
-            session_id=self.session_id, connection_string="sqlite:///chat_history.db"
-        )
-        
-        messages = history.messages
-        
-        # 我们需要找到最后一条人类消息。如果找不到，或者历史记录为空，则无法重新生成。
+    def _regenerate(self, session_id, chain, request_id, cancel_event):
+        """在后台线程中执行的重新生成逻辑。"""
+        from long_input import HISTORY_MARKER
+
+        history = self._get_session_history(session_id)
+
+        # 倒序查找最后一条人类消息，只读取这一条，而不是把整段会话都加载出来
         last_user_message_content = None
-        # 从后往前找，找到第一个 'human' 消息
-        for i in range(len(messages) - 1, -1, -1):
-            if messages[i].type == 'human':
-                # 找到了，记录下它的内容
-                last_user_message_content = messages[i].content
-                # 确定需要保留的消息是这条人类消息之前的所有消息
-                messages_to_keep = messages[:i]
-                
-                # 现在，我们安全地修改数据库中的历史记录
-                # 1. 清空当前会话的全部历史
-                history.clear()
-                # 2. 将我们想保留的消息重新加回去
-                if messages_to_keep:
-                    history.add_messages(messages_to_keep)
-                
-                # 找到后就可以跳出循环了
-                break
+        last_human = history.get_last_human_message()
+        if last_human and last_human[1].additional_kwargs.get(HISTORY_MARKER):
+            # 长文本在历史里只保存了开头的预览，拿预览重新生成只会得到一个不相干的回答
+            logging.warning("The last turn was a long input; only its preview is stored, refusing to regenerate.")
+            notice = "上一轮是长文本输入，聊天记录中只保存了开头部分，无法重新生成。请重新发送完整内容。"
+            self._evaluate_js(f"addMessageToChat({json.dumps(notice)}, 'system')")
+            self._evaluate_js(f"requestFinished({json.dumps(request_id)})")
+            return
+        if last_human:
+            message_id, message = last_human
+            last_user_message_content = message.content
+            # 在一个事务里删除这条人类消息及其之后的所有消息（通常就是最后一轮问答），
+            # 不再需要先清空整段历史再写回去
+            history.truncate(message_id)
         
         # 如果成功找到了最后的用户消息...
         if last_user_message_content:
-            # ...就用它的内容重新调用 process_input
+            # ...就用它的内容重新执行一轮对话
             logging.info(f"Regenerating response for: {last_user_message_content}")
             # 因为我们已经修剪了数据库中的历史记录，
-            # 所以现在调用 process_input 会将这条人类消息和新的AI回答追加到正确的历史末尾。
-            self.process_input(last_user_message_content)
+            # 所以现在会将这条人类消息和新的AI回答追加到正确的历史末尾。
+            # 重新生成必须跳过回答缓存，否则会拿到一模一样的回答
+            self._run_turn(
+                last_user_message_content, session_id, chain, request_id, cancel_event,
+                skip_cache=True, kind="regenerate",
+            )
         else:
-            # 如果循环结束都没找到，说明历史记录里一条用户消息都没有
+            # 没找到，说明历史记录里一条用户消息都没有
             logging.warning("Could not find the last user message to regenerate.")
-            if self._window:
-                message = json.dumps("没有可以重新生成的消息。")
-                self._window.evaluate_js(f"addMessageToChat({message}, 'system')")
+            self._evaluate_js(f"addMessageToChat({json.dumps('没有可以重新生成的消息。')}, 'system')")
+            self._evaluate_js(f"requestFinished({json.dumps(request_id)})")
 
     ## 前端调用
     def process_input(self, text):
-        """这个方法会被 JS 调用"""
+        """
+        这个方法会被 JS 调用。
+        请求会被提交到后台执行器，这里立即返回 request_id，不阻塞桥接线程。
+        """
         logging.info(f"Python 收到了来自 JS 的消息: {text}")
+
+        # 启动后立刻发送的消息排进启动队列，由工作线程等待后台初始化完成后再取快照
+        if self._is_deferred():
+            return self._submit_when_ready(
+                lambda request_id, cancel_event: self._run_prepared(self._prepare_input(text), request_id, cancel_event)
+            )
+        prepared = self._prepare_input(text)
+        return self._executor.submit(*prepared) if prepared else None
+
+    def _prepare_input(self, text):
+        """取会话和 chain 的快照，返回 (session_id, fn)；chain 未初始化时提示用户并返回 None。"""
+        # 在锁内取一份会话和 chain 的快照，之后切换角色不会影响这次请求
+        with self._state_lock:
+            session_id = self.session_id
+            chain = self.chain_with_history
+            llm = self.llm
+            profile_name = self.profile_name
         
         # 增加前置检查，如果chain未初始化，则提示用户
-        if not self.chain_with_history:
+        if not chain:
             error_message = "AI功能尚未初始化，请在“设置”中配置有效的API Key。"
             if self._window:
                 self._window.evaluate_js(f"addMessageToChat({json.dumps(error_message)}, 'system')")
-            return
+            return None
 
+        long_input = self._long_input_processor(text, llm, profile_name)
+        return session_id, lambda request_id, cancel_event: self._run_turn(
+            text, session_id, chain, request_id, cancel_event, long_input=long_input, profile_name=profile_name,
+        )
+
+    def _long_input_processor(self, text, llm, profile_name):
+        """
+        输入超过 long_input_threshold_tokens（0 表示关闭）时，返回一个按当前角色分段并行处理的 LongInputProcessor，
+        否则返回 None，照常整段发送。
+        """
+        from history_store import count_tokens
+        from long_input import LongInputProcessor
+
+        threshold = self.settings.get("long_input_threshold_tokens", 6000)
+        if not threshold or count_tokens(text) <= threshold:
+            return None
+        system_prompt = self.prompts.get(profile_name, {}).get("prompt", "You are a helpful assistant.")
+        return LongInputProcessor(
+            llm,
+            system_prompt,
+            chunk_tokens=self.settings.get("long_input_chunk_tokens", 2000),
+            concurrency=self.settings.get("long_input_concurrency", 4),
+            reduce=self.settings.get("long_input_reduce", False),
+        )
+
+    def cancel_request(self, request_id=None):
+        """“停止生成”按钮调用。不传 request_id 时取消所有排队中和进行中的请求。"""
+        cancelled = self._executor.cancel(request_id)
+        logging.info(f"Cancel requested for {request_id or 'all requests'}, {cancelled} request(s) affected.")
+        return cancelled
+
+    def _run_turn(self, text, session_id, chain, request_id, cancel_event, skip_cache=False, kind="turn",
+                  long_input=None, profile_name=None):
+        """
+        在后台线程中执行一轮完整的对话，结束后通知前端该请求已完成，并记录各阶段耗时。
+        传入 long_input 时按分段并行的方式处理这次输入，profile_name 用于记录新会话所属的角色。
+        """
+        from history_store import count_tokens, MESSAGE_TOKEN_OVERHEAD
+        from metrics import TurnTimer
+
+        timer = TurnTimer(request_id, session_id, "long_input" if long_input else kind)
+        # 历史窗口的预算要扣掉这次问题本身的 token 数
+        configurable = {
+            "session_id": session_id,
+            "question_tokens": count_tokens(text) + MESSAGE_TOKEN_OVERHEAD,
+            "skip_cache": skip_cache,
+        }
+        config = {"configurable": configurable, "callbacks": [timer]}
+        try:
+            if long_input:
+                self._long_input_response(
+                    text, session_id, long_input, profile_name, config, request_id, cancel_event, timer,
+                )
+            elif self.settings.get("stream", True):
+                self._stream_response(text, session_id, chain, config, request_id, cancel_event, timer)
+            else:
+                self._invoke_response(text, chain, config, timer)
+        finally:
+            self._last_activity_at = time.monotonic()
+            self._evaluate_js(f"requestFinished({json.dumps(request_id)})", timer)
+            if self._metrics:
+                self._metrics.record(timer)
+
+    def _invoke_response(self, text, chain, config, timer):
+        """非流式调用。invoke 一旦发出就无法中途取消，只有还在排队的请求可以被取消。"""
         # 调用 LangChain 并传入 session_id
         try:
-            response = self.chain_with_history.invoke(
-                {"question": text},
-                config={"configurable": {"session_id": self.session_id}}
-            )
+            response = chain.invoke({"question": text}, config=config)
+            # invoke 返回时历史记录已经写完
+            timer.mark("done")
             logging.info(f"LangChain 响应: {response.content}")
+            if getattr(response, "usage_metadata", None):
+                logging.info(f"Token usage: {response.usage_metadata}")
         except Exception as e:
             logging.error(f"LangChain 调用失败: {str(e)}")
-            if self._window:
-                # 构造一个用户友好的错误消息，并将其发送到前端
-                error_message = f"抱歉，AI 响应失败。\n请检查您的网络连接和 API 设置是否正确。如果您是首次使用本软件，请右键托盘的设置选项，进行配置。\n错误详情: {e}"
-                js_error_message = json.dumps(error_message)
-                try:
-                    self._window.evaluate_js(f"addMessageToChat({js_error_message}, 'system')")
-                except Exception as eval_e:
-                    logging.error(f"向前端发送错误消息失败: {eval_e}")
+            timer.status = "error"
+            self._show_error(e)
             return  # 提前返回，避免后续错误
         
-        response_text = response.content
+        # 使用 json.dumps 为 JS 安全地转义字符串，这能正确处理引号、换行符等
+        if self._evaluate_js(f"addMessageToChat({json.dumps(response.content)}, 'ai')", timer):
+            logging.info("成功调用 evaluate_js，已将AI响应发送到前端。")
+
+    def _stream_response(self, text, session_id, chain, config, request_id, cancel_event, timer):
+        """
+        流式调用 chain，并把增量文本分批推送到前端正在生成的那条消息里。
+        历史记录由 RunnableWithMessageHistory 在流结束（包括被取消后关闭）时写入。
+        只有取消后 chain 没有写入这一轮时，才手动把问题和已生成的部分回答写入历史，避免同一轮被保存两次。
+        """
+        from langchain_core.messages import HumanMessage, AIMessage
+        from long_input import CANCEL_POLL_SECONDS
+
+        js_request_id = json.dumps(request_id)
+        batcher = StreamBatcher(
+            lambda delta: self._evaluate_js(f"appendToStreamingMessage({js_request_id}, {json.dumps(delta)})", timer),
+            flush_ms=self.settings.get("stream_flush_ms", 50),
+            flush_chars=self.settings.get("stream_flush_chars", 200),
+        )
+        parts = []
+        usage = None
+        started_at = time.monotonic()
+        first_token_at = None
+        cancelled = False
+
+        history = self._get_session_history(session_id)
+        last_human = history.get_last_human_message()
+        last_human_id = last_human[0] if last_human else None
 
-        if self._window:
-            # 使用 json.dumps 为 JS 安全地转义字符串，这能正确处理引号、换行符等
-            js_response_text = json.dumps(response_text)
+        self._evaluate_js(f"startStreamingMessage({js_request_id})", timer)
+        stream = chain.stream({"question": text}, config=config)
+        chunks = queue.Queue()
+        stop_event = threading.Event()
+
+        def read_stream():
+            # 在单独的线程里读取流，等待下一个 chunk（包括迟迟不来的首字节）时也能按时检查取消；
+            # 流正常结束时放入 None，出错时放入异常
             try:
-                # 注意 js_response_text 已经包含了引号，所以 f-string 中不再需要额外的引号
-                self._window.evaluate_js(f"addMessageToChat({js_response_text}, 'ai')")
-                logging.info("成功调用 evaluate_js，已将AI响应发送到前端。")
+                for chunk in stream:
+                    if stop_event.is_set():
+                        break
+                    chunks.put(chunk)
+                chunks.put(None)
             except Exception as e:
-                logging.error(f"evaluate_js 调用失败: {str(e)}")
+                chunks.put(e)
+            finally:
+                # 主动关闭生成器，中止底层的 HTTP 流；生成器只能由迭代它的线程关闭
+                stream.close()
+
+        reader = threading.Thread(target=read_stream, name="stream-reader", daemon=True)
+        reader.start()
+        try:
+            while not cancel_event.is_set():
+                try:
+                    chunk = chunks.get(timeout=CANCEL_POLL_SECONDS)
+                except queue.Empty:
+                    continue
+                if chunk is None:
+                    # 流正常结束时 RunnableWithMessageHistory 已经把这一轮写入了历史
+                    timer.mark("done")
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                # 部分服务商会在最后一个 chunk 里附带本次请求实际消耗的 token 数
+                if getattr(chunk, "usage_metadata", None):
+                    usage = chunk.usage_metadata
+                if not chunk.content:
+                    continue
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                    idle = started_at - self._last_activity_at
+                    prewarmed = self._last_prewarm_done_at > self._last_activity_at
+                    logging.info(
+                        f"首个 token 用时: {first_token_at - started_at:.2f}s "
+                        f"(空闲 {idle:.0f}s 后的请求, 已预热连接: {'是' if prewarmed else '否'})"
+                    )
+                parts.append(chunk.content)
+                batcher.push(chunk.content)
+            else:
+                cancelled = True
+            batcher.flush()
+        except Exception as e:
+            logging.error(f"LangChain 调用失败: {str(e)}")
+            timer.status = "error"
+            batcher.flush()
+            self._evaluate_js(f"finishStreamingMessage({js_request_id})", timer)
+            self._show_error(e)
+            return
+        finally:
+            # 取消时读取线程在下一个 chunk 处停下并关闭流
+            stop_event.set()
+
+        response_text = "".join(parts)
+        if cancelled:
+            logging.info(f"Request {request_id} cancelled after {len(response_text)} characters.")
+            timer.status = "cancelled"
+
+            def save_cancelled_turn(*_):
+                # 流关闭之后才能确定 chain 有没有写入这一轮（取消前流恰好结束时它会写入）
+                reader.join()
+                last_human = history.get_last_human_message()
+                saved_by_chain = last_human is not None and last_human[0] != last_human_id
+                if response_text and not saved_by_chain:
+                    history.add_messages([HumanMessage(content=text), AIMessage(content=response_text)])
+
+            reader.join(CANCEL_POLL_SECONDS)
+            if reader.is_alive():
+                # 读取线程还在等服务端的数据：这次请求先结束，补写历史排在同一队列的最前面，
+                # 之后的请求仍然能按顺序看到这一轮
+                self._executor.submit_after(request_id, save_cancelled_turn)
+            else:
+                with timer.span("history_write"):
+                    save_cancelled_turn()
+            stopped_note = json.dumps("\n\n*（已停止生成）*")
+            self._evaluate_js(f"appendToStreamingMessage({js_request_id}, {stopped_note})", timer)
+
+        self._evaluate_js(f"finishStreamingMessage({js_request_id})", timer)
+        logging.info(f"LangChain 响应 (总用时 {time.monotonic() - started_at:.2f}s): {response_text}")
+        if usage:
+            logging.info(f"Token usage: {usage}")
+
+    def _long_input_response(self, text, session_id, processor, profile_name, config, request_id, cancel_event, timer):
+        """
+        长文本的分段并行处理，结果按段落顺序流式推送到前端（无论 stream 设置如何）。
+        聊天记录里只写入精简的一轮：输入的预览和分段信息，以及最终的回答，各段的中间结果不写入。
+        """
+        js_request_id = json.dumps(request_id)
+        batcher = StreamBatcher(
+            lambda delta: self._evaluate_js(f"appendToStreamingMessage({js_request_id}, {json.dumps(delta)})", timer),
+            flush_ms=self.settings.get("stream_flush_ms", 50),
+            flush_chars=self.settings.get("stream_flush_chars", 200),
+        )
+        parts = []
+        started_at = time.monotonic()
+
+        chunk_count = processor.split(text)
+        notice = f"输入较长，已拆分为 {chunk_count} 段并行处理" + ("，处理完成后合并结果。" if processor.reduce else "。")
+        self._evaluate_js(f"addMessageToChat({json.dumps(notice)}, 'system')", timer)
+        self._evaluate_js(f"startStreamingMessage({js_request_id})", timer)
+        try:
+            for delta in processor.stream(cancel_event, config):
+                parts.append(delta)
+                batcher.push(delta)
+            batcher.flush()
+        except Exception as e:
+            logging.error(f"长文本分段处理失败: {str(e)}")
+            timer.status = "error"
+            batcher.flush()
+            self._evaluate_js(f"finishStreamingMessage({js_request_id})", timer)
+            self._show_error(e)
+            return
+
+        response_text = "".join(parts)
+        cancelled = cancel_event.is_set()
+        if cancelled:
+            logging.info(f"Request {request_id} cancelled after {len(response_text)} characters.")
+            timer.status = "cancelled"
+            stopped_note = json.dumps("\n\n*（已停止生成）*")
+            self._evaluate_js(f"appendToStreamingMessage({js_request_id}, {stopped_note})", timer)
+        if response_text or not cancelled:
+            with timer.span("history_write"):
+                history = self._get_session_history(session_id, profile=profile_name)
+                history.add_messages(processor.history_messages(text, response_text))
+        timer.mark("done")
+
+        self._evaluate_js(f"finishStreamingMessage({js_request_id})", timer)
+        logging.info(
+            f"长文本处理完成 ({chunk_count} 段, 总用时 {time.monotonic() - started_at:.2f}s, "
+            f"回答 {len(response_text)} 个字符)"
+        )
+
+    def _evaluate_js(self, script, timer=None):
+        """
+        安全地调用前端 JS，窗口不存在或调用失败时只记录日志。返回是否调用成功。
+        传入 timer 时，调用耗时会累加到这一轮的 ui_dispatch 上。
+        """
+        if not self._window:
+            return False
+        started_at = time.perf_counter()
+        try:
+            self._window.evaluate_js(script)
+            return True
+        except Exception as e:
+            logging.error(f"evaluate_js 调用失败: {str(e)}")
+            return False
+        finally:
+            if timer:
+                timer.add("ui_dispatch", time.perf_counter() - started_at)
+
+    def _show_error(self, e):
+        """构造一个用户友好的错误消息，并将其发送到前端。"""
+        if not self._window:
+            return
+        error_message = f"抱歉，AI 响应失败。\n请检查您的网络连接和 API 设置是否正确。如果您是首次使用本软件，请右键托盘的设置选项，进行配置。\n错误详情: {e}"
+        js_error_message = json.dumps(error_message)
+        try:
+            self._window.evaluate_js(f"addMessageToChat({js_error_message}, 'system')")
+        except Exception as eval_e:
+            logging.error(f"向前端发送错误消息失败: {eval_e}")
 
 
 api = Api()
@@ -338,6 +1244,8 @@ hotkey = "ctrl+shift+a"  # 提供一个默认值
 
 def open_settings_window():
     """创建并显示设置窗口，如果它不存在的话。"""
+    import webview
+
     global settings_window
     if settings_window is None:
         # 创建一个全新的窗口实例，并传入 js_api
@@ -380,6 +1288,7 @@ def on_closing():
         window.hide()
         # 手动更新我们自己的状态变量
         is_window_visible = False
+        api.on_window_hidden()
     # 返回 False 会取消默认的关闭事件，从而阻止应用退出
     # 如果希望在某些情况下（例如从托盘菜单选择退出）能真正关闭，可以在这里加入判断逻辑
     return False 
@@ -394,12 +1303,18 @@ def toggle_window():
         # 使用我们自己的状态变量来判断
         if not is_window_visible:
             logging.info("Window state is 'hidden', showing it.")
+            # 从空闲模式恢复和预热连接都在后台进行，不会拖慢窗口的显示
+            api.on_window_shown()
+            api.prewarm_connection()
+            shown_at = time.perf_counter()
             window.show()
             is_window_visible = True
+            logging.info(f"Window shown in {(time.perf_counter() - shown_at) * 1000:.1f} ms.")
         else:
             logging.info("Window state is 'visible', hiding it.")
             window.hide()
             is_window_visible = False
+            api.on_window_hidden()
     except Exception as e:
         # 如果窗口已经被销毁，可能会抛出异常
         logging.error(f"Error toggling window: {e}")
@@ -407,6 +1322,9 @@ def toggle_window():
 def setup_tray():
     """设置并运行系统托盘图标。"""
     global tray_icon
+    from PIL import Image
+    import pystray
+
     try:
         image = Image.open(icon_path)
     except FileNotFoundError:
@@ -429,6 +1347,8 @@ def setup_tray():
 
 def start_keyboard_listener():
     """启动全局快捷键监听。"""
+    import keyboard
+
     global hotkey
     # 从配置中读取快捷键
     # 这确保了即使 change_hotkey 失败，重启后也能加载正确的快捷键
@@ -452,12 +1372,13 @@ def post_start(w):
     global window, is_window_visible
     window = w
     api._window = window
+    startup_timer.mark("window shown")
     # 窗口初始是可见的，所以我们在这里同步状态
     is_window_visible = True
     logging.info("Window object has been successfully assigned to the API.")
 
-    # 启动时检查 API Key，如果为空则自动打开设置窗口
-    if not api.settings.get("api_key"):
+    # 启动时检查 API Key（顶层设置或 endpoints 列表中任意一个接口），都没有时自动打开设置窗口
+    if not api._get_endpoints():
         logging.warning("API key is missing. Opening settings window automatically.")
         open_settings_window()
 
@@ -473,15 +1394,76 @@ def post_start(w):
 
 
 def main_display():
+    import webview
+
     global window
+    # LangChain 的导入和 LLM 初始化放到后台线程，先把窗口和托盘显示出来
+    api.start_background_init()
     # 我们将创建的窗口实例直接赋值给全局变量
     window = webview.create_window("SimpleAI", "static/index.html", height=600,width=400, js_api = api, on_top=True)
 
 
     # 订阅 closing 事件。当用户尝试关闭窗口时，会调用 on_closing 函数
     window.events.closing += on_closing
+    # 页面加载完成，用户已经可以输入了
+    window.events.loaded += lambda: startup_timer.mark("window ready")
     logging.info("窗口创建成功")
     webview.start(post_start, window)
 
+def main_batch(argv):
+    """
+    无界面的批处理模式，不创建窗口、托盘和全局快捷键，使用 secrets.json 中的接口设置和 prompts.json 中的角色。
+    用法: python main.py batch input.jsonl output.jsonl [--profile default] [--concurrency 4] [--rpm 0] [--tpm 0]
+    输入输出格式和续跑规则见 batch.BatchRunner。
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="main.py batch", description="Run a prompt profile over a JSONL file.")
+    parser.add_argument("input", help="输入 JSONL，每行一个 JSON 字符串或 {\"id\": ..., \"input\": ...}")
+    parser.add_argument("output", help="输出 JSONL，已存在时跳过其中已完成的条目")
+    parser.add_argument("--profile", default="default", help="prompts.json 中的角色 ID")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rpm", type=int, default=0, help="每分钟最多发出的请求数，0 表示不限")
+    parser.add_argument("--tpm", type=int, default=0, help="每分钟最多消耗的 token 数，0 表示不限")
+    parser.add_argument("--max-retries", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    prompt_data = api.prompts.get(args.profile)
+    if not prompt_data or "prompt" not in prompt_data:
+        logging.error(f"Unknown prompt profile '{args.profile}'. Available: {', '.join(api.prompts)}")
+        return 2
+    endpoints = api._get_endpoints()
+    if not endpoints:
+        logging.error("API key not found. Please configure secrets.json first.")
+        return 2
+
+    import llm_clients
+    from batch import BatchRunner
+
+    # 重试只由 BatchRunner 负责（经过限速器、按 --max-retries 计数），SDK 自带的重试要关掉
+    api._clients = llm_clients.ClientRegistry(max_retries=0)
+    try:
+        runner = BatchRunner(
+            api._build_llm(endpoints),
+            prompt_data["prompt"],
+            concurrency=args.concurrency,
+            rpm=args.rpm,
+            tpm=args.tpm,
+            max_retries=args.max_retries,
+        )
+        logging.info(f"Running batch with prompt profile '{args.profile}' ({prompt_data.get('name', args.profile)}).")
+        stats = runner.run(args.input, args.output)
+    except KeyboardInterrupt:
+        logging.warning(f"Batch interrupted. Run the same command again to resume from {args.output}.")
+        return 130
+    finally:
+        api._clients.close()
+        if api._response_cache:
+            api._response_cache.close()
+    return 1 if stats["failed"] else 0
+
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["batch"]:
+        sys.exit(main_batch(sys.argv[2:]))
     main_display()
\ No newline at end of file
@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+# 每轮对话记录的耗时（毫秒），按请求经过的先后顺序排列
+# - history_read:  读取历史窗口
+# - prompt_render: 渲染提示词模板
+# - request_sent:  从开始处理到请求发出的总耗时（前面各步骤加上其他本地开销）
+# - network_wait:  请求发出到收到第一个 token（首字节）
+# - generation:    第一个 token 到最后一个 token
+# - history_write: 最后一个 token 到流程结束，主要是写入历史（开启回答缓存时也包括写缓存）
+# - ui_dispatch:   本轮所有 evaluate_js 调用的累计耗时
+# - total:         整轮对话的总耗时
+SPAN_NAMES = (
+    "history_read", "prompt_render", "request_sent", "network_wait",
+    "generation", "history_write", "ui_dispatch", "total",
+)
+
+
+class TurnTimer(BaseCallbackHandler):
+    """
+    一轮对话的计时器。作为 LangChain 回调传入 config["callbacks"]，
+    从 chain 内部的运行事件中取得历史读取、提示词渲染、请求发出、首字节和末字节的时间点；
+    写历史和前端推送的耗时由调用方通过 mark / add / span 补充。
+    """
+    def __init__(self, request_id, session_id, kind="turn"):
+        self.request_id = request_id
+        self.session_id = session_id
+        self.kind = kind
+        self.status = "ok"
+        self.started_at = time.perf_counter()
+        self.started_wall = time.time()
+        self.marks = {}
+        self.spans = {}
+        self._runs = {}
+
+    def mark(self, name):
+        """记录某个时间点（只记录第一次）。"""
+        self.marks.setdefault(name, time.perf_counter())
+
+    def add(self, name, seconds):
+        """累加某个阶段的耗时。"""
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    @contextmanager
+    def span(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started_at)
+
+    # --- LangChain 回调 ---
+    def on_chain_start(self, serialized, inputs, *, run_id, **kwargs):
+        if kwargs.get("name") == "load_history":
+            self._runs[run_id] = ("history_read", time.perf_counter())
+        elif kwargs.get("run_type") == "prompt":
+            self._runs[run_id] = ("prompt_render", time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run:
+            self.add(run[0], time.perf_counter() - run[1])
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._runs.pop(run_id, None)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.mark("request_sent")
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        self.mark("first_byte")
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self.mark("last_byte")
+
+    def to_record(self):
+        """转换成写入 JSONL 的一条记录，所有耗时都以毫秒为单位。"""
+        finished_at = time.perf_counter()
+        ms = lambda seconds: round(seconds * 1000, 2)
+        spans = {name: ms(seconds) for name, seconds in self.spans.items()}
+        request_sent = self.marks.get("request_sent")
+        last_byte = self.marks.get("last_byte")
+        # 非流式调用没有逐 token 的回调，首字节就是末字节
+        first_byte = self.marks.get("first_byte", last_byte)
+        if request_sent is not None:
+            spans["request_sent"] = ms(request_sent - self.started_at)
+            if first_byte is not None:
+                spans["network_wait"] = ms(first_byte - request_sent)
+        if first_byte is not None and last_byte is not None:
+            spans["generation"] = ms(last_byte - first_byte)
+        if "history_write" not in spans and last_byte is not None and "done" in self.marks:
+            spans["history_write"] = ms(self.marks["done"] - last_byte)
+        spans["total"] = ms(finished_at - self.started_at)
+        return {
+            "ts": round(self.started_wall, 3),
+            "request_id": self.request_id,
+            "session_id": self.session_id,
+            "kind": self.kind,
+            "status": self.status,
+            "spans": {name: spans[name] for name in SPAN_NAMES if name in spans},
+        }
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+class MetricsRecorder:
+    """
+    请求计时的记录器。
+    - 每轮对话一行 JSON，写入按大小轮转的 metrics.jsonl（默认 1 MB，保留 3 个旧文件）
+    - 内存里保留最近 window 轮的记录，用于计算滚动的 p50/p95/p99；启动时从日志文件中恢复
+    """
+    def __init__(self, log_path, max_bytes=1024 * 1024, backup_count=3, window=500):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._records = deque(maxlen=window)
+        self._load_recent()
+        # 独立的 logger 实例，不经过 root logger，也不会重复添加 handler
+        self._handler = RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self._handler.setFormatter(logging.Formatter("%(message)s"))
+        self._logger = logging.Logger("simpleai.metrics")
+        self._logger.addHandler(self._handler)
+
+    def _load_recent(self):
+        if not os.path.exists(self.log_path):
+            return
+        try:
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        self._records.append(json.loads(line))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not load previous metrics from {self.log_path}: {e}")
+
+    def record(self, timer):
+        record = timer.to_record()
+        with self._lock:
+            self._records.append(record)
+        self._logger.info(json.dumps(record, ensure_ascii=False))
+        spans = ", ".join(f"{name} {value:.1f} ms" for name, value in record["spans"].items())
+        logging.info(f"Request {record['request_id']} ({record['kind']}, {record['status']}) timings: {spans}")
+        return record
+
+    def summary(self, recent=20):
+        """最近 window 轮对话各阶段耗时的 p50/p95/p99，以及最近几轮的原始记录。"""
+        with self._lock:
+            records = list(self._records)
+        spans = []
+        for name in SPAN_NAMES:
+            values = [r["spans"][name] for r in records if name in r.get("spans", {})]
+            if values:
+                spans.append({
+                    "name": name,
+                    "count": len(values),
+                    "p50": percentile(values, 0.5),
+                    "p95": percentile(values, 0.95),
+                    "p99": percentile(values, 0.99),
+                })
+        statuses = {}
+        for r in records:
+            statuses[r.get("status", "ok")] = statuses.get(r.get("status", "ok"), 0) + 1
+        return {
+            "count": len(records),
+            "statuses": statuses,
+            "spans": spans,
+            "recent": records[-recent:][::-1],
+            "log_path": self.log_path,
+        }
+
+    def close(self):
+        self._handler.close()
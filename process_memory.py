@@ -0,0 +1,50 @@
+import ctypes
+import ctypes.util
+import gc
+import logging
+import os
+import sys
+
+
+def current_rss_mb():
+    """当前进程的常驻内存（MB）。Linux 读 /proc，Windows 用 GetProcessMemoryInfo，其他平台退回峰值。"""
+    if sys.platform.startswith("linux"):
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    if sys.platform == "win32":
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(
+            ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb
+        )
+        return counters.WorkingSetSize / 1024 / 1024
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def release_free_memory():
+    """
+    回收循环引用的对象，并尽量把空闲的堆内存还给操作系统。
+    glibc 不会主动归还堆中间的空闲页，这里调用 malloc_trim；其他平台只做 gc。
+    """
+    collected = gc.collect()
+    if sys.platform.startswith("linux"):
+        libc_name = ctypes.util.find_library("c")
+        try:
+            ctypes.CDLL(libc_name).malloc_trim(0)
+        except (OSError, AttributeError, TypeError):
+            # musl 等没有 malloc_trim 的 libc
+            logging.debug("malloc_trim is not available on this platform.")
+    return collected
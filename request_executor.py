@@ -0,0 +1,121 @@
+import logging
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _Request:
+    def __init__(self, request_id, session_id, fn, cancellable=True):
+        self.request_id = request_id
+        self.session_id = session_id
+        self.fn = fn
+        self.cancellable = cancellable
+        self.cancel_event = threading.Event()
+
+
+class RequestExecutor:
+    """
+    后台请求执行器。
+    - 所有 LLM 调用都在这里的线程池中执行，不会阻塞 pywebview 的桥接线程。
+    - 同一个会话内的请求严格按提交顺序串行执行，避免并发写同一段历史记录；
+      不同会话之间可以并行，总并发数受 max_workers 限制。
+    - 每个请求都有一个 cancel_event，任务函数需要自行检查它来实现“停止生成”。
+    - 还没开始就被取消的请求不会调用 fn，而是在后台线程中调用 on_dropped(request_id)，方便调用方通知前端。
+    """
+    def __init__(self, max_workers=4, on_dropped=None):
+        self._on_dropped = on_dropped
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-request")
+        self._lock = threading.Lock()
+        # session_id -> 等待执行的请求队列
+        self._queues = {}
+        # session_id -> 正在执行的请求
+        self._running = {}
+        # request_id -> 请求（包括排队中和执行中的）
+        self._requests = {}
+
+    def submit(self, session_id, fn, cancellable=True):
+        """
+        提交一个请求，立即返回 request_id。
+        fn 会以 (request_id, cancel_event) 为参数在后台线程中被调用。
+        cancellable 为 False 的请求（例如排队中的设置修改）不受 cancel() 影响，一定会执行。
+        """
+        request = _Request(uuid.uuid4().hex, session_id, fn, cancellable)
+        with self._lock:
+            self._requests[request.request_id] = request
+            self._queues.setdefault(session_id, deque()).append(request)
+            if session_id not in self._running:
+                self._start_next(session_id)
+        return request.request_id
+
+    def submit_after(self, request_id, fn):
+        """
+        在 request_id 所在的队列最前面插入一个不可取消的请求，它会紧接着 request_id 执行，
+        排在同一队列里其他请求的前面。用于执行中的请求把收尾工作（例如补写历史）留到自己返回之后。
+        request_id 必须正在执行，通常由它自己的 fn 调用。
+        """
+        with self._lock:
+            session_id = self._requests[request_id].session_id
+            request = _Request(uuid.uuid4().hex, session_id, fn, cancellable=False)
+            self._requests[request.request_id] = request
+            self._queues.setdefault(session_id, deque()).appendleft(request)
+        return request.request_id
+
+    def cancel(self, request_id=None):
+        """取消指定的请求；不传 request_id 时取消全部排队中和执行中的请求。"""
+        with self._lock:
+            if request_id is None:
+                targets = list(self._requests.values())
+            else:
+                target = self._requests.get(request_id)
+                targets = [target] if target else []
+            targets = [request for request in targets if request.cancellable]
+            for request in targets:
+                request.cancel_event.set()
+        return len(targets)
+
+    def is_busy(self, session_id=None):
+        with self._lock:
+            if session_id is None:
+                return bool(self._requests)
+            return session_id in self._running
+
+    def shutdown(self):
+        self.cancel()
+        self._pool.shutdown(wait=False)
+
+    def _start_next(self, session_id):
+        """调用方需持有 self._lock。"""
+        queue = self._queues.get(session_id)
+        while queue:
+            request = queue.popleft()
+            if request.cancel_event.is_set():
+                # 还没开始就被取消的请求直接丢弃
+                self._requests.pop(request.request_id, None)
+                logging.info(f"Request {request.request_id} cancelled before it started.")
+                if self._on_dropped:
+                    # 不在持有锁的情况下回调
+                    self._pool.submit(self._notify_dropped, request.request_id)
+                continue
+            self._running[session_id] = request
+            self._pool.submit(self._run, request)
+            return
+        self._queues.pop(session_id, None)
+        self._running.pop(session_id, None)
+
+    def _notify_dropped(self, request_id):
+        try:
+            self._on_dropped(request_id)
+        except Exception as e:
+            logging.error(f"Dropped request {request_id} callback failed: {e}")
+
+    def _run(self, request):
+        try:
+            request.fn(request.request_id, request.cancel_event)
+        except Exception as e:
+            logging.error(f"Request {request.request_id} failed: {e}")
+        finally:
+            with self._lock:
+                self._requests.pop(request.request_id, None)
+                self._running.pop(request.session_id, None)
+                self._start_next(request.session_id)
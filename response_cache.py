@@ -0,0 +1,149 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from langchain_core.messages import AIMessage, AIMessageChunk, convert_to_messages
+from langchain_core.runnables import Runnable
+
+
+class ResponseCache:
+    """
+    持久化的 LLM 回答缓存，保存在单独的 SQLite 文件中。
+    - TTL：超过 ttl_seconds 的条目视为过期，查询时直接删除
+    - LRU：条目数超过 max_entries 时，淘汰最久没有被命中的条目
+    """
+    def __init__(self, db_path, max_entries=1000, ttl_seconds=7 * 24 * 3600):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, response TEXT, created_at REAL, last_used_at REAL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_response_cache_last_used_at ON response_cache (last_used_at)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(endpoints, messages):
+        """
+        缓存键：按优先级排列的全部接口 [(model_name, base_url), ...]，以及完整的消息列表
+        （system prompt + 实际发送的历史窗口 + 问题）。多个接口时回答可能来自任何一个备用接口，
+        所以整个列表都算进键里，接口配置一变就不会命中旧的回答。
+        """
+        payload = json.dumps(
+            [[list(endpoint) for endpoint in endpoints], [(m.type, m.content) for m in messages]],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row and now - row[1] <= self.ttl_seconds:
+                self._conn.execute("UPDATE response_cache SET last_used_at = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+                self.hits += 1
+                return row[0]
+            if row:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._conn.commit()
+            self.misses += 1
+            return None
+
+    def put(self, key, response):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, response, created_at, last_used_at) VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            # 顺带清理过期条目，再按 LRU 把条目数压回上限以内
+            self._conn.execute("DELETE FROM response_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                "SELECT key FROM response_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _to_messages(input):
+    """和 ChatModel 一样接受 PromptValue、字符串或消息列表，统一转换成消息列表用于计算缓存键。"""
+    if hasattr(input, "to_messages"):
+        return input.to_messages()
+    if isinstance(input, str):
+        return convert_to_messages([("human", input)])
+    return convert_to_messages(input)
+
+
+class CachedChatModel(Runnable):
+    """
+    包在 ChatOpenAI 外面的缓存层，用法与原来的 llm 相同：prompt | CachedChatModel(llm, ...)。
+    命中时直接返回缓存的完整回答（流式调用时作为一个 chunk 返回）；
+    未命中时调用真正的模型，完整生成结束后才写入缓存，被中途取消的回答不会入缓存。
+    在 config 的 configurable 中传入 skip_cache=True 可以跳过查询（但仍会用新的回答覆盖缓存），
+    重新生成回答时就是这么做的。
+    """
+    def __init__(self, llm, cache, endpoints):
+        self.llm = llm
+        self.cache = cache
+        # [(model_name, base_url), ...]，和 llm 使用的接口顺序一致
+        self.endpoints = [tuple(endpoint) for endpoint in endpoints]
+
+    def _lookup(self, input, config):
+        key = ResponseCache.make_key(self.endpoints, _to_messages(input))
+        skip = ((config or {}).get("configurable") or {}).get("skip_cache", False)
+        cached = None if skip else self.cache.get(key)
+        if cached is not None:
+            logging.info(f"Response cache hit ({self.cache.hits} hits / {self.cache.misses} misses).")
+        return key, cached
+
+    def invoke(self, input, config=None, **kwargs):
+        key, cached = self._lookup(input, config)
+        if cached is not None:
+            return AIMessage(content=cached)
+        response = self.llm.invoke(input, config, **kwargs)
+        if isinstance(response.content, str):
+            self.cache.put(key, response.content)
+        return response
+
+    def stream(self, input, config=None, **kwargs):
+        key, cached = self._lookup(input, config)
+        if cached is not None:
+            yield AIMessageChunk(content=cached)
+            return
+        parts = []
+        for chunk in self.llm.stream(input, config, **kwargs):
+            if isinstance(chunk.content, str):
+                parts.append(chunk.content)
+            yield chunk
+        self.cache.put(key, "".join(parts))
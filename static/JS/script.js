@@ -7,6 +7,10 @@ window.addEventListener('load', () => {
     const prompt_area = document.getElementById('prompt-area');
     const close_prompt_modal_button = document.getElementById('close-prompt-modal');
     const clear_screen_button = document.getElementById('clear-screen'); // 获取新按钮的引用
+    const show_history_button = document.getElementById('show-history');
+    const history_area = document.getElementById('history-area');
+    const history_search = document.getElementById('history-search');
+    const stop_button = document.getElementById('stop-button');
 
 
     // pin_button.addEventListener('click', () => {
@@ -35,7 +39,8 @@ window.addEventListener('load', () => {
             addMessageToChat(message, 'user');
             // 重点：调用 Python 的 process_input 方法
             // window.pywebview.api 是 pywebview 自动注入的对象
-            window.pywebview.api.process_input(message);
+            // Python 会立即返回一个 request_id，真正的回答稍后通过 evaluate_js 推送过来
+            window.pywebview.api.process_input(message).then(requestStarted);
             // 清空输入框
             input_txt.value = '';
         }
@@ -53,7 +58,12 @@ window.addEventListener('load', () => {
         }
 
         // 3. 调用后端的 regenerate_response 方法
-        window.pywebview.api.regenerate_response();
+        window.pywebview.api.regenerate_response().then(requestStarted);
+    });
+
+    stop_button.addEventListener('click', () => {
+        // 取消所有排队中和进行中的请求
+        window.pywebview.api.cancel_request();
     });
     
     change_prompt_button.addEventListener('click', () => {
@@ -68,6 +78,44 @@ window.addEventListener('load', () => {
     });
 
 
+    show_history_button.addEventListener('click', () => {
+        history_search.value = '';
+        loadHistoryPage(true);
+        history_area.style.display = 'flex';
+        history_search.focus();
+    });
+
+    document.getElementById('close-history-modal').addEventListener('click', () => {
+        history_area.style.display = 'none';
+    });
+
+    document.getElementById('history-more').addEventListener('click', () => {
+        loadHistoryPage(false);
+    });
+
+    // 点击会话或搜索结果，回到那个会话继续对话
+    document.getElementById('history-list').addEventListener('click', (event) => {
+        const item = event.target.closest('.history-item');
+        if (item) {
+            history_area.style.display = 'none';
+            resumeSession(item.dataset.sessionId);
+        }
+    });
+
+    // 恢复的会话滚动到顶部附近时，加载更早的一页
+    document.getElementById('ai-area').addEventListener('scroll', (event) => {
+        if (event.target.scrollTop < 200) {
+            loadOlderMessages();
+        }
+    });
+
+    // 输入停顿 250 毫秒后再搜索，避免每敲一个字都查询一次
+    let history_search_timer = null;
+    history_search.addEventListener('input', () => {
+        clearTimeout(history_search_timer);
+        history_search_timer = setTimeout(() => loadHistoryPage(true), 250);
+    });
+
     // 这就是实现点击外部区域关闭的核心逻辑
     window.addEventListener('click', (event) => {
         // event.target 会告诉我们用户实际点击的是哪个元素
@@ -75,6 +123,9 @@ window.addEventListener('load', () => {
         if (event.target == prompt_area) {
             prompt_area.style.display = "none";
         }
+        if (event.target == history_area) {
+            history_area.style.display = "none";
+        }
     });
 
     // 为清屏按钮添加点击事件监听器
@@ -83,6 +134,7 @@ window.addEventListener('load', () => {
             const chatOutput = document.getElementById('ai-area');
             // 移除所有子元素，即清空聊天记录
             chatOutput.innerHTML = '';
+            sessionPaging = null;
             // 重新添回初始的欢迎消息
             addMessageToChat('你好！有什么可以帮你的吗？', 'ai');
         });
@@ -104,15 +156,261 @@ window.addEventListener('load', () => {
     }
 });
 
+function createMessageElement(text, sender) {
+    const element = document.createElement('div');
+    element.classList.add('ai-response', sender);
+    element.innerHTML = marked.parse(text);
+    return element;
+}
+
 function addMessageToChat(text, sender) {
     const chatOutput = document.getElementById('ai-area');
-    const messageElement = document.createElement('div');
-    messageElement.classList.add('ai-response', sender);
-    messageElement.innerHTML = marked.parse(text);
+    const messageElement = createMessageElement(text, sender);
     chatOutput.appendChild(messageElement);
+    observeMessage(messageElement);
     chatOutput.scrollTop = chatOutput.scrollHeight;
 }
 
+// ---------------- 消息虚拟化与代码块懒高亮 ----------------
+// 远离可视区域的消息会被“折叠”：保存渲染好的 HTML 字符串，清空其 DOM，只保留一个同样高度的占位。
+// 滚动回来时再恢复。这样会话再长，页面里的 DOM 节点数也基本恒定。
+// 代码块只在第一次进入可视区域时才做高亮。
+const collapsedHtml = new WeakMap();
+let messageObserver = null;
+
+function getMessageObserver() {
+    if (!messageObserver) {
+        messageObserver = new IntersectionObserver(onMessageVisibilityChange, {
+            root: document.getElementById('ai-area'),
+            // 上下各预留约两屏的缓冲区，滚动时来得及恢复
+            rootMargin: '1500px 0px 1500px 0px',
+        });
+    }
+    return messageObserver;
+}
+
+function observeMessage(element) {
+    getMessageObserver().observe(element);
+}
+
+function onMessageVisibilityChange(entries) {
+    // 先统一读取要折叠的消息的高度，再统一修改 DOM，避免读写交替导致反复重排
+    const toCollapse = [];
+    for (const entry of entries) {
+        const element = entry.target;
+        if (entry.isIntersecting) {
+            expandMessage(element);
+            highlightCodeBlocks(element);
+        } else if (!element.classList.contains('streaming') && !collapsedHtml.has(element)) {
+            toCollapse.push([element, entry.boundingClientRect.height]);
+        }
+    }
+    toCollapse.forEach(([element, height]) => collapseMessage(element, height));
+}
+
+function collapseMessage(element, height) {
+    collapsedHtml.set(element, element.innerHTML);
+    element.style.height = `${height}px`;
+    element.classList.add('collapsed');
+    element.innerHTML = '';
+}
+
+function expandMessage(element) {
+    const html = collapsedHtml.get(element);
+    if (html === undefined) {
+        return;
+    }
+    element.innerHTML = html;
+    element.style.height = '';
+    element.classList.remove('collapsed');
+    collapsedHtml.delete(element);
+}
+
+// 一个很小的通用语法高亮：只区分注释、字符串、数字和常见关键字，足够让代码块更易读
+const HIGHLIGHT_PATTERN = new RegExp([
+    /(\/\/.*|#.*|\/\*[\s\S]*?\*\/)/.source,                                   // 注释
+    /("(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|`(?:[^`\\]|\\.)*`)/.source,     // 字符串
+    /\b(\d+(?:\.\d+)?)\b/.source,                                             // 数字
+    /\b(function|def|class|return|if|else|elif|for|while|in|of|import|from|as|const|let|var|new|try|catch|except|finally|raise|throw|async|await|public|private|static|void|int|True|False|None|true|false|null|undefined|self|this|with|lambda|yield|break|continue)\b/.source, // 关键字
+].join('|'), 'g');
+const HIGHLIGHT_CLASSES = ['tok-comment', 'tok-string', 'tok-number', 'tok-keyword'];
+
+function escapeHtml(text) {
+    return text.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;');
+}
+
+function highlightCode(code) {
+    let html = '';
+    let last = 0;
+    for (const match of code.matchAll(HIGHLIGHT_PATTERN)) {
+        const group = match.slice(1).findIndex(value => value !== undefined);
+        html += escapeHtml(code.slice(last, match.index));
+        html += `<span class="${HIGHLIGHT_CLASSES[group]}">${escapeHtml(match[0])}</span>`;
+        last = match.index + match[0].length;
+    }
+    return html + escapeHtml(code.slice(last));
+}
+
+function highlightCodeBlocks(element) {
+    if (element.classList.contains('streaming')) {
+        return;
+    }
+    element.querySelectorAll('pre code:not([data-highlighted])').forEach(block => {
+        block.innerHTML = highlightCode(block.textContent);
+        block.dataset.highlighted = 'true';
+    });
+}
+
+// 记录还没有完成的请求，用来控制“停止生成”按钮的显示
+const pendingRequests = new Set();
+
+function requestStarted(requestId) {
+    if (!requestId) {
+        return;
+    }
+    pendingRequests.add(requestId);
+    document.getElementById('stop-button').style.display = 'block';
+}
+
+function requestFinished(requestId) {
+    pendingRequests.delete(requestId);
+    if (pendingRequests.size === 0) {
+        document.getElementById('stop-button').style.display = 'none';
+    }
+}
+
+// 流式输出：Python 端会先调用 startStreamingMessage 创建一条空的 AI 消息，
+// 然后多次调用 appendToStreamingMessage 追加文本，最后调用 finishStreamingMessage 结束。
+// 不同请求的回答可能同时在生成，所以按 request_id 分别记录。
+// 增量渲染：逐行扫描新增的文本，扫描位置和代码块状态在两次追加之间保留，每次追加只处理新增的部分：
+// - 代码块之外的空行之前的部分（完整的段落）只解析一次并固定下来
+// - 代码块一开始就创建 <pre><code>，之后的代码按行以纯文本追加进去，不再经过 marked
+// - 没有空行的长段落超过 STREAM_TAIL_MAX_CHARS 后在行尾提前固定
+// 这样每次追加的开销只和新增文本的长度有关，长代码块、长段落也不会被反复整体解析。
+const streamingMessages = new Map();
+const STREAM_TAIL_MAX_CHARS = 2000;
+// 代码块的开始或结束行：``` / ~~~（三个及以上），后面可以跟语言名
+const FENCE_PATTERN = /^(`{3,}|~{3,})([^`]*)$/;
+
+function startStreamingMessage(requestId) {
+    const chatOutput = document.getElementById('ai-area');
+    const element = document.createElement('div');
+    element.classList.add('ai-response', 'ai', 'streaming');
+    const committed = document.createElement('div');
+    const tail = document.createElement('div');
+    element.appendChild(committed);
+    element.appendChild(tail);
+    chatOutput.appendChild(element);
+    observeMessage(element);
+    chatOutput.scrollTop = chatOutput.scrollHeight;
+    streamingMessages.set(requestId, {
+        element: element,
+        committed: committed,
+        tail: tail,
+        text: '',
+        // 已经固定下来的文本长度，以及下一行开始扫描的位置
+        committedLength: 0,
+        scanPos: 0,
+        // 正在输出的代码块：{ marker, code, partial }，partial 是代码块里还没写完的那一行
+        fence: null,
+    });
+}
+
+// 把 committedLength 到 end 之间的 markdown 解析一次，追加到已固定的部分
+function commitMarkdown(message, end) {
+    if (end > message.committedLength) {
+        const block = message.text.slice(message.committedLength, end);
+        message.committed.insertAdjacentHTML('beforeend', marked.parse(block));
+        message.committedLength = end;
+    }
+}
+
+function openFence(message, marker, info) {
+    const pre = document.createElement('pre');
+    const code = document.createElement('code');
+    const language = info.trim().split(/\s+/)[0];
+    if (language) {
+        code.className = `language-${language}`;
+    }
+    const partial = document.createTextNode('');
+    code.appendChild(partial);
+    pre.appendChild(code);
+    message.committed.appendChild(pre);
+    message.fence = { marker: marker, code: code, partial: partial };
+}
+
+// 从上次的位置继续扫描新增的完整行，最后一行还没写完时留到下次
+function scanStreamingLines(message) {
+    const text = message.text;
+    let lineEnd;
+    while ((lineEnd = text.indexOf('\n', message.scanPos)) !== -1) {
+        const lineStart = message.scanPos;
+        const line = text.slice(lineStart, lineEnd);
+        const fenceMatch = FENCE_PATTERN.exec(line.trim());
+        message.scanPos = lineEnd + 1;
+        const fence = message.fence;
+        if (fence) {
+            const marker = fenceMatch && fenceMatch[1];
+            if (marker && marker[0] === fence.marker[0] && marker.length >= fence.marker.length && !fenceMatch[2].trim()) {
+                fence.partial.data = '';
+                message.fence = null;
+            } else {
+                fence.code.insertBefore(document.createTextNode(line + '\n'), fence.partial);
+            }
+            message.committedLength = lineEnd + 1;
+        } else if (fenceMatch) {
+            commitMarkdown(message, lineStart);
+            openFence(message, fenceMatch[1], fenceMatch[2]);
+            message.committedLength = lineEnd + 1;
+        } else if (line.trim() === '' || lineEnd + 1 - message.committedLength > STREAM_TAIL_MAX_CHARS) {
+            commitMarkdown(message, lineEnd + 1);
+        }
+    }
+}
+
+function appendToStreamingMessage(requestId, delta) {
+    if (!streamingMessages.has(requestId)) {
+        startStreamingMessage(requestId);
+    }
+    const message = streamingMessages.get(requestId);
+    const chatOutput = document.getElementById('ai-area');
+    // 判断用户是否停留在底部，如果用户在往上翻看，就不要强制滚动
+    const atBottom = chatOutput.scrollHeight - chatOutput.scrollTop - chatOutput.clientHeight < 40;
+    message.text += delta;
+
+    scanStreamingLines(message);
+    const tailText = message.text.slice(message.committedLength);
+    if (message.fence) {
+        message.fence.partial.data = tailText;
+        if (message.tail.firstChild) {
+            message.tail.innerHTML = '';
+        }
+    } else {
+        message.tail.innerHTML = tailText ? marked.parse(tailText) : '';
+    }
+
+    if (atBottom) {
+        chatOutput.scrollTop = chatOutput.scrollHeight;
+    }
+}
+
+function finishStreamingMessage(requestId) {
+    const message = streamingMessages.get(requestId);
+    if (!message) {
+        return;
+    }
+    message.element.classList.remove('streaming');
+    // 如果一个字都没有收到（例如请求直接失败），就把空消息移除
+    if (!message.text) {
+        message.element.remove();
+    } else {
+        // 结束时整体解析一次，修正按块解析可能产生的细微差异（例如被空行分开的列表）
+        message.element.innerHTML = marked.parse(message.text);
+        highlightCodeBlocks(message.element);
+    }
+    streamingMessages.delete(requestId);
+}
+
 function renderPromptOptions() {
     const container = document.getElementById('prompt-options');
     container.innerHTML = ''; // 清空旧列表
@@ -128,3 +426,154 @@ function renderPromptOptions() {
     });
 }
 
+
+const HISTORY_PAGE_SIZE = 20;
+// 当前显示的列表：查询词和已加载的条数。查询词为空时显示会话列表，否则显示搜索结果
+const historyState = { query: '', offset: 0, generation: 0 };
+
+function formatTimestamp(seconds) {
+    return seconds ? new Date(seconds * 1000).toLocaleString() : '';
+}
+
+// 摘要里的命中部分由后端用 \u0002 / \u0003 标记，先转义整段文字再换成 <mark>，消息内容不会被当作 HTML
+function renderSnippet(snippet) {
+    return escapeHtml(snippet).replace(/\u0002/g, '<mark>').replace(/\u0003/g, '</mark>');
+}
+
+function createHistoryItem(sessionId, title, meta, snippetHtml) {
+    const item = document.createElement('div');
+    item.className = 'history-item';
+    item.dataset.sessionId = sessionId;
+    const heading = document.createElement('div');
+    heading.className = 'history-title';
+    heading.textContent = title || '（无标题）';
+    const info = document.createElement('div');
+    info.className = 'history-meta';
+    info.textContent = meta;
+    item.append(heading, info);
+    if (snippetHtml) {
+        const snippet = document.createElement('div');
+        snippet.className = 'history-snippet';
+        snippet.innerHTML = snippetHtml;
+        item.appendChild(snippet);
+    }
+    return item;
+}
+
+function loadHistoryPage(reset) {
+    const list = document.getElementById('history-list');
+    const more_button = document.getElementById('history-more');
+    if (reset) {
+        historyState.query = document.getElementById('history-search').value.trim();
+        historyState.offset = 0;
+        list.innerHTML = '';
+    }
+    // 输入变化后旧请求的结果可能晚到，用序号丢弃过期的结果
+    const generation = ++historyState.generation;
+    const query = historyState.query;
+    const request = query
+        ? window.pywebview.api.search_history(query, HISTORY_PAGE_SIZE, historyState.offset)
+        : window.pywebview.api.list_sessions(HISTORY_PAGE_SIZE, historyState.offset);
+
+    request.then(page => {
+        if (generation !== historyState.generation) {
+            return;
+        }
+        const items = query ? page.results : page.sessions;
+        for (const entry of items) {
+            const meta = [entry.profile_name, formatTimestamp(entry.updated_at)];
+            if (query) {
+                meta.push(entry.type === 'human' ? '提问' : '回答');
+                list.appendChild(createHistoryItem(entry.session_id, entry.title, meta.filter(Boolean).join(' · '), renderSnippet(entry.snippet)));
+            } else {
+                meta.push(`${entry.message_count} 条消息`);
+                list.appendChild(createHistoryItem(entry.session_id, entry.title, meta.filter(Boolean).join(' · ')));
+            }
+        }
+        historyState.offset += items.length;
+        if (historyState.offset === 0) {
+            list.textContent = query ? '没有找到匹配的消息' : '还没有历史记录';
+        }
+        more_button.style.display = page.has_more ? 'inline-block' : 'none';
+    });
+}
+
+// ---------------- 恢复历史会话 ----------------
+// 恢复时只加载最近一页消息，向上滚动时再按 before_id 逐页加载更早的消息，
+// 会话再长，打开的耗时和内存都只与一页的大小有关。
+// sessionPaging 为 null 表示当前显示的不是恢复的会话（或已经清屏），不需要翻页。
+let sessionPaging = null;
+
+// 清空聊天区域，渲染会话最近的一页消息，更早的消息向上滚动时再加载
+function renderSessionPage(sessionId, page) {
+    const chatOutput = document.getElementById('ai-area');
+    chatOutput.innerHTML = '';
+    sessionPaging = { sessionId: sessionId, beforeId: page.before_id, hasMore: page.has_more, loading: false };
+    for (const message of page.messages) {
+        addMessageToChat(message.content, message.type === 'human' ? 'user' : 'ai');
+    }
+}
+
+function resumeSession(sessionId) {
+    window.pywebview.api.resume_session(sessionId).then(page => {
+        if (!page) {
+            return;
+        }
+        renderSessionPage(sessionId, page);
+        const role = page.profile_name ? `（${page.profile_name}）` : '';
+        addMessageToChat(`已恢复会话${role}: ${page.title || sessionId}`, 'system');
+    });
+}
+
+function loadOlderMessages() {
+    const paging = sessionPaging;
+    if (!paging || !paging.hasMore || paging.loading) {
+        return;
+    }
+    paging.loading = true;
+    window.pywebview.api.load_history_page(paging.sessionId, paging.beforeId).then(page => {
+        paging.loading = false;
+        // 加载期间清屏或者恢复了别的会话，丢弃这一页
+        if (paging !== sessionPaging) {
+            return;
+        }
+        paging.beforeId = page.before_id;
+        paging.hasMore = page.has_more;
+
+        const chatOutput = document.getElementById('ai-area');
+        const fragment = document.createDocumentFragment();
+        const elements = page.messages.map(message =>
+            createMessageElement(message.content, message.type === 'human' ? 'user' : 'ai'));
+        elements.forEach(element => fragment.appendChild(element));
+        // 插到最前面之后按新增的高度调整滚动位置，保持用户正在看的内容不动
+        const previousHeight = chatOutput.scrollHeight;
+        chatOutput.insertBefore(fragment, chatOutput.firstChild);
+        chatOutput.scrollTop += chatOutput.scrollHeight - previousHeight;
+        elements.forEach(observeMessage);
+    });
+}
+
+// ---------------- 空闲模式 ----------------
+// 窗口长时间隐藏时 Python 端调用 enterIdle 清空聊天 DOM，会话本身保存在数据库里；
+// 窗口再次显示时调用 leaveIdle，从数据库重新渲染最近的一页消息。
+function enterIdle() {
+    document.getElementById('ai-area').innerHTML = '';
+    document.getElementById('history-list').innerHTML = '';
+    sessionPaging = null;
+    if (messageObserver) {
+        messageObserver.disconnect();
+        messageObserver = null;
+    }
+}
+
+function leaveIdle(sessionId, page) {
+    // 恢复期间用户已经发出了新消息，不再覆盖
+    if (document.getElementById('ai-area').hasChildNodes()) {
+        return;
+    }
+    if (page && page.messages.length) {
+        renderSessionPage(sessionId, page);
+    } else {
+        addMessageToChat('你好！有什么可以帮你的吗？', 'ai');
+    }
+}
@@ -10,6 +10,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const saveHotkeyButton = document.getElementById('save-hotkey-btn');
     const savePromptButton = document.getElementById('save-prompt-btn');
     const clearPromptFormButton = document.getElementById('clear-prompt-form-btn');
+    const refreshMetricsButton = document.getElementById('refresh-metrics-btn');
 
     // 为保存按钮添加点击事件
     if (saveButton) {
@@ -31,6 +32,11 @@ document.addEventListener('DOMContentLoaded', () => {
         clearPromptFormButton.addEventListener('click', clearPromptForm);
     }
 
+    // 为刷新性能统计按钮添加点击事件
+    if(refreshMetricsButton) {
+        refreshMetricsButton.addEventListener('click', loadMetrics);
+    }
+
     // 为快捷键输入框添加键盘事件监听
     if (hotkeyInput) {
         hotkeyInput.addEventListener('keydown', handleHotkeyInput);
@@ -50,6 +56,11 @@ document.addEventListener('DOMContentLoaded', () => {
                 page.classList.remove('active');
             });
             document.getElementById(targetId).classList.add('active');
+
+            // 每次打开性能统计页面时都重新获取最新数据
+            if (targetId === 'metrics-settings') {
+                loadMetrics();
+            }
         });
     });
 });
@@ -261,4 +272,43 @@ function saveHotkey() {
             statusElement.textContent = '';
         }, 2000);
     }
-} 
\ No newline at end of file
+} 
+
+
+// 各阶段在页面上显示的名称，顺序与 Python 端 metrics.SPAN_NAMES 一致
+const SPAN_LABELS = {
+    history_read: '读取历史',
+    prompt_render: '渲染提示词',
+    request_sent: '发出请求',
+    network_wait: '等待首字节',
+    generation: '生成回答',
+    history_write: '写入历史',
+    ui_dispatch: '推送到界面',
+    total: '总耗时'
+};
+
+function loadMetrics() {
+    window.pywebview.api.get_metrics_summary().then(summary => {
+        const summaryElement = document.getElementById('metrics-summary');
+        const tbody = document.querySelector('#metrics-table tbody');
+        tbody.innerHTML = '';
+
+        if (!summary || summary.count === 0) {
+            summaryElement.textContent = summary ? '暂无数据，发送几条消息后再来查看。' : '性能统计未开启（secrets.json 中的 metrics_enabled）。';
+            return;
+        }
+
+        const statuses = Object.entries(summary.statuses).map(([status, count]) => `${status}: ${count}`).join('，');
+        summaryElement.textContent = `最近 ${summary.count} 轮对话（${statuses}）。详细记录见 ${summary.log_path}`;
+
+        summary.spans.forEach(span => {
+            const row = document.createElement('tr');
+            [SPAN_LABELS[span.name] || span.name, span.count, span.p50, span.p95, span.p99].forEach((value, i) => {
+                const cell = document.createElement('td');
+                cell.textContent = i >= 2 ? value.toFixed(1) : value;
+                row.appendChild(cell);
+            });
+            tbody.appendChild(row);
+        });
+    });
+}